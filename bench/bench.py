@@ -0,0 +1,411 @@
+
+# Runs standard workloads against a master and chunkservers started as
+# local processes, e.g.
+#
+#   python bench.py --out before.json
+#   python bench.py --compare before.json
+#
+# --workloads takes a comma separated subset of WORKLOADS. Results are
+# printed as a table and, with --out, written as JSON; --compare prints the
+# change in throughput and latency from an earlier run's JSON.
+
+import setup
+import json
+import os
+import random
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+import client
+import rpc
+
+_clock = getattr(time, "perf_counter", time.time)
+
+DFS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "dfs")
+
+WORKLOADS = [
+    "seq_write",
+    "seq_read",
+    "random_read",
+    "small_files",
+    "metadata",
+    "concurrent",
+]
+
+def _free_port():
+    s = socket.socket()
+    s.bind(("127.0.0.1", 0))
+    port = s.getsockname()[1]
+    s.close()
+    return port
+
+def _cpu_seconds(pid):
+    # User plus system time of a running process, or None off Linux.
+    try:
+        with open("/proc/{}/stat".format(pid)) as f:
+            fields = f.read().rsplit(")", 1)[1].split()
+    except (IOError, OSError):
+        return None
+    return float(int(fields[11]) + int(fields[12])) / os.sysconf("SC_CLK_TCK")
+
+def _wait_ready(addr, timeout=10.0):
+    # Waits until the server at addr answers a ping.
+    deadline = time.time() + timeout
+    while True:
+        try:
+            conn = rpc.connect(addr)
+            try:
+                rpc.call_framed(conn, "ping")
+            finally:
+                conn.close()
+            return
+        except Exception:
+            if time.time() > deadline:
+                raise IOError("{}:{} never came up".format(*addr))
+            time.sleep(0.05)
+
+def percentile(samples, p):
+    # Nearest rank percentile of a list of samples.
+    if not samples:
+        return None
+    ordered = sorted(samples)
+    rank = max(0, int(round(p / 100.0 * len(ordered))) - 1)
+    return ordered[min(rank, len(ordered) - 1)]
+
+class Cluster:
+
+    # A master and n chunkservers running as local processes on free
+    # loopback ports. Server output goes to log files in a scratch
+    # directory that's removed on stop.
+
+    def __init__(self, nchunkservers, replication, env="mem",
+                 python=sys.executable):
+        self._dir = tempfile.mkdtemp(prefix="dfs-bench-")
+        self._python = python
+        self._procs = []
+        try:
+            self._start(nchunkservers, replication, env)
+        except Exception:
+            self.stop()
+            raise
+
+    def _start(self, nchunkservers, replication, env):
+        self.master_addr = ("127.0.0.1", _free_port())
+        chunk_port = _free_port()
+
+        self.master = self._spawn("master", "master.py", [
+            "--client-port", str(self.master_addr[1]),
+            "--chunk-port", str(chunk_port),
+            "--replication", str(replication),
+            "--meta-dir", os.path.join(self._dir, "meta"),
+        ])
+        _wait_ready(self.master_addr)
+
+        self.chunkservers = []
+        for n in range(nchunkservers):
+            port = _free_port()
+            args = [
+                "--client-port", str(port),
+                "--master-addr", "127.0.0.1:{}".format(chunk_port),
+                "--env", env,
+            ]
+            if env == "posix":
+                args += ["--data-dir", os.path.join(self._dir, "data{}".format(n))]
+            self.chunkservers.append(
+                self._spawn("chunkserver{}".format(n), "chunkserver.py", args)
+            )
+            _wait_ready(("127.0.0.1", port))
+        # Chunkservers answer before the master has finished registering them.
+        time.sleep(0.5)
+
+    def _spawn(self, name, script, args):
+        log = open(os.path.join(self._dir, name + ".log"), "w")
+        proc = subprocess.Popen(
+            [self._python, script] + args,
+            cwd=DFS_DIR,
+            stdout=log,
+            stderr=subprocess.STDOUT
+        )
+        log.close()
+        self._procs.append(proc)
+        return proc
+
+    def cpu(self):
+        # Returns {"master": s, "chunkservers": s} of CPU time used so far.
+        usage = {"master": _cpu_seconds(self.master.pid), "chunkservers": 0.0}
+        for proc in self.chunkservers:
+            s = _cpu_seconds(proc.pid)
+            if s is None:
+                usage["chunkservers"] = None
+                break
+            usage["chunkservers"] += s
+        return usage
+
+    def connect(self, **kwargs):
+        return client.connect(self.master_addr, **kwargs)
+
+    def stop(self):
+        for proc in self._procs:
+            if proc.poll() is None:
+                proc.terminate()
+        for proc in self._procs:
+            proc.wait()
+        shutil.rmtree(self._dir, ignore_errors=True)
+
+class Recorder:
+
+    # Collects per-op latencies and bytes moved for one workload. Safe to
+    # share between client threads.
+
+    def __init__(self):
+        self.latencies = []
+        self.nbytes = 0
+        self._lock = threading.Lock()
+
+    def record(self, elapsed, nbytes=0):
+        with self._lock:
+            self.latencies.append(elapsed)
+            self.nbytes += nbytes
+
+    def time(self, fn, nbytes=0):
+        start = _clock()
+        result = fn()
+        self.record(_clock() - start, nbytes)
+        return result
+
+def _payload(size):
+    return os.urandom(size)
+
+def seq_write(cluster, opts, rec):
+    data = _payload(opts["io_size"])
+    with cluster.connect() as cl:
+        f = cl.create("seq")
+        for _ in range(opts["file_size"] // len(data)):
+            rec.time(lambda: f.write(data), len(data))
+        rec.time(f.close)
+
+def seq_read(cluster, opts, rec):
+    with cluster.connect() as cl:
+        f = cl.open("seq")
+        while True:
+            start = _clock()
+            buf = f.read(opts["io_size"])
+            if not buf:
+                break
+            rec.record(_clock() - start, len(buf))
+        f.close()
+
+def random_read(cluster, opts, rec):
+    # Block-aligned reads of one block each, with no cache, so every read
+    # goes to a chunkserver and moves only what's recorded.
+    size = 4096
+    rand = random.Random(0)
+    with cluster.connect(readahead_max=0, cache_size=0, block_size=size) as cl:
+        f = cl.open("seq")
+        for _ in range(opts["random_reads"]):
+            f.seek(rand.randrange(0, opts["file_size"] // size) * size)
+            rec.time(lambda: f.read(size), size)
+        f.close()
+
+def small_files(cluster, opts, rec):
+    data = _payload(opts["small_file_size"])
+    names = ["small{}".format(n) for n in range(opts["small_files"])]
+    with cluster.connect() as cl:
+        def put(name):
+            f = cl.create(name)
+            f.write(data)
+            f.close()
+        def get(name):
+            f = cl.open(name)
+            f.read(len(data))
+            f.close()
+        for name in names:
+            rec.time(lambda: put(name), len(data))
+        for name in names:
+            rec.time(lambda: get(name), len(data))
+        for name in names:
+            cl.delete(name)
+
+def metadata(cluster, opts, rec):
+    names = ["meta{}".format(n) for n in range(opts["metadata_ops"])]
+    with cluster.connect() as cl:
+        for name in names:
+            rec.time(lambda: cl.create(name).close())
+        for name in names:
+            rec.time(lambda: cl.open(name).close())
+        for name in names:
+            rec.time(lambda: cl.delete(name))
+
+def concurrent(cluster, opts, rec):
+    # Each client writes then reads back its own share of file_size.
+    nclients = opts["clients"]
+    data = _payload(opts["io_size"])
+    count = max(1, opts["file_size"] // nclients // len(data))
+    errors = []
+
+    def run(n):
+        try:
+            with cluster.connect() as cl:
+                name = "concurrent{}".format(n)
+                f = cl.create(name)
+                for _ in range(count):
+                    rec.time(lambda: f.write(data), len(data))
+                rec.time(f.close)
+                f = cl.open(name)
+                for _ in range(count):
+                    rec.time(lambda: f.read(len(data)), len(data))
+                f.close()
+                cl.delete(name)
+        except Exception as err:
+            errors.append(err)
+
+    threads = [threading.Thread(target=run, args=(n,)) for n in range(nclients)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    if errors:
+        raise errors[0]
+
+def run_workload(cluster, name, opts):
+    rec = Recorder()
+    cpu_before = cluster.cpu()
+    start = _clock()
+    globals()[name](cluster, opts, rec)
+    elapsed = _clock() - start
+    cpu_after = cluster.cpu()
+
+    cpu = {}
+    for proc, before in cpu_before.items():
+        after = cpu_after[proc]
+        cpu[proc] = None if before is None or after is None else after - before
+    p50, p99 = percentile(rec.latencies, 50), percentile(rec.latencies, 99)
+    return {
+        "workload": name,
+        "ops": len(rec.latencies),
+        "bytes": rec.nbytes,
+        "seconds": elapsed,
+        "ops_per_sec": len(rec.latencies) / elapsed,
+        "mb_per_sec": rec.nbytes / elapsed / (1 << 20),
+        "p50_ms": None if p50 is None else p50 * 1000,
+        "p99_ms": None if p99 is None else p99 * 1000,
+        "master_cpu_sec": cpu["master"],
+        "chunkserver_cpu_sec": cpu["chunkservers"],
+    }
+
+def _fmt(value):
+    if value is None:
+        return "-"
+    return "{:.2f}".format(value)
+
+def print_results(results, baseline=None):
+    # Prints a table of results, with the change from a baseline run's
+    # matching workload alongside throughput and latency if one is given.
+    base = {}
+    if baseline is not None:
+        base = dict((r["workload"], r) for r in baseline["results"])
+
+    def change(r, key):
+        old = base.get(r["workload"], {}).get(key)
+        if not old or r[key] is None:
+            return ""
+        return " ({:+.0f}%)".format((r[key] - old) * 100.0 / old)
+
+    header = ("workload", "ops/s", "MB/s", "p50 ms", "p99 ms",
+              "master cpu", "cs cpu")
+    print("{:<12} {:>18} {:>18} {:>18} {:>18} {:>10} {:>10}".format(*header))
+    for r in results:
+        print("{:<12} {:>18} {:>18} {:>18} {:>18} {:>10} {:>10}".format(
+            r["workload"],
+            _fmt(r["ops_per_sec"]) + change(r, "ops_per_sec"),
+            _fmt(r["mb_per_sec"]) + change(r, "mb_per_sec"),
+            _fmt(r["p50_ms"]) + change(r, "p50_ms"),
+            _fmt(r["p99_ms"]) + change(r, "p99_ms"),
+            _fmt(r["master_cpu_sec"]),
+            _fmt(r["chunkserver_cpu_sec"])
+        ))
+
+def main():
+    opts = {
+        "chunkservers": 3,
+        "replication": 3,
+        "env": "mem",
+        "file_size": 64 << 20,
+        "io_size": 1 << 20,
+        "random_reads": 2000,
+        "small_files": 500,
+        "small_file_size": 4096,
+        "metadata_ops": 1000,
+        "clients": 4,
+    }
+    workloads = WORKLOADS
+    out = None
+    compare = None
+
+    args = sys.argv[1:]
+    for idx, arg in enumerate(args):
+        if idx+1 >= len(args):
+            break
+        value = args[idx+1]
+        if arg == "--chunkservers":
+            opts["chunkservers"] = int(value)
+        elif arg == "--replication":
+            opts["replication"] = int(value)
+        elif arg == "--env":
+            opts["env"] = value
+        elif arg == "--file-size-mb":
+            opts["file_size"] = int(value) << 20
+        elif arg == "--io-size-kb":
+            opts["io_size"] = int(value) << 10
+        elif arg == "--random-reads":
+            opts["random_reads"] = int(value)
+        elif arg == "--small-files":
+            opts["small_files"] = int(value)
+        elif arg == "--metadata-ops":
+            opts["metadata_ops"] = int(value)
+        elif arg == "--clients":
+            opts["clients"] = int(value)
+        elif arg == "--workloads":
+            workloads = value.split(",")
+        elif arg == "--out":
+            out = value
+        elif arg == "--compare":
+            compare = value
+
+    for name in workloads:
+        if name not in WORKLOADS:
+            print("Unrecognized workload {}".format(name))
+            sys.exit(1)
+    if ("seq_read" in workloads or "random_read" in workloads) \
+            and "seq_write" not in workloads:
+        # The read workloads read back the file seq_write leaves behind.
+        workloads = ["seq_write"] + workloads
+
+    baseline = None
+    if compare is not None:
+        with open(compare) as f:
+            baseline = json.load(f)
+
+    cluster = Cluster(opts["chunkservers"], opts["replication"], opts["env"])
+    try:
+        results = [run_workload(cluster, name, opts) for name in workloads]
+    finally:
+        cluster.stop()
+
+    print_results(results, baseline)
+    if out is not None:
+        with open(out, "w") as f:
+            json.dump({
+                "time": time.time(),
+                "python": sys.version.split()[0],
+                "options": opts,
+                "results": results,
+            }, f, indent=2, sort_keys=True)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,4 @@
+#!/usr/bin/env bash
+
+cd "$(dirname "$0")"
+python bench.py "$@"
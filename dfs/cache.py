@@ -0,0 +1,75 @@
+
+import collections
+import threading
+
+class BlockCache:
+
+    # Blocks are keyed by (chunkid, start_offset, end_offset) and evicted
+    # in least recently used order once their total size exceeds capacity.
+
+    def __init__(self, capacity):
+        self._capacity = capacity
+        self._size = 0
+        self._blocks = collections.OrderedDict()
+        self._chunk_keys = {}
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def _remove(self, key):
+        block = self._blocks.pop(key)
+        self._size -= len(block)
+        keys = self._chunk_keys[key[0]]
+        keys.discard(key)
+        if not keys:
+            del self._chunk_keys[key[0]]
+
+    def contains(self, key):
+        with self._lock:
+            return key in self._blocks
+
+    def get(self, key):
+        with self._lock:
+            block = self._blocks.pop(key, None)
+            if block is None:
+                self.misses += 1
+                return None
+            self._blocks[key] = block
+            self.hits += 1
+            return block
+
+    def add(self, key, block):
+        if len(block) > self._capacity:
+            return
+        with self._lock:
+            if key in self._blocks:
+                self._remove(key)
+            self._blocks[key] = block
+            self._size += len(block)
+            self._chunk_keys.setdefault(key[0], set()).add(key)
+            while self._size > self._capacity:
+                oldest = next(iter(self._blocks))
+                self._remove(oldest)
+                self.evictions += 1
+
+    def invalidate(self, chunkid, start_offset=0, end_offset=None):
+        with self._lock:
+            for key in list(self._chunk_keys.get(chunkid, ())):
+                _, start, end = key
+                if end_offset is not None and start >= end_offset:
+                    continue
+                if end <= start_offset:
+                    continue
+                self._remove(key)
+
+    def stats(self):
+        with self._lock:
+            return {
+                "size": self._size,
+                "capacity": self._capacity,
+                "blocks": len(self._blocks),
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions
+            }
@@ -0,0 +1,36 @@
+
+import struct
+import zlib
+
+_ENTRY_SIZE = 4
+
+def _crc32_view(data, start, end, crc):
+    return zlib.crc32(memoryview(data)[start:end], crc)
+
+def _crc32_buffer(data, start, end, crc):
+    # Python 2's crc32 takes buffers but not memoryviews or bytearrays.
+    if isinstance(data, memoryview):
+        data, start, end = data[start:end].tobytes(), 0, end - start
+    return zlib.crc32(buffer(data, start, end - start), crc)
+
+try:
+    zlib.crc32(memoryview(b""))
+    _crc32 = _crc32_view
+except TypeError:
+    _crc32 = _crc32_buffer
+
+def crc32(data, start=0, end=None, crc=0):
+    # CRC32 of data[start:end], continuing from crc, without copying.
+    if end is None:
+        end = len(data)
+    return _crc32(data, start, end, crc) & 0xffffffff
+
+def pack(crcs):
+    return struct.pack("!{}I".format(len(crcs)), *crcs)
+
+def unpack(data):
+    n = len(data) // _ENTRY_SIZE
+    return list(struct.unpack("!{}I".format(n), data[:n * _ENTRY_SIZE]))
+
+def entry_offset(block):
+    return block * _ENTRY_SIZE
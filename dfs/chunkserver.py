@@ -1,113 +1,907 @@
 
+import bisect
+import collections
+import logging
 import socket
-import select
+import sys
+import threading
+import time
 
+import checksum
+import compression
 from constants import *
+from metrics import start_dump
+from pool import ConnectionPool
+from server import Server
+from workers import Future, KeyedThreads, WorkerPool, gather, run_into
 import rpc
 
+log = logging.getLogger("chunkserver")
+
+class _FrameIndex:
+
+    # Where each frame of a compressed chunk is stored and the raw offset
+    # it ends at.
+
+    def __init__(self):
+        self.starts = []
+        self.ends = []
+        self.stored = 0
+
+    def size(self):
+        return self.ends[-1] if self.ends else 0
+
+    def add(self, raw_len, stored_len):
+        self.starts.append(self.stored)
+        self.ends.append(self.size() + raw_len)
+        self.stored += compression.HEADER.size + stored_len
+
+    def span(self, start, end):
+        # Returns (raw offset, stored start, stored end) of the frames
+        # holding raw bytes [start, end), which must be in the chunk.
+        first = bisect.bisect_right(self.ends, start)
+        last = bisect.bisect_left(self.ends, end)
+        raw = self.ends[first-1] if first > 0 else 0
+        if last + 1 < len(self.starts):
+            return raw, self.starts[first], self.starts[last+1]
+        return raw, self.starts[first], self.stored
+
 class ChunkServer:
 
+    # Each chunk has a sidecar file holding a CRC32 of every
+    # CHECKSUM_BLOCK_SIZE block. Writes update the checksums of the blocks
+    # they touch and reads verify them, so corrupt data is never served.
+    # Chunks found corrupt are remembered until take_bad_chunks is called.
+    #
+    # Chunks of compressed files are written and read framed: they hold
+    # the frames clients send, and offsets and sizes count raw bytes. They
+    # can only be appended to. Checksums cover the stored bytes.
+
     def __init__(self, env):
         self._env = env
+        self._lock = threading.Lock()
+        self._bad = set()
+        self._last_access = {}
+        self._frames = {}
 
     def _chunk_fname(self, chunkid):
         return str(chunkid)
 
+    def _crc_fname(self, chunkid):
+        return str(chunkid) + CHECKSUM_SUFFIX
+
+    def _touch(self, chunkid):
+        self._last_access[chunkid] = time.time()
+
+    def chunk_ids(self):
+        return [
+            name for name in self._env.listdir()
+            if not name.endswith(CHECKSUM_SUFFIX)
+        ]
+
+    def is_cold(self, chunkid, cold_after):
+        last = self._last_access.get(chunkid, 0)
+        return time.time() - last >= cold_after
+
+    def _mark_bad(self, chunkid):
+        with self._lock:
+            self._bad.add(chunkid)
+
+    def take_bad_chunks(self):
+        with self._lock:
+            bad, self._bad = self._bad, set()
+        return list(bad)
+
     def create_chunk(self, chunkid):
         fd = self._env.open(self._chunk_fname(chunkid), "w+")
         self._env.close(fd)
+        self._env.close(self._env.open(self._crc_fname(chunkid), "w+"))
+
+    def create_chunks(self, chunkids):
+        for chunkid in chunkids:
+            self.create_chunk(chunkid)
 
     def delete_chunk(self, chunkid):
         self._env.remove(self._chunk_fname(chunkid))
+        self._last_access.pop(chunkid, None)
+        with self._lock:
+            self._frames.pop(chunkid, None)
+        try:
+            self._env.remove(self._crc_fname(chunkid))
+        except IOError:
+            pass
+
+    def delete_chunks(self, chunkids):
+        # Chunks already gone are skipped, so a batch can be retried.
+        for chunkid in chunkids:
+            try:
+                self.delete_chunk(chunkid)
+            except IOError:
+                pass
+
+    def _check_size(self, chunkid, size):
+        if size > CHUNK_SIZE:
+            raise ValueError("Write of {} bytes exceeds size of chunk {}".format(
+                size, chunkid))
+
+    def _open_crcs(self, chunkid, fd):
+        try:
+            return self._env.open(self._crc_fname(chunkid), "r+")
+        except IOError:
+            pass
+        # Chunks written before checksums were kept get them on first use.
+        crcfd = self._env.open(self._crc_fname(chunkid), "w+")
+        try:
+            self._update_crcs(fd, crcfd, 0, 0, self._env.readrange(
+                fd,
+                start_offset=0,
+                end_offset=self._env.size(fd)
+            ))
+        except:
+            self._env.close(crcfd)
+            raise
+        return crcfd
+
+    def _read_crcs(self, crcfd, first, last):
+        return checksum.unpack(self._env.readrange(
+            crcfd,
+            start_offset=checksum.entry_offset(first),
+            end_offset=checksum.entry_offset(last)
+        ))
+
+    def _update_crcs(self, fd, crcfd, old_size, offset, data):
+        # Recomputes the checksums of the blocks data was just written to.
+        # Blocks data covers are summed straight from it, a partial last
+        # block it appends to extends the stored sum, and anything else is
+        # read back.
+        end = offset + len(data)
+        if end == offset:
+            return
+        new_size = max(old_size, end)
+        first = offset // CHECKSUM_BLOCK_SIZE
+        last = (end - 1) // CHECKSUM_BLOCK_SIZE
+        crcs = []
+        for block in range(first, last + 1):
+            bstart = block * CHECKSUM_BLOCK_SIZE
+            bend = min(bstart + CHECKSUM_BLOCK_SIZE, new_size)
+            prev = None
+            if block == first and offset == old_size and bstart < offset:
+                prev = self._read_crcs(crcfd, block, block + 1)
+            if offset <= bstart and end >= bend:
+                crc = checksum.crc32(data, bstart - offset, bend - offset)
+            elif prev and end >= bend:
+                crc = checksum.crc32(data, 0, bend - offset, prev[0])
+            else:
+                crc = checksum.crc32(self._env.readrange(
+                    fd,
+                    start_offset=bstart,
+                    end_offset=bend
+                ))
+            crcs.append(crc)
+        self._env.writeat(
+            crcfd,
+            checksum.entry_offset(first),
+            checksum.pack(crcs)
+        )
 
-    def write_chunk(self, chunkid, data):
-        # TODO: Check file exists.
-        fd = self._env.open(self._chunk_fname(chunkid), "w+")
-        self._env.write(fd, data)
-        self._env.close(fd)
+    def _write_at(self, chunkid, fd, size, offset, data):
+        crcfd = self._open_crcs(chunkid, fd)
+        try:
+            self._env.writeat(fd, offset, data)
+            self._update_crcs(fd, crcfd, size, offset, data)
+        finally:
+            self._env.close(crcfd)
+        self._touch(chunkid)
+        return max(size, offset + len(data))
+
+    def _frame_index(self, chunkid, fd):
+        # Compressed chunks are indexed on first use by walking their
+        # frame headers. A frame torn by a crash ends the chunk.
+        with self._lock:
+            index = self._frames.get(chunkid)
+        if index is not None:
+            return index
+        index = _FrameIndex()
+        size = self._env.size(fd)
+        header_size = compression.HEADER.size
+        while index.stored + header_size <= size:
+            header = self._env.readrange(
+                fd,
+                start_offset=index.stored,
+                end_offset=index.stored + header_size
+            )
+            _, raw_len, stored_len = compression.HEADER.unpack_from(header)
+            if index.stored + header_size + stored_len > size:
+                break
+            index.add(raw_len, stored_len)
+        with self._lock:
+            self._frames[chunkid] = index
+        return index
+
+    def _append_frames(self, chunkid, fd, offset, data):
+        # Appends the frames in data at raw offset, which must be the end
+        # of the chunk. Returns the chunk's new raw size.
+        index = self._frame_index(chunkid, fd)
+        if offset != index.size():
+            raise ValueError("Compressed chunk {} ends at {}, not {}".format(
+                chunkid, index.size(), offset))
+        sizes = list(compression.frames(data))
+        self._check_size(chunkid, offset + sum(raw for raw, _ in sizes))
+        size = self._env.size(fd)
+        if size > index.stored:
+            # Drop a torn frame. An old size of 0 makes the checksum of the
+            # block it ended in be recomputed from disk.
+            self._env.truncate(fd, index.stored)
+            size = 0
+        self._write_at(chunkid, fd, size, index.stored, data)
+        for raw_len, stored_len in sizes:
+            index.add(raw_len, stored_len)
+        return index.size()
+
+    def write_chunk(self, chunkid, data, framed=False):
+        if not framed:
+            self._check_size(chunkid, len(data))
+        fd = self._env.open(self._chunk_fname(chunkid), "r+")
+        try:
+            self._env.truncate(fd, 0)
+            crcfd = self._env.open(self._crc_fname(chunkid), "w+")
+            self._env.close(crcfd)
+            with self._lock:
+                self._frames.pop(chunkid, None)
+            if framed:
+                self._append_frames(chunkid, fd, 0, data)
+            else:
+                self._write_at(chunkid, fd, 0, 0, data)
+        finally:
+            self._env.close(fd)
+
+    def write_chunk_at(self, chunkid, offset, data, framed=False):
+        fd = self._env.open(self._chunk_fname(chunkid), "r+")
+        try:
+            if framed:
+                return self._append_frames(chunkid, fd, offset, data)
+            size = self._env.size(fd)
+            if offset > size:
+                raise ValueError("Write at {} past end of chunk {}".format(
+                    offset, chunkid))
+            self._check_size(chunkid, offset + len(data))
+            return self._write_at(chunkid, fd, size, offset, data)
+        finally:
+            self._env.close(fd)
+
+    def append_chunk(self, chunkid, data, framed=False):
+        fd = self._env.open(self._chunk_fname(chunkid), "r+")
+        try:
+            if framed:
+                index = self._frame_index(chunkid, fd)
+                return self._append_frames(chunkid, fd, index.size(), data)
+            size = self._env.size(fd)
+            self._check_size(chunkid, size + len(data))
+            return self._write_at(chunkid, fd, size, size, data)
+        finally:
+            self._env.close(fd)
+
+    def chunk_size(self, chunkid, framed=False):
+        fd = self._env.open(self._chunk_fname(chunkid), "r")
+        try:
+            if framed:
+                return self._frame_index(chunkid, fd).size()
+            return self._env.size(fd)
+        finally:
+            self._env.close(fd)
+
+    def _read_verified(self, chunkid, fd, start, end):
+        # Reads [start, end) after checking every block it touches.
+        size = self._env.size(fd)
+        end = min(end, size)
+        if start >= end:
+            return b""
+        first = start // CHECKSUM_BLOCK_SIZE
+        last = (end - 1) // CHECKSUM_BLOCK_SIZE
+        bstart = first * CHECKSUM_BLOCK_SIZE
+        bend = min((last + 1) * CHECKSUM_BLOCK_SIZE, size)
+        data = self._env.readrange(fd, start_offset=bstart, end_offset=bend)
+
+        crcfd = self._open_crcs(chunkid, fd)
+        try:
+            crcs = self._read_crcs(crcfd, first, last + 1)
+        finally:
+            self._env.close(crcfd)
+        for idx in range(last + 1 - first):
+            lo = idx * CHECKSUM_BLOCK_SIZE
+            hi = min(lo + CHECKSUM_BLOCK_SIZE, len(data))
+            if idx >= len(crcs) or checksum.crc32(data, lo, hi) != crcs[idx]:
+                self._mark_bad(chunkid)
+                raise IOError("Checksum mismatch in block {} of chunk {}".format(
+                    first + idx, chunkid))
+
+        if bstart == start and bend == end:
+            return data
+        return data[start-bstart:end-bstart]
 
     def read_chunk(self, chunkid,
                    start_offset=-1,
                    end_offset=-1):
         fd = self._env.open(self._chunk_fname(chunkid), "r")
-
-        if start_offset is -1 and end_offset is -1:
-            return self._env.readall(fd)
-
-        assert(start_offset is not -1)
-        assert(end_offset is not -1)
-        data = self._env.readrange(
-            fd,
-            start_offset=start_offset,
-            end_offset=end_offset
-        )
-        return data
+        try:
+            if start_offset == -1 and end_offset == -1:
+                start_offset, end_offset = 0, self._env.size(fd)
+
+            assert(start_offset != -1)
+            assert(end_offset != -1)
+            self._touch(chunkid)
+            return self._read_verified(chunkid, fd, start_offset, end_offset)
+        finally:
+            self._env.close(fd)
+
+    def read_frames(self, chunkid,
+                    start_offset=-1,
+                    end_offset=-1):
+        # Returns (raw offset, frames) for the frames of a compressed chunk
+        # holding raw bytes [start_offset, end_offset).
+        fd = self._env.open(self._chunk_fname(chunkid), "r")
+        try:
+            index = self._frame_index(chunkid, fd)
+            if start_offset == -1 and end_offset == -1:
+                start_offset, end_offset = 0, index.size()
+            end_offset = min(end_offset, index.size())
+            if start_offset >= end_offset:
+                return start_offset, b""
+            self._touch(chunkid)
+            raw, start, end = index.span(start_offset, end_offset)
+            return raw, self._read_verified(chunkid, fd, start, end)
+        finally:
+            self._env.close(fd)
+
+    def verify_chunk(self, chunkid):
+        # Checks the whole chunk without counting as an access. Returns its
+        # size.
+        fd = self._env.open(self._chunk_fname(chunkid), "r")
+        try:
+            size = self._env.size(fd)
+            self._read_verified(chunkid, fd, 0, size)
+            return size
+        finally:
+            self._env.close(fd)
+
+    def stats(self):
+        return {
+            "chunks": len(self.chunk_ids()),
+            "free": self._env.free_space()
+        }
 
 class RemoteChunkServer:
 
+    # Calls are serialized so the master's loop and collector can share the
+    # connection.
+
     def __init__(self, conn):
         self._conn = conn
+        self._lock = threading.Lock()
 
     def _check_error(self, resp):
         if "error" in resp:
             raise ValueError(resp["error"])
 
-    def create_chunk(self, chunkid):
-        resp = rpc.call_sync(
-            self._conn,
-            "create_chunk",
-            chunkid=chunkid
-        )
+    def _call(self, method, payload=b"", **args):
+        with self._lock:
+            resp, data = rpc.call_framed(
+                self._conn,
+                method,
+                payload=payload,
+                **args
+            )
         self._check_error(resp)
+        return resp, data
+
+    # Requests sent with send are answered in order by recv, so several can
+    # be outstanding. Only for a connection no one else is using.
+
+    def send(self, method, payload=b"", **args):
+        args["method"] = method
+        rpc.sendframe(self._conn, args, payload)
+
+    def recv(self):
+        frame = rpc.recvframe(self._conn)
+        if frame is None:
+            raise IOError("Connection closed awaiting a reply")
+        return frame
+
+    def create_chunk(self, chunkid):
+        self._call("create_chunk", chunkid=chunkid)
+
+    def create_chunks(self, chunkids):
+        self._call("create_chunks", chunkids=list(chunkids))
 
     def delete_chunk(self, chunkid):
-        resp = rpc.call_sync(
-            self._conn,
-            "delete_chunk",
-            chunkid=chunkid
-        )
-        self._check_error(resp)
+        self._call("delete_chunk", chunkid=chunkid)
+
+    def delete_chunks(self, chunkids):
+        self._call("delete_chunks", chunkids=list(chunkids))
+
+    # Data for compressed files is given raw along with the file's codec,
+    # and goes over the wire and into storage as frames.
 
-    def write_chunk(self, chunkid, data):
-        resp =  rpc.call_sync(
-            self._conn,
+    def _encode(self, codec, data):
+        if codec is None:
+            return data, {}
+        return compression.encode(codec, data), {"framed": True}
+
+    def write_chunk(self, chunkid, data, chain=(), codec=None):
+        data, framed = self._encode(codec, data)
+        self._call(
             "write_chunk",
+            payload=data,
             chunkid=chunkid,
-            data=data,
+            chain=list(chain),
+            **framed
         )
-        self._check_error(resp)
+
+    def write_chunk_at(self, chunkid, offset, data, chain=(), codec=None):
+        data, framed = self._encode(codec, data)
+        resp, _ = self._call(
+            "write_chunk_at",
+            payload=data,
+            chunkid=chunkid,
+            offset=offset,
+            chain=list(chain),
+            **framed
+        )
+        return resp["size"]
+
+    def write_chunk_pipelined(self, chunkid, offset, data,
+                              chain=(),
+                              piece_size=DEFAULT_PIPELINE_PIECE_SIZE,
+                              window=DEFAULT_PIPELINE_WINDOW,
+                              codec=None):
+        with self._lock:
+            return self._write_chunk_pipelined(
+                chunkid,
+                offset,
+                data,
+                chain,
+                piece_size,
+                window,
+                codec
+            )
+
+    def _write_chunk_pipelined(self, chunkid, offset, data,
+                               chain, piece_size, window, codec):
+        # Sends data as back-to-back write_chunk_at pieces without waiting
+        # for each reply, so every replica in the chain forwards one piece
+        # while it is still receiving the next.
+        view = memoryview(data)
+        size = offset
+        errors = []
+        nsent = 0
+        nacked = 0
+
+        def ack():
+            frame = rpc.recvframe(self._conn)
+            if frame is None:
+                raise IOError("Connection closed during write_chunk_at")
+            resp, _ = frame
+            if "error" in resp:
+                errors.append(resp["error"])
+                return size
+            return max(size, resp["size"])
+
+        for start in range(0, len(view), piece_size):
+            piece, framed = self._encode(codec, view[start:start+piece_size])
+            rpc.sendframe(self._conn, dict({
+                "method": "write_chunk_at",
+                "chunkid": chunkid,
+                "offset": offset + start,
+                "chain": list(chain)
+            }, **framed), piece)
+            nsent += 1
+            if nsent - nacked >= window:
+                size = ack()
+                nacked += 1
+        while nacked < nsent:
+            size = ack()
+            nacked += 1
+
+        if errors:
+            raise ValueError(errors[0])
+        return size
+
+    def append_chunk(self, chunkid, data, chain=(), codec=None):
+        data, framed = self._encode(codec, data)
+        resp, _ = self._call(
+            "append_chunk",
+            payload=data,
+            chunkid=chunkid,
+            chain=list(chain),
+            **framed
+        )
+        return resp["size"]
+
+    def chunk_size(self, chunkid, framed=False):
+        resp, _ = self._call("chunk_size", chunkid=chunkid, framed=framed)
+        return resp["size"]
 
     def read_chunk(self, chunkid,
                    start_offset=-1,
-                   end_offset=-1):
-        resp = rpc.call_sync(
-            self._conn,
+                   end_offset=-1,
+                   codec=None):
+        if codec is None:
+            _, chunk = self._call(
+                "read_chunk",
+                chunkid=chunkid,
+                start_offset=start_offset,
+                end_offset=end_offset
+            )
+            return chunk
+        # Only the frames the range touches come back and are decoded.
+        resp, frames = self._call(
             "read_chunk",
             chunkid=chunkid,
             start_offset=start_offset,
-            end_offset=end_offset
+            end_offset=end_offset,
+            framed=True
         )
-        self._check_error(resp)
-        return resp["chunk"]
+        data = compression.decode(codec, frames)
+        if start_offset == -1 and end_offset == -1:
+            return data
+        skip = start_offset - resp["start"]
+        return data[skip:skip + end_offset - start_offset]
 
     def close(self):
         self._conn.close()
 
+    def fileno(self):
+        return self._conn.fileno()
+
     def addr(self):
-        resp = rpc.call_sync(self._conn, "get_client_port")
+        resp, _ = self._call("get_client_port")
         port = int(resp["port"])
         host = self._conn.getpeername()[0]
         return (host, port)
 
     def ping(self):
-        resp = rpc.call_sync(self._conn, "ping")
+        resp, _ = self._call("ping")
         assert(resp["status"] == "ok")
 
+    def start_heartbeats(self, port, interval):
+        self._call("start_heartbeats", port=port, interval=interval)
+
+    def stats(self):
+        resp, _ = self._call("stats")
+        return resp
+
 def connect(addr):
-    conn = socket.socket()
-    conn.connect(addr)
+    conn = rpc.connect(addr)
     return RemoteChunkServer(conn)
 
+class Heartbeater:
+
+    # Reports the chunkserver's load to the master every interval seconds
+    # over a connection of its own, reconnecting after failures.
+
+    def __init__(self, chunkserver, client_port, io_pool):
+        self._chunkserver = chunkserver
+        self._client_port = client_port
+        self._io_pool = io_pool
+        self._addr = None
+        self._interval = None
+        self._conn = None
+        self._thread = None
+
+    def start(self, addr, interval):
+        self._addr = addr
+        self._interval = interval
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run)
+            self._thread.daemon = True
+            self._thread.start()
+
+    def beat(self):
+        stats = self._chunkserver.stats()
+        stats["inflight"] = self._io_pool.inflight()
+        bad = self._chunkserver.take_bad_chunks()
+        try:
+            if self._conn is None:
+                self._conn = rpc.connect(self._addr)
+            resp, _ = rpc.call_framed(
+                self._conn,
+                "heartbeat",
+                port=self._client_port,
+                stats=stats,
+                bad_chunks=bad
+            )
+            if "error" in resp:
+                raise ValueError(resp["error"])
+        except:
+            # Report them with the next heartbeat instead.
+            for chunkid in bad:
+                self._chunkserver._mark_bad(chunkid)
+            raise
+
+    def _run(self):
+        while True:
+            try:
+                self.beat()
+            except (IOError, socket.error, ValueError) as err:
+                log.warning("Heartbeat failed: %s", err)
+                if self._conn is not None:
+                    self._conn.close()
+                    self._conn = None
+            time.sleep(self._interval)
+
+class Scrubber:
+
+    # Verifies chunks no one has read or written for cold_after seconds,
+    # reading at most rate bytes a second, and rests interval seconds after
+    # each pass. Reads already check the blocks they touch, so only cold
+    # data needs scrubbing. Corrupt chunks go out with the next heartbeat.
+
+    def __init__(self, chunkserver, io_pool,
+                 rate=DEFAULT_SCRUB_RATE,
+                 cold_after=DEFAULT_SCRUB_COLD_AFTER,
+                 interval=DEFAULT_SCRUB_INTERVAL):
+        self._chunkserver = chunkserver
+        self._io_pool = io_pool
+        self._rate = rate
+        self._cold_after = cold_after
+        self._interval = interval
+
+    def scrub(self):
+        # Makes one pass. Returns the number of bytes verified.
+        total = 0
+        for chunkid in self._chunkserver.chunk_ids():
+            if not self._chunkserver.is_cold(chunkid, self._cold_after):
+                continue
+            # Keyed by chunk so it doesn't race with writes to it.
+            fut = self._io_pool.submit_keyed(
+                chunkid,
+                self._chunkserver.verify_chunk,
+                chunkid
+            )
+            try:
+                n = fut.result()
+            except IOError as err:
+                log.warning("Scrubbing chunk %s failed: %s", chunkid, err)
+                continue
+            total += n
+            time.sleep(float(n) / self._rate)
+        return total
+
+    def _run(self):
+        while True:
+            self.scrub()
+            time.sleep(self._interval)
+
+    def start(self):
+        t = threading.Thread(target=self._run)
+        t.daemon = True
+        t.start()
+
+def _check_reply(resp):
+    if "error" in resp:
+        raise ValueError(resp["error"])
+    return resp
+
+class _Stream:
+
+    def __init__(self, addr, peer):
+        self.addr = addr
+        self.peer = peer
+        self.pending = collections.deque()
+        self.broken = False
+
+class ChainForwarder:
+
+    # Passes chained writes on to the next replica. A chunk's writes go
+    # back to back over a connection of their own, up to window of them
+    # unanswered, while a thread per connection matches replies to them in
+    # order. So each replica sends a piece on without waiting for the rest
+    # of the chain to ack the one before, as write_chunk_pipelined does.
+
+    def __init__(self, peers, window=DEFAULT_PIPELINE_WINDOW):
+        self._peers = peers
+        self._window = window
+        self._senders = KeyedThreads()
+        self._cond = threading.Condition()
+        self._streams = {}
+
+    def forward(self, msg, payload):
+        # Returns a future for the next replica's reply.
+        fut = Future()
+        self._senders.submit_keyed(
+            msg["chunkid"],
+            self._send,
+            fut,
+            msg,
+            payload
+        )
+        return fut
+
+    def _send(self, fut, msg, payload):
+        args = dict(msg)
+        method = args.pop("method")
+        chain = args.pop("chain")
+        addr = tuple(chain[0])
+        key = (msg["chunkid"], addr)
+        # A stream is only dropped once nothing's pending on it, so one
+        # found here stays up for this write.
+        with self._cond:
+            stream = self._streams.get(key)
+            if stream is not None:
+                stream.pending.append(fut)
+        if stream is None:
+            try:
+                stream = _Stream(addr, self._peers.checkout(addr))
+            except (IOError, socket.error):
+                fut.set_exception(sys.exc_info())
+                return
+            stream.pending.append(fut)
+            with self._cond:
+                self._streams[key] = stream
+            t = threading.Thread(target=self._read, args=(key, stream))
+            t.daemon = True
+            t.start()
+        try:
+            stream.peer.send(method, payload=payload, chain=chain[1:], **args)
+        except (IOError, socket.error):
+            self._fail(key, stream, sys.exc_info())
+            return
+        with self._cond:
+            while len(stream.pending) >= self._window and not stream.broken:
+                self._cond.wait()
+
+    def _read(self, key, stream):
+        while True:
+            try:
+                resp, _ = stream.peer.recv()
+            except (IOError, socket.error):
+                self._fail(key, stream, sys.exc_info())
+                return
+            with self._cond:
+                fut = stream.pending.popleft()
+                done = not stream.pending
+                if done:
+                    del self._streams[key]
+                self._cond.notify_all()
+            run_into(fut, _check_reply, resp)
+            if done:
+                self._peers.checkin(stream.addr, stream.peer)
+                return
+
+    def _fail(self, key, stream, exc_info):
+        # Fails everything pending on a stream whose connection broke.
+        with self._cond:
+            if stream.broken:
+                return
+            stream.broken = True
+            if self._streams.get(key) is stream:
+                del self._streams[key]
+            pending, stream.pending = stream.pending, collections.deque()
+            self._cond.notify_all()
+        self._peers.discard(stream.addr, stream.peer)
+        for fut in pending:
+            fut.set_exception(exc_info)
+
+def _stats(server, chunkserver, io_pool):
+    return dict(
+        chunkserver.stats(),
+        io_queue=io_pool.inflight(),
+        rpc=server.metrics.to_hash()
+    )
+
+def _register(server, chunkserver, client_port, io_pool):
+
+    heartbeater = Heartbeater(chunkserver, client_port, io_pool)
+
+    # Forwards wait on the next replica, which may be waiting on us, so
+    # they never hold an I/O worker or wait for a connection.
+    forwarder = ChainForwarder(
+        ConnectionPool(connect=connect, max_per_addr=None)
+    )
+
+    # Chunk I/O runs on io_pool, serialized per chunk, so the network loop
+    # keeps serving other chunks and pings while a slow write is running.
+    def chunk_io(msg, fn):
+        return io_pool.submit_keyed(msg["chunkid"], fn)
+
+    # Writes carrying a chain are applied locally and forwarded to the next
+    # replica at the same time. Forwards overlap with the local write but
+    # stay in order for the chunk.
+    def replicated_io(msg, payload, fn):
+        local = chunk_io(msg, fn)
+        if not msg.get("chain"):
+            return local
+        forwarded = forwarder.forward(msg, payload)
+        return gather([local, forwarded]).then(lambda results: results[0])
+
+    def create_chunk(conn, msg, payload):
+        return chunk_io(msg, lambda: chunkserver.create_chunk(msg["chunkid"]))
+
+    def create_chunks(conn, msg, payload):
+        return gather([
+            io_pool.submit_keyed(chunkid, chunkserver.create_chunk, chunkid)
+            for chunkid in msg["chunkids"]
+        ]).then(lambda results: None)
+
+    def delete_chunk(conn, msg, payload):
+        return chunk_io(msg, lambda: chunkserver.delete_chunk(msg["chunkid"]))
+
+    def delete_chunks(conn, msg, payload):
+        return gather([
+            io_pool.submit_keyed(chunkid, chunkserver.delete_chunks, [chunkid])
+            for chunkid in msg["chunkids"]
+        ]).then(lambda results: None)
+
+    def write_chunk(conn, msg, payload):
+        return replicated_io(msg, payload, lambda: chunkserver.write_chunk(
+            msg["chunkid"],
+            payload,
+            framed=msg.get("framed", False)
+        ))
+
+    def write_chunk_at(conn, msg, payload):
+        return replicated_io(msg, payload, lambda: {
+            "size": chunkserver.write_chunk_at(
+                msg["chunkid"],
+                msg["offset"],
+                payload,
+                framed=msg.get("framed", False)
+            )
+        })
+
+    def append_chunk(conn, msg, payload):
+        return replicated_io(msg, payload, lambda: {
+            "size": chunkserver.append_chunk(
+                msg["chunkid"],
+                payload,
+                framed=msg.get("framed", False)
+            )
+        })
+
+    def chunk_size(conn, msg, payload):
+        return chunk_io(msg, lambda: {
+            "size": chunkserver.chunk_size(
+                msg["chunkid"],
+                framed=msg.get("framed", False)
+            )
+        })
+
+    def read_frames(msg):
+        start, frames = chunkserver.read_frames(
+            msg["chunkid"],
+            msg.get("start_offset", -1),
+            msg.get("end_offset", -1)
+        )
+        return {"start": start}, frames
+
+    def read_chunk(conn, msg, payload):
+        if msg.get("framed"):
+            return chunk_io(msg, lambda: read_frames(msg))
+        return chunk_io(msg, lambda: ({}, chunkserver.read_chunk(
+            msg["chunkid"],
+            msg.get("start_offset", -1),
+            msg.get("end_offset", -1)
+        )))
+
+    def get_client_port(conn, msg, payload):
+        return {"port": client_port}
+
+    def ping(conn, msg, payload):
+        return {"status": "ok"}
+
+    # The master asks for heartbeats on its RPC port once it has registered
+    # us; it's reached at the host our connection to it came from.
+    def start_heartbeats(conn, msg, payload):
+        heartbeater.start((conn.peer[0], msg["port"]), msg["interval"])
+
+    def stats(conn, msg, payload):
+        return _stats(server, chunkserver, io_pool)
+
+    for handler in (create_chunk, create_chunks, delete_chunk, delete_chunks,
+                    write_chunk, write_chunk_at, append_chunk, chunk_size,
+                    read_chunk, get_client_port, ping, start_heartbeats, stats):
+        server.register(handler.__name__, handler)
+
 def main():
     import sys
     import env
@@ -115,85 +909,66 @@ def main():
     args = sys.argv[1:]
     client_port = DEFAULT_CHUNK_SERVER_CLIENT_PORT
     master_addr = DEFAULT_CHUNK_SERVER_MASTER_ADDR
+    env_type = DEFAULT_CHUNK_SERVER_ENV
+    data_dir = DEFAULT_CHUNK_SERVER_DATA_DIR
+    fsync = DEFAULT_CHUNK_SERVER_FSYNC
+    io_threads = DEFAULT_CHUNK_SERVER_IO_THREADS
+    scrub_rate = DEFAULT_SCRUB_RATE
+    log_level = DEFAULT_LOG_LEVEL
+    stats_interval = DEFAULT_STATS_INTERVAL
     for idx, arg in enumerate(args):
         if arg == "--client-port" and idx+1 < len(args):
             client_port = int(args[idx+1])
         if arg == "--master-addr" and idx+1 < len(args):
             l = args[idx+1].split(":")
             master_addr = (l[0], int(l[1]))
+        if arg == "--env" and idx+1 < len(args):
+            env_type = args[idx+1]
+        if arg == "--data-dir" and idx+1 < len(args):
+            data_dir = args[idx+1]
+        if arg == "--fsync" and idx+1 < len(args):
+            fsync = args[idx+1]
+        if arg == "--io-threads" and idx+1 < len(args):
+            io_threads = int(args[idx+1])
+        if arg == "--scrub-rate" and idx+1 < len(args):
+            scrub_rate = int(args[idx+1])
+        if arg == "--log-level" and idx+1 < len(args):
+            log_level = args[idx+1].upper()
+        if arg == "--stats-interval" and idx+1 < len(args):
+            stats_interval = float(args[idx+1])
+
+    logging.basicConfig(level=log_level, format=DEFAULT_LOG_FORMAT)
+
+    if env_type == "mem":
+        chunk_env = env.MemEnv()
+    elif env_type == "posix":
+        chunk_env = env.PosixEnv(data_dir=data_dir, fsync=fsync)
+    else:
+        log.error("Unrecognized env %s", env_type)
+        sys.exit(1)
 
-    print("Starting chunk server.")
+    log.info("Starting chunk server.")
 
-    master_conn = socket.socket()
     try:
-        master_conn.connect(master_addr)
+        master_conn = rpc.connect(master_addr)
     except socket.error as err:
-        print("Unable to connect to master.")
+        log.error("Unable to connect to master: %s", err)
         sys.exit(1)
-    print("Connected to master at address {}".format(master_addr))
-
-    client_listener = socket.socket()
-    client_listener.bind(("", client_port))
-    client_listener.listen(1)
-    print("Listening for clients on port {}".format(client_port))
-
-    readers = [client_listener, master_conn]
-    chunkserver = ChunkServer(env=env.MemEnv())
-    while True:
-        rlist, _, _ = select.select(readers, [], [])
-        for s in rlist:
-
-            if s is client_listener:
-                conn, addr = s.accept()
-                print("Accepted client conn with {}".format(addr))
-                readers.append(conn)
-                continue
-
-            msg = rpc.recvmsg(s)
-            if not msg:
-                print("Client {} closed conn.".format(s.getpeername()))
-                s.close()
-                readers.remove(s)
-                continue
-
-            method = msg["method"]
-            print("RPC Call to method {}".format(method))
-
-            resp = {}
-            if method == "create_chunk":
-                try:
-                    chunkserver.create_chunk(msg["chunkid"])
-                except Exception as err:
-                    resp["error"] = str(err)
-                    print(err)
-            elif method == "delete_chunk":
-                try:
-                    chunkserver.delete_chunk(msg["chunkid"])
-                except Exception as err:
-                    resp["error"] = str(err)
-                    print(err)
-            elif method == "write_chunk":
-                try:
-                    chunkserver.write_chunk(
-                        msg["chunkid"],
-                        msg["data"]
-                    )
-                except Exception as err:
-                    resp["error"] = str(err)
-                    print(err)
-            elif method == "read_chunk":
-                try:
-                    resp["chunk"] = chunkserver.read_chunk(msg["chunkid"])
-                except Exception as err:
-                    resp["error"] = str(err)
-                    print(err)
-            elif method == "get_client_port":
-                resp["port"] = client_port
-            elif method == "ping":
-                resp["status"] = "ok"
-            else:
-                resp["error"] = "Unrecognized method: {}".format(method)
-            rpc.sendmsg(s, resp)
+    log.info("Connected to master at address %s", master_addr)
+
+    server = Server()
+    server.listen(client_port)
+    log.info("Listening for clients on port %s", client_port)
+
+    chunkserver = ChunkServer(env=chunk_env)
+    io_pool = WorkerPool(io_threads)
+    server.add_connection(master_conn)
+    _register(server, chunkserver, client_port, io_pool)
+    if scrub_rate > 0:
+        Scrubber(chunkserver, io_pool, rate=scrub_rate).start()
+    if stats_interval > 0:
+        start_dump(lambda: _stats(server, chunkserver, io_pool), stats_interval)
+    server.serve_forever()
 
 if __name__ == "__main__":
     main()
@@ -1,104 +1,488 @@
 
+import collections
+import socket
+import threading
+
+import compression as codecs
 import master
 import chunkserver
-from constants import CHUNK_SIZE
+from constants import *
+from cache import BlockCache
+from pool import ConnectionPool
+from workers import WorkerPool
+
+def _local_hosts():
+    hosts = set(["", "localhost", "127.0.0.1"])
+    try:
+        hosts.add(socket.gethostbyname(socket.gethostname()))
+    except socket.error:
+        pass
+    return hosts
+
+class ChunkLocations:
 
-class _ChunkCache:
+    # Chunk locations of one file, fetched from the master a page at a time
+    # as reads reach them and cached until a lookup through them fails.
+    # Chunks the client allocates itself are added as they come, and known
+    # ones, like a packed file's, can be given up front.
 
-    def __init__(self):
-        self._cnum = -1
-        self._chunk = None
+    def __init__(self, master, fname, nchunks, page_size, known=None):
+        self._master = master
+        self._fname = fname
+        self._nchunks = nchunks
+        self._page_size = page_size
+        self._chunks = dict(known or {})
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return self._nchunks
 
-    def contains(self, cnum):
-        return self._cnum is cnum
+    def _page(self, cnum):
+        start = cnum - cnum % self._page_size
+        return start, min(start + self._page_size, self._nchunks)
 
     def get(self, cnum):
-        assert(cnum is self._cnum)
-        return self._chunk
+        with self._lock:
+            cinfo = self._chunks.get(cnum)
+            if cinfo is not None:
+                return cinfo
+            start, end = self._page(cnum)
+            infos = self._master.get_chunk_info(self._fname, start, end)
+            for idx, info in enumerate(infos):
+                self._chunks.setdefault(start + idx, info)
+            if cnum not in self._chunks:
+                raise IOError("No chunk {} in {}".format(cnum, self._fname))
+            return self._chunks[cnum]
+
+    def last(self):
+        return self.get(self._nchunks - 1)
 
-    def add(self, cnum, chunk):
-        self._cnum = cnum
-        self._chunk = chunk
+    def append(self, cinfo):
+        with self._lock:
+            self._chunks[self._nchunks] = cinfo
+            self._nchunks += 1
+
+    def reset(self, cinfos):
+        with self._lock:
+            self._chunks = dict(enumerate(cinfos))
+            self._nchunks = len(cinfos)
+
+    def invalidate(self, cnum):
+        with self._lock:
+            start, end = self._page(cnum)
+            for idx in range(start, end):
+                self._chunks.pop(idx, None)
 
 class File:
 
-    def __init__(self, name, master, finfo):
+    def __init__(self, name, client, meta):
         self.name = name
-        self._master = master
-        self._info = finfo
-        self._cache = _ChunkCache()
+        self._master = client._master
+        self._chunks = ChunkLocations(
+            client._master,
+            name,
+            meta.nchunks,
+            client._chunk_info_page,
+            known={0: meta.packed} if meta.packed else None
+        )
+        self._codec = codecs.get(meta.compression)
+        self._packed = meta.packed is not None
+        self._small_file_size = client._small_file_size
+        self._pool = client._pool
+        self._local_hosts = client._local_hosts
+        self._block_size = client._block_size
+        self._cache = client._cache
         self._roffset = 0
+        self._last_size = None
 
-    def _get_chunk(self, cnum):
-        if self._cache.contains(cnum):
-            return self._cache.get(cnum)
-        cinfo = self._info.chunk_info[cnum]
-        server = chunkserver.connect(cinfo.addr)
-        chunk = server.read_chunk(cinfo.id)
-        self._cache.add(cnum, chunk)
-        return chunk
+        self._read_pool = client._read_pool
+        self._write_pool = client._write_pool
+        self._write_window = client._write_window
+        self._wbuf_size = client._write_buffer_size
+        self._wbuf = bytearray()
 
-    def read(self, n):
-        cnum = self._roffset / CHUNK_SIZE
-        if cnum >= len(self._info.chunk_info):
-            return b''
-        chunk = self._get_chunk(cnum)
-        coff = self._roffset % CHUNK_SIZE
-        rem = min(n, len(chunk) - coff)
-        if rem is 0:
-            return b''
-        data = chunk[coff:coff+rem]
-        n -= rem
-        self._roffset += rem
-
-        while n > 0:
-            cnum = self._roffset / CHUNK_SIZE
-            if cnum >= len(self._info.chunk_info):
+        self._readahead_pool = client._readahead_pool
+        self._readahead_max = client._readahead_max
+        self._readahead_window = 0
+        self._readahead_next = 0
+        self._prefetching = {}
+        self._lock = threading.Lock()
+
+    def _block_range(self, cnum, bnum):
+        cinfo = self._chunks.get(cnum)
+        start = bnum * self._block_size
+        end = start + self._block_size
+        if cinfo.packed():
+            # A packed file is a slice of its container chunk.
+            start = cinfo.offset + min(start, cinfo.length)
+            end = cinfo.offset + min(end, cinfo.length)
+        return cinfo, start, end
+
+    def _replica_order(self, cinfo):
+        # Prefer replicas on this host, then those we're least busy with.
+        return sorted(cinfo.replicas, key=lambda addr: (
+            addr[0] not in self._local_hosts,
+            self._pool.load(addr)
+        ))
+
+    def _fetch_block(self, cinfo, start, end):
+        err = None
+        for addr in self._replica_order(cinfo):
+            try:
+                with self._pool.connection(addr) as server:
+                    block = server.read_chunk(
+                        cinfo.id,
+                        start_offset=start,
+                        end_offset=end,
+                        codec=None if cinfo.packed() else self._codec
+                    )
                 break
-            chunk = self._get_chunk(cnum)
-            rem = min(n, len(chunk))
-            if rem is 0:
+            except (IOError, ValueError) as e:
+                err = e
+        else:
+            raise err
+        self._cache.add((cinfo.id, start, end), block)
+        return block
+
+    def _get_block(self, cnum, bnum):
+        cinfo, start, end = self._block_range(cnum, bnum)
+        if start >= end:
+            return b""
+        key = (cinfo.id, start, end)
+        block = self._cache.get(key)
+        if block is not None:
+            return block
+        with self._lock:
+            fut = self._prefetching.get(key)
+        if fut is not None:
+            try:
+                return fut.result()
+            except Exception:
+                # Retry below so the caller sees the failure directly.
+                pass
+        try:
+            return self._fetch_block(cinfo, start, end)
+        except (IOError, ValueError) as err:
+            # The chunk may have moved since we looked it up, or a packed
+            # file to another container. Retry once if the master knows of
+            # somewhere else.
+            self._chunks.invalidate(cnum)
+            fresh, fstart, fend = self._block_range(cnum, bnum)
+            if (fresh.id, fresh.replicas, fstart) == \
+                    (cinfo.id, cinfo.replicas, start):
+                raise err
+            return self._fetch_block(fresh, fstart, fend)
+
+    def _prefetch(self, cnum, bnum):
+        cinfo, start, end = self._block_range(cnum, bnum)
+        if start >= end:
+            return
+        key = (cinfo.id, start, end)
+        if cnum == len(self._chunks) - 1:
+            if self._last_size is not None and start >= self._last_size:
+                return
+        with self._lock:
+            if key in self._prefetching:
+                return
+            if self._cache.contains(key):
+                return
+            fut = self._readahead_pool.submit(
+                self._fetch_block,
+                cinfo,
+                start,
+                end
+            )
+            self._prefetching[key] = fut
+
+        def done(_):
+            with self._lock:
+                self._prefetching.pop(key, None)
+        fut.add_done_callback(done)
+
+    def _update_readahead(self):
+        # Sequential reads double the readahead window up to the
+        # configured maximum. Any other access pattern closes it.
+        if self._readahead_max <= 0:
+            return
+        if self._roffset == self._readahead_next:
+            self._readahead_window = min(
+                max(1, 2 * self._readahead_window),
+                self._readahead_max
+            )
+        else:
+            self._readahead_window = 0
+
+    def _issue_readahead(self):
+        nblocks = CHUNK_SIZE // self._block_size
+        first = self._roffset // self._block_size + 1
+        for idx in range(first, first + self._readahead_window):
+            cnum, bnum = divmod(idx, nblocks)
+            if cnum >= len(self._chunks):
                 break
-            data += chunk[:rem]
-            n -= rem
-            self._roffset += rem
+            self._prefetch(cnum, bnum)
 
-        return data
+    def seek(self, offset):
+        self._roffset = offset
 
-    def write(self, data):
+    def tell(self):
+        return self._roffset
+
+    def _span(self, n):
+        # Yields (cnum, bnum, offset in block, length) for each block that
+        # [roffset, roffset+n) touches in chunks the file has.
+        off = self._roffset
+        end = off + n
+        while off < end:
+            cnum, coff = divmod(off, CHUNK_SIZE)
+            if cnum >= len(self._chunks):
+                return
+            bnum, boff = divmod(coff, self._block_size)
+            length = min(end - off, self._block_size - boff)
+            yield cnum, bnum, boff, length
+            off += length
+
+    def read(self, n):
+        self.flush()
+        self._update_readahead()
+        span = list(self._span(n))
+        if len(span) > 1:
+            # Don't fan out, or allocate, past the end of the file.
+            n = min(n, max(0, self._size() - self._roffset))
+            span = list(self._span(n))
+        if len(span) > 1:
+            # Fetch every block at once, bounded by the read pool.
+            blocks = [
+                self._read_pool.submit(self._get_block, cnum, bnum)
+                for cnum, bnum, _, _ in span
+            ]
+        else:
+            blocks = None
 
-        if len(self._info.chunk_info) > 0:
-            last = self._get_chunk(len(self._info.chunk_info) - 1)
-            if len(last) < CHUNK_SIZE:
-                cinfo = self._info.chunk_info[-1]
-                rem = min(CHUNK_SIZE - len(last), len(data))
-                server = chunkserver.connect(cinfo.addr)
-                server.write_chunk(
-                    chunkid=cinfo.id,
-                    data=last+data[:rem]
+        data = bytearray(sum(length for _, _, _, length in span))
+        pos = 0
+        for idx, (cnum, bnum, boff, length) in enumerate(span):
+            if blocks is None:
+                block = self._get_block(cnum, bnum)
+            else:
+                block = blocks[idx].result()
+            rem = min(length, len(block) - boff)
+            if rem <= 0:
+                break
+            data[pos:pos+rem] = memoryview(block)[boff:boff+rem]
+            pos += rem
+            if rem < length:
+                break
+        del data[pos:]
+        self._roffset += pos
+
+        self._readahead_next = self._roffset
+        if self._readahead_window > 0:
+            self._issue_readahead()
+        return bytes(data)
+
+    def _last_chunk_size(self):
+        if self._last_size is None:
+            cinfo = self._chunks.last()
+            with self._pool.connection(cinfo.replicas[0]) as server:
+                self._last_size = server.chunk_size(
+                    cinfo.id,
+                    framed=self._codec is not None
                 )
-                data = data[rem:]
-
-        while len(data) > 0:
-            cinfo = self._master.request_new_chunk(self.name)
-            rem = min(len(data), CHUNK_SIZE)
-            server = chunkserver.connect(cinfo.addr)
-            server.write_chunk(
-                chunkid=cinfo.id,
-                data=data[:rem]
+        return self._last_size
+
+    def _size(self):
+        # The file's length, as of when the last chunk's size was fetched.
+        if len(self._chunks) == 0:
+            return 0
+        last = self._chunks.last()
+        tail = last.length if last.packed() else self._last_chunk_size()
+        return (len(self._chunks) - 1) * CHUNK_SIZE + tail
+
+    def _write_replicas(self, cinfo, offset, data):
+        # Data is pushed to the first replica, which forwards it down the
+        # chain of the others. Offsets rather than appends keep the replicas
+        # identical.
+        with self._pool.connection(cinfo.replicas[0]) as server:
+            return server.write_chunk_pipelined(
+                cinfo.id,
+                offset,
+                data,
+                chain=cinfo.replicas[1:],
+                codec=self._codec
             )
-            self._info.chunk_info.append(cinfo)
-            data = data[rem:]
 
+    def _tail_room(self):
+        if len(self._chunks) == 0:
+            return 0
+        return CHUNK_SIZE - self._last_chunk_size()
+
+    def _fill_tail(self, data):
+        cinfo = self._chunks.last()
+        size = self._last_size
+        self._last_size = self._write_replicas(cinfo, size, data)
+        self._cache.invalidate(cinfo.id, size, self._last_size)
+
+    def _upload(self, pieces, count=None):
+        # Each piece fills a new chunk. Chunks are allocated in order on
+        # this thread, in one call when count is known up front, while up
+        # to write_window uploads run at once, spread across the
+        # chunkservers the master placed them on.
+        allocated = collections.deque()
+        if count:
+            allocated.extend(self._master.request_new_chunks(self.name, count))
+        inflight = collections.deque()
+        err = None
+        for piece in pieces:
+            if allocated:
+                cinfo = allocated.popleft()
+            else:
+                cinfo = self._master.request_new_chunk(self.name)
+            self._chunks.append(cinfo)
+            self._last_size = len(piece)
+            inflight.append(self._write_pool.submit(
+                self._write_replicas,
+                cinfo,
+                0,
+                piece
+            ))
+            while len(inflight) >= self._write_window and not err:
+                err = inflight.popleft().exception()
+            if err:
+                break
+        while inflight:
+            # Wait for them all, keeping the first error.
+            exc = inflight.popleft().exception()
+            err = err or exc
+        if err:
+            # Keep chunks the master allocated but we never wrote so our
+            # view of the file matches its.
+            if allocated:
+                for cinfo in allocated:
+                    self._chunks.append(cinfo)
+                self._last_size = None
+            raise err
+
+    def write(self, data):
+        # Small writes are buffered until write_buffer_size bytes are
+        # waiting, then sent together. Writes at least that big skip the
+        # buffer.
+        if len(data) < self._wbuf_size:
+            self._wbuf += data
+            if len(self._wbuf) >= self._wbuf_size:
+                self.flush()
+            return len(data)
+        self.flush()
+        return self._write_through(data)
+
+    def flush(self):
+        # Sends buffered writes. The buffer is dropped if that fails and the
+        # error is raised here, or from close.
+        if not self._wbuf:
+            return
+        data, self._wbuf = self._wbuf, bytearray()
+        self._write_through(data)
+
+    def _unpack(self):
+        # A packed file is moved to a chunk of its own before it grows.
+        if not self._packed:
+            return
+        self._chunks.reset(self._master.unpack(self.name))
+        self._packed = False
+        self._last_size = None
+
+    def _write_through(self, data):
+        self._unpack()
+        view = memoryview(data)
+
+        rem = min(self._tail_room(), len(view))
+        if rem > 0:
+            self._fill_tail(view[:rem])
+            view = view[rem:]
+
+        starts = range(0, len(view), CHUNK_SIZE)
+        self._upload(
+            (view[start:start+CHUNK_SIZE] for start in starts),
+            count=len(starts)
+        )
         return len(data)
 
+    def write_from(self, fileobj):
+        # Copies fileobj to the end of the file, reading the next chunk
+        # while earlier ones are still uploading.
+        self.flush()
+        self._unpack()
+        n = 0
+        room = self._tail_room()
+        if room > 0:
+            data = fileobj.read(room)
+            if data:
+                self._fill_tail(data)
+                n += len(data)
+            if len(data) < room:
+                return n
+
+        def pieces():
+            while True:
+                data = fileobj.read(CHUNK_SIZE)
+                if not data:
+                    return
+                sizes.append(len(data))
+                yield data
+
+        sizes = []
+        self._upload(pieces())
+        return n + sum(sizes)
+
     def close(self):
-        self._master.close(self.name)
+        if len(self._chunks) == 0 and \
+                0 < len(self._wbuf) <= self._small_file_size:
+            # The whole file was written in one go and is small enough to
+            # pack, which the master does, and closes it, in one call.
+            data, self._wbuf = self._wbuf, bytearray()
+            try:
+                self._master.write_small(self.name, bytes(data), close=True)
+            except:
+                self._master.close(self.name)
+                raise
+            return
+        try:
+            self.flush()
+        finally:
+            self._master.close(self.name)
 
 class Client:
 
-    def __init__(self, master):
+    def __init__(self, master,
+                 max_conns_per_server=DEFAULT_POOL_MAX_CONNS_PER_SERVER,
+                 idle_timeout=DEFAULT_POOL_IDLE_TIMEOUT,
+                 block_size=DEFAULT_BLOCK_SIZE,
+                 cache_size=DEFAULT_CACHE_SIZE,
+                 readahead_max=DEFAULT_READAHEAD_MAX_BLOCKS,
+                 readahead_threads=DEFAULT_READAHEAD_THREADS,
+                 read_threads=DEFAULT_READ_THREADS,
+                 write_window=DEFAULT_WRITE_WINDOW,
+                 write_buffer_size=DEFAULT_WRITE_BUFFER_SIZE,
+                 chunk_info_page=DEFAULT_CHUNK_INFO_PAGE,
+                 small_file_size=DEFAULT_SMALL_FILE_SIZE):
+        assert(CHUNK_SIZE % block_size == 0)
+        assert(small_file_size <= MAX_SMALL_FILE_SIZE)
         self._master = master
+        self._small_file_size = small_file_size
+        self._chunk_info_page = chunk_info_page
+        self._local_hosts = _local_hosts()
+        self._block_size = block_size
+        self._cache = BlockCache(capacity=cache_size)
+        self._readahead_max = readahead_max
+        self._readahead_pool = WorkerPool(readahead_threads)
+        self._read_pool = WorkerPool(read_threads)
+        self._write_window = write_window
+        self._write_buffer_size = write_buffer_size
+        self._write_pool = WorkerPool(write_window)
+        self._pool = ConnectionPool(
+            connect=chunkserver.connect,
+            max_per_addr=max_conns_per_server,
+            idle_timeout=idle_timeout
+        )
 
     def __enter__(self):
         return self
@@ -106,30 +490,71 @@ class Client:
     def __exit__(self, type, value, tb):
         self.close()
 
-    def create(self, fname):
-        finfo = self._master.create(fname)
-        f = File(fname, self._master, finfo)
+    def create(self, fname, compression=None):
+        # compression names a codec in compression.NAMES to store the file
+        # with. It must be available here.
+        codecs.get(compression)
+        meta = self._master.create(fname, compression)
+        f = File(fname, self, meta)
         return f
 
+    def put(self, fname, data, compression=None):
+        # Creates fname holding data. Small files are created, packed and
+        # written with one call to the master.
+        codecs.get(compression)
+        if 0 < len(data) <= self._small_file_size:
+            self._master.write_small(
+                fname,
+                bytes(data),
+                create=True,
+                compression=compression
+            )
+            return
+        f = self.create(fname, compression)
+        try:
+            f.write(data)
+        finally:
+            f.close()
+
     def delete(self, fname):
         self._master.delete(fname)
 
     def open(self, fname):
-        finfo = self._master.open(fname)
-        f = File(fname, self._master, finfo)
+        meta = self._master.open(fname)
+        f = File(fname, self, meta)
         return f
 
     def stat(self, fname):
-        finfo = self._master.stat(fname)
-        return finfo
+        return self._master.stat(fname)
+
+    def list(self, prefix="", limit=DEFAULT_LIST_LIMIT, cursor=None):
+        # One page of the entries under prefix; see Master.list.
+        return self._master.list(prefix, limit, cursor)
+
+    def list_all(self, prefix="", page_size=DEFAULT_LIST_LIMIT):
+        # Yields every entry under prefix, fetching a page at a time.
+        cursor = None
+        while True:
+            entries, cursor = self.list(prefix, page_size, cursor)
+            for entry in entries:
+                yield entry
+            if cursor is None:
+                return
 
     def ping(self):
         self._master.ping()
 
+    def cache_stats(self):
+        return self._cache.stats()
+
     def close(self):
+        self._readahead_pool.shutdown()
+        self._read_pool.shutdown()
+        self._write_pool.shutdown()
+        self._pool.close()
         self._master.closeconn()
 
-def connect(addr):
+def connect(addr, **kwargs):
     m = master.connect(addr)
-    c = Client(m)
+    c = Client(m, **kwargs)
     return c
@@ -0,0 +1,113 @@
+
+import collections
+import logging
+import threading
+import time
+
+from constants import *
+
+log = logging.getLogger("collector")
+
+class ChunkCollector:
+
+    # Deletes the chunks of deleted files in the background. Chunk ids are
+    # queued per chunkserver address and sent as delete_chunks batches of
+    # at most batch_size, no faster than rate chunks a second. A batch that
+    # fails, or is meant for a server lookup(addr) doesn't know, stays
+    # queued and is retried after retry_interval.
+
+    def __init__(self, lookup,
+                 batch_size=DEFAULT_GC_BATCH,
+                 rate=DEFAULT_GC_RATE,
+                 retry_interval=DEFAULT_GC_RETRY_INTERVAL):
+        self._lookup = lookup
+        self._batch_size = batch_size
+        self._rate = rate
+        self._retry_interval = retry_interval
+        self._queues = collections.OrderedDict()
+        # Batches taken off the queues and not yet deleted.
+        self._sending = []
+        self._retry_at = {}
+        self._lock = threading.Lock()
+        self._cond = threading.Condition(self._lock)
+
+    def add(self, addr, chunkids):
+        with self._lock:
+            self._queues.setdefault(addr, collections.deque()).extend(chunkids)
+            self._cond.notify()
+
+    def pending(self):
+        with self._lock:
+            return sum(len(q) for q in self._queues.values())
+
+    def pending_chunks(self):
+        # Returns {addr: [chunkid]} of every chunk not yet deleted.
+        with self._lock:
+            chunks = {}
+            for addr, queue in self._queues.items():
+                chunks.setdefault(addr, []).extend(queue)
+            for addr, batch in self._sending:
+                chunks.setdefault(addr, []).extend(batch)
+            return chunks
+
+    def _next_batch(self, now):
+        # Takes a batch for the first server not waiting out a retry.
+        with self._lock:
+            for addr, queue in self._queues.items():
+                if self._retry_at.get(addr, 0) > now:
+                    continue
+                batch = [queue.popleft()
+                         for _ in range(min(self._batch_size, len(queue)))]
+                if not queue:
+                    del self._queues[addr]
+                else:
+                    # Round robin between servers.
+                    self._queues[addr] = self._queues.pop(addr)
+                self._sending.append((addr, batch))
+                return addr, batch
+        return None, None
+
+    def _requeue(self, addr, batch, now):
+        with self._lock:
+            self._sending.remove((addr, batch))
+            queue = self._queues.setdefault(addr, collections.deque())
+            queue.extendleft(reversed(batch))
+            self._retry_at[addr] = now + self._retry_interval
+
+    def collect(self):
+        # Sends one batch. Returns the number of chunks deleted, or None if
+        # there was nothing to send yet.
+        now = time.time()
+        addr, batch = self._next_batch(now)
+        if addr is None:
+            return None
+        server = self._lookup(addr)
+        try:
+            if server is None:
+                raise IOError("Unknown chunk server {}".format(addr))
+            server.delete_chunks(batch)
+        except Exception as err:
+            log.warning("Deleting chunks on %s failed: %s", addr, err)
+            self._requeue(addr, batch, now)
+            return 0
+        with self._lock:
+            self._sending.remove((addr, batch))
+            self._retry_at.pop(addr, None)
+        return len(batch)
+
+    def _run(self):
+        while True:
+            with self._lock:
+                while not self._queues:
+                    self._cond.wait()
+            n = self.collect()
+            if n is None:
+                # Everything queued is waiting to be retried.
+                time.sleep(min(1.0, self._retry_interval))
+            elif n > 0:
+                time.sleep(float(n) / self._rate)
+
+    def start(self):
+        t = threading.Thread(target=self._run)
+        t.daemon = True
+        t.start()
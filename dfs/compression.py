@@ -0,0 +1,103 @@
+
+import struct
+import zlib
+
+from constants import *
+
+# Compressed chunks are stored and sent as a sequence of frames, each one
+# block of the file compressed on its own so a ranged read only has to
+# decompress the blocks it touches. A frame is a header of (flags, raw
+# length, stored length) followed by the stored bytes. Blocks that don't
+# shrink are stored raw.
+HEADER = struct.Struct("!BII")
+_COMPRESSED = 1
+
+class _Zlib:
+
+    def compress(self, data):
+        return zlib.compress(data, 6)
+
+    def decompress(self, data, raw_len):
+        return zlib.decompress(data)
+
+class _LZ4:
+
+    def __init__(self, block):
+        self._block = block
+
+    def compress(self, data):
+        return self._block.compress(data, store_size=False)
+
+    def decompress(self, data, raw_len):
+        return self._block.decompress(data, uncompressed_size=raw_len)
+
+# Every codec a file may name. Only those whose library is installed can be
+# used, and only clients need them; chunkservers just store frames.
+NAMES = ("zlib", "lz4")
+
+CODECS = {"zlib": _Zlib()}
+try:
+    import lz4.block
+    CODECS["lz4"] = _LZ4(lz4.block)
+except ImportError:
+    pass
+
+def check(name):
+    if name is not None and name not in NAMES:
+        raise ValueError("Unrecognized compression {}".format(name))
+
+def get(name):
+    # Returns the codec called name, or None for no compression.
+    check(name)
+    if name is None:
+        return None
+    codec = CODECS.get(name)
+    if codec is None:
+        raise ValueError("Compression {} is not available".format(name))
+    return codec
+
+def _bytes(data):
+    return data.tobytes() if isinstance(data, memoryview) else bytes(data)
+
+def encode(codec, data, block_size=COMPRESSION_BLOCK_SIZE):
+    # Returns data as frames of block_size raw bytes each.
+    out = []
+    for start in range(0, len(data), block_size):
+        raw = _bytes(data[start:start+block_size])
+        stored = codec.compress(raw)
+        flags = _COMPRESSED
+        if len(stored) >= len(raw):
+            stored, flags = raw, 0
+        out.append(HEADER.pack(flags, len(raw), len(stored)))
+        out.append(stored)
+    return b"".join(out)
+
+def frames(data):
+    # Yields (raw length, stored length) of each frame in data.
+    pos = 0
+    while pos < len(data):
+        if pos + HEADER.size > len(data):
+            raise ValueError("Truncated frame header at {}".format(pos))
+        _, raw_len, stored_len = HEADER.unpack_from(data, pos)
+        pos += HEADER.size + stored_len
+        if pos > len(data):
+            raise ValueError("Truncated frame at {}".format(pos))
+        yield raw_len, stored_len
+
+def decode(codec, data):
+    # Returns the raw bytes of the frames in data.
+    out = []
+    view = memoryview(data)
+    pos = 0
+    while pos < len(view):
+        flags, raw_len, stored_len = HEADER.unpack_from(data, pos)
+        pos += HEADER.size
+        stored = _bytes(view[pos:pos+stored_len])
+        pos += stored_len
+        if flags & _COMPRESSED:
+            stored = codec.decompress(stored, raw_len)
+        if len(stored) != raw_len:
+            raise IOError("Frame decoded to {} bytes, expected {}".format(
+                len(stored), raw_len))
+        out.append(stored)
+    return b"".join(out)
@@ -1,7 +1,63 @@
 
 CHUNK_SIZE = 1 << 26
+CHECKSUM_BLOCK_SIZE = 1 << 16
+CHECKSUM_SUFFIX = ".crc"
+COMPRESSION_BLOCK_SIZE = 1 << 16
+DEFAULT_BLOCK_SIZE = 1 << 20
+DEFAULT_CACHE_SIZE = 1 << 26
+DEFAULT_READAHEAD_MAX_BLOCKS = 8
+DEFAULT_READAHEAD_THREADS = 4
+DEFAULT_READ_THREADS = 8
+DEFAULT_WRITE_WINDOW = 4
+DEFAULT_WRITE_BUFFER_SIZE = 1 << 22
+DEFAULT_CHUNK_INFO_PAGE = 1024
+DEFAULT_LIST_LIMIT = 1000
+MAX_LIST_LIMIT = 10000
+
+DEFAULT_REPLICATION = 3
+DEFAULT_PIPELINE_PIECE_SIZE = 1 << 20
+DEFAULT_PIPELINE_WINDOW = 8
+
+DEFAULT_PLACEMENT = "random-of-two"
+DEFAULT_HEARTBEAT_INTERVAL = 1.0
+DEFAULT_HEARTBEAT_TIMEOUT = 3 * DEFAULT_HEARTBEAT_INTERVAL
 
 DEFAULT_MASTER_CLIENT_PORT = 5001
 DEFAULT_MASTER_CHUNK_PORT = 5002
+DEFAULT_MASTER_META_DIR = "meta"
+DEFAULT_CHECKPOINT_OPS = 100000
+DEFAULT_GC_GRACE = 0
+DEFAULT_GC_INTERVAL = 1.0
+DEFAULT_GC_BATCH = 1000
+DEFAULT_GC_RATE = 10000
+DEFAULT_GC_RETRY_INTERVAL = 5.0
+
+# Files of up to DEFAULT_SMALL_FILE_SIZE bytes written in one go are packed
+# into container chunks shared with other small files, written by the master
+# on DEFAULT_MASTER_IO_THREADS threads. Containers no longer
+# taking files whose live files have fallen below DEFAULT_COMPACT_THRESHOLD
+# of them are rewritten, moving at most DEFAULT_COMPACT_BYTES every
+# DEFAULT_COMPACT_INTERVAL seconds.
+DEFAULT_SMALL_FILE_SIZE = 1 << 16
+MAX_SMALL_FILE_SIZE = 1 << 20
+DEFAULT_COMPACT_THRESHOLD = 0.5
+DEFAULT_COMPACT_INTERVAL = 10.0
+DEFAULT_COMPACT_BYTES = 1 << 24
+DEFAULT_MASTER_IO_THREADS = 4
+
 DEFAULT_CHUNK_SERVER_CLIENT_PORT = 5003
 DEFAULT_CHUNK_SERVER_MASTER_ADDR = ("", DEFAULT_MASTER_CHUNK_PORT)
+DEFAULT_CHUNK_SERVER_ENV = "mem"
+DEFAULT_CHUNK_SERVER_DATA_DIR = "data"
+DEFAULT_CHUNK_SERVER_FSYNC = "batch"
+DEFAULT_CHUNK_SERVER_IO_THREADS = 8
+DEFAULT_SCRUB_RATE = 1 << 24
+DEFAULT_SCRUB_COLD_AFTER = 60
+DEFAULT_SCRUB_INTERVAL = 60
+
+DEFAULT_LOG_LEVEL = "INFO"
+DEFAULT_LOG_FORMAT = "%(asctime)s %(levelname)s %(name)s: %(message)s"
+DEFAULT_STATS_INTERVAL = 0
+
+DEFAULT_POOL_MAX_CONNS_PER_SERVER = 4
+DEFAULT_POOL_IDLE_TIMEOUT = 60
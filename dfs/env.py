@@ -1,74 +1,324 @@
 
+import collections
+import errno
+import itertools
+import mmap
+import os
+import threading
+import time
+
 class MemEnv:
 
+    # Descriptors index _ftable and are recycled through a free list, so
+    # closing one never renumbers the others. Like an unlinked posix file,
+    # a removed file stays readable through descriptors already open on it.
+    # Callers serialize access to any one file; _lock guards the tables.
+
     def __init__(self):
         self._files = {}
         self._ftable = []
+        self._free = []
+        self._lock = threading.Lock()
 
     def open(self, fname, mode):
+        with self._lock:
+            return self._open(fname, mode)
+
+    def _open(self, fname, mode):
         if mode == "w+":
             f = {
                 "name": fname,
-                "buf": b"",
-                "offset": 0
+                "buf": bytearray()
             }
             self._files[fname] = f
-            self._ftable.append(f)
         else:
             f = self._files.get(fname, None)
             if not f:
                 raise IOError("No such file {}".format(fname))
-            self._ftable.append(f)
-            
-        return len(self._ftable) - 1
+
+        entry = {
+            "file": f,
+            "offset": 0
+        }
+        if self._free:
+            fd = self._free.pop()
+            self._ftable[fd] = entry
+        else:
+            fd = len(self._ftable)
+            self._ftable.append(entry)
+        return fd
 
     def close(self, fd):
-        f = self._ftable[fd]
-        f["offset"] = 0
-        self._ftable = self._ftable[:fd] + self._ftable[fd+1:]
+        with self._lock:
+            self._ftable[fd] = None
+            self._free.append(fd)
 
     def remove(self, fname):
-        # TODO: Concurrent access
-        if fname not in self._files:
-            raise IOError("{} does not exist.".format(fname))
-        self._files.pop(fname, None)
-        self._ftable = filter(lambda e: e["name"] != fname, self._ftable)
+        with self._lock:
+            if fname not in self._files:
+                raise IOError("{} does not exist.".format(fname))
+            del self._files[fname]
+
+    def _buf(self, fd):
+        return self._ftable[fd]["file"]["buf"]
 
     def seek(self, fd, pos):
-        f = self._ftable[fd]
-        assert(pos <= len(f["buf"]))
-        f["offset"] = pos
-        
+        assert(pos <= len(self._buf(fd)))
+        self._ftable[fd]["offset"] = pos
+
+    def _slice(self, fd, start, end):
+        buf = self._buf(fd)
+        return memoryview(buf)[start:min(end, len(buf))].tobytes()
+
     def read(self, fd, bufsize):
-        f = self._ftable[fd]
-        n = min(bufsize, len(f["buf"]) - f["offset"])
-        buf = f["buf"][f["offset"]:f["offset"] + n]
-        f["offset"] += n
+        entry = self._ftable[fd]
+        buf = self._slice(fd, entry["offset"], entry["offset"] + bufsize)
+        entry["offset"] += len(buf)
         return buf
 
     def readall(self, fd):
-        buf = b""
+        return self.read(fd, len(self._buf(fd)))
+
+    def readrange(self, fd, start_offset, end_offset):
+        self.seek(fd, min(start_offset, len(self._buf(fd))))
+        return self.read(fd, end_offset - start_offset)
+
+    def write(self, fd, data):
+        entry = self._ftable[fd]
+        self.writeat(fd, entry["offset"], data)
+        entry["offset"] += len(data)
+
+    def writeat(self, fd, offset, data):
+        buf = self._buf(fd)
+        assert(offset <= len(buf))
+        buf[offset:offset+len(data)] = data
+
+    def size(self, fd):
+        return len(self._buf(fd))
+
+    def truncate(self, fd, size):
+        entry = self._ftable[fd]
+        del self._buf(fd)[size:]
+        entry["offset"] = min(entry["offset"], size)
+
+    def listdir(self):
+        with self._lock:
+            return list(self._files)
+
+    def free_space(self):
+        # Files live in memory, so what's left is the host's free memory.
+        try:
+            return os.sysconf("SC_AVPHYS_PAGES") * os.sysconf("SC_PAGE_SIZE")
+        except (ValueError, OSError, AttributeError):
+            return None
+
+FSYNC_ALWAYS = "always"
+FSYNC_BATCH = "batch"
+FSYNC_NONE = "none"
+
+def _pwrite(fd, data, offset):
+    view = memoryview(data)
+    while len(view) > 0:
+        if hasattr(os, "pwrite"):
+            n = os.pwrite(fd, view, offset)
+        else:
+            # Only one thread may position the shared descriptor at a time.
+            with _seek_lock:
+                os.lseek(fd, offset, os.SEEK_SET)
+                n = os.write(fd, view)
+        view = view[n:]
+        offset += n
+
+_seek_lock = threading.Lock()
+
+class _PosixFile:
+
+    def __init__(self, fname, osfd):
+        self.name = fname
+        self.osfd = osfd
+        self.map = None
+        self.mapsize = 0
+        self.dirty = False
+        self.refs = 0
+
+class PosixEnv:
+
+    # Chunk files live under data_dir. OS descriptors stay open across
+    # open/close so per-RPC opens are cheap and batched fsyncs can find
+    # dirty files; at most max_open idle files are kept open.
+
+    def __init__(self, data_dir,
+                 fsync=FSYNC_BATCH,
+                 fsync_interval=1.0,
+                 max_open=256):
+        assert(fsync in (FSYNC_ALWAYS, FSYNC_BATCH, FSYNC_NONE))
+        if not os.path.isdir(data_dir):
+            os.makedirs(data_dir)
+        self._dir = data_dir
+        self._fsync = fsync
+        self._max_open = max_open
+        self._lock = threading.RLock()
+        self._files = collections.OrderedDict()
+        self._ftable = {}
+        self._fds = itertools.count()
+        if fsync == FSYNC_BATCH:
+            t = threading.Thread(target=self._sync_loop, args=(fsync_interval,))
+            t.daemon = True
+            t.start()
+
+    def _path(self, fname):
+        assert(os.sep not in fname)
+        return os.path.join(self._dir, fname)
+
+    def _sync_loop(self, interval):
         while True:
-            b = self.read(fd, 4092)
-            if not b:
+            time.sleep(interval)
+            self.sync()
+
+    def _sync_file(self, f):
+        if f.dirty:
+            f.dirty = False
+            os.fsync(f.osfd)
+
+    def _close_file(self, f):
+        self._sync_file(f)
+        os.close(f.osfd)
+        f.map = None
+
+    def _evict(self):
+        for f in list(self._files.values()):
+            if len(self._files) <= self._max_open:
                 break
-            buf += b
+            if f.refs == 0:
+                del self._files[f.name]
+                self._close_file(f)
+
+    def _file(self, fd):
+        return self._ftable[fd][0]
+
+    def open(self, fname, mode):
+        with self._lock:
+            f = self._files.pop(fname, None)
+            if f is None or mode == "w+":
+                if f is not None:
+                    self._close_file(f)
+                flags = os.O_RDWR
+                if mode == "w+":
+                    flags |= os.O_CREAT | os.O_TRUNC
+                try:
+                    f = _PosixFile(fname, os.open(self._path(fname), flags, 0o644))
+                except OSError as err:
+                    if err.errno == errno.ENOENT:
+                        raise IOError("No such file {}".format(fname))
+                    raise
+            self._files[fname] = f
+            f.refs += 1
+            fd = next(self._fds)
+            self._ftable[fd] = [f, 0]
+            self._evict()
+            return fd
+
+    def close(self, fd):
+        with self._lock:
+            f, _ = self._ftable.pop(fd)
+            f.refs -= 1
+            self._evict()
+
+    def remove(self, fname):
+        with self._lock:
+            f = self._files.pop(fname, None)
+            if f is not None:
+                f.dirty = False
+                self._close_file(f)
+                for fd, entry in list(self._ftable.items()):
+                    if entry[0] is f:
+                        del self._ftable[fd]
+            try:
+                os.remove(self._path(fname))
+            except OSError:
+                raise IOError("{} does not exist.".format(fname))
+
+    def sync(self):
+        with self._lock:
+            for f in self._files.values():
+                self._sync_file(f)
+
+    def listdir(self):
+        return os.listdir(self._dir)
+
+    def free_space(self):
+        st = os.statvfs(self._dir)
+        return st.f_bavail * st.f_frsize
+
+    def _size_of(self, f):
+        return os.fstat(f.osfd).st_size
+
+    def size(self, fd):
+        return self._size_of(self._file(fd))
+
+    def seek(self, fd, pos):
+        assert(pos <= self.size(fd))
+        self._ftable[fd][1] = pos
+
+    def _map(self, f, size):
+        # Replaced maps are not closed explicitly; they go once nothing
+        # refers to them.
+        with self._lock:
+            if f.map is None or f.mapsize < size:
+                f.map = mmap.mmap(f.osfd, size, access=mmap.ACCESS_READ)
+                f.mapsize = size
+            return f.map
+
+    def _slice(self, f, start, end):
+        size = self._size_of(f)
+        end = min(end, size)
+        if start >= end:
+            return b""
+        # Copied out of the map: a view could outlive the read and be sent
+        # after the file's truncated under it, faulting on the missing pages.
+        return self._map(f, size)[start:end]
+
+    def read(self, fd, bufsize):
+        entry = self._ftable[fd]
+        f, offset = entry
+        buf = self._slice(f, offset, offset + bufsize)
+        entry[1] = offset + len(buf)
         return buf
 
-    def readrange(self, fd, start_offset, end_offset):
-        l = end_offset - start_offset
-        buf = b""
+    def readall(self, fd):
+        entry = self._ftable[fd]
+        buf = self._slice(entry[0], entry[1], self.size(fd))
+        entry[1] += len(buf)
+        return buf
 
+    def readrange(self, fd, start_offset, end_offset):
         self.seek(fd, start_offset)
-        while len(buf) < l:
-            b = self.read(fd, l - len(buf))
-            if not b:
-                break
-            buf += b
-        return buf
+        return self.read(fd, end_offset - start_offset)
+
+    def _written(self, f):
+        if self._fsync == FSYNC_ALWAYS:
+            os.fsync(f.osfd)
+        elif self._fsync == FSYNC_BATCH:
+            f.dirty = True
 
     def write(self, fd, data):
-        f = self._ftable[fd]
-        buf = f["buf"]
-        f["buf"] = buf[:f["offset"]] + data + buf[f["offset"]:]
-        f["offset"] += len(data)
+        entry = self._ftable[fd]
+        f, offset = entry
+        _pwrite(f.osfd, data, offset)
+        entry[1] = offset + len(data)
+        self._written(f)
+
+    def writeat(self, fd, offset, data):
+        assert(offset <= self.size(fd))
+        f = self._file(fd)
+        _pwrite(f.osfd, data, offset)
+        self._written(f)
+
+    def truncate(self, fd, size):
+        entry = self._ftable[fd]
+        f = entry[0]
+        os.ftruncate(f.osfd, size)
+        entry[1] = min(entry[1], size)
+        with self._lock:
+            f.map = None
+        self._written(f)
@@ -1,68 +1,315 @@
 
+import collections
+import logging
+import random
 import socket
-import select
+import sys
+import struct
+import threading
+import time
 
+import compression as codecs
 import rpc
 from constants import *
+from collector import ChunkCollector
+from metrics import start_dump
+import namespace
+from namespace import NamespaceIndex
+from oplog import OpLog
+from server import Server
+from workers import Future, WorkerPool, chain, gather, run_into
+
+log = logging.getLogger("master")
 
 class ChunkInfo:
 
-    def __init__(self, id, addr):
+    # replicas lists the addresses of the chunkservers holding the chunk.
+    # Writes go to the first and are forwarded along the rest in order.
+    # A small file packed into a container chunk shared with others is the
+    # length bytes at offset in it.
+
+    def __init__(self, id, replicas, offset=None, length=None):
         self.id = id
-        self.addr = addr
+        self.replicas = replicas
+        self.offset = offset
+        self.length = length
+
+    def packed(self):
+        return self.length is not None
 
     def to_hash(self):
-        return {
+        h = {
             "id": self.id,
-            "addr": self.addr
+            "replicas": self.replicas
         }
+        if self.packed():
+            h["offset"] = self.offset
+            h["length"] = self.length
+        return h
 
     @staticmethod
     def from_hash(h):
-        host = h["addr"][0]
-        port = int(h["addr"][1])
-        addr = (host, port)
+        replicas = [(host, int(port)) for host, port in h["replicas"]]
         ci = ChunkInfo(
             id=h["id"],
-            addr=addr
+            replicas=replicas,
+            offset=h.get("offset"),
+            length=h.get("length")
         )
         return ci
 
 class FileInfo:
 
-    def __init__(self):
+    # compression names the codec clients compress the file's blocks with,
+    # or is None. It's fixed when the file is created.
+
+    def __init__(self, compression=None):
         self.chunk_info = []
+        self.compression = compression
         self.nopen = 0
         self.deleted = False
+        self.deleted_at = None
+
+    def packed(self):
+        return len(self.chunk_info) == 1 and self.chunk_info[0].packed()
+
+    def meta(self):
+        return FileMeta(
+            nchunks=len(self.chunk_info),
+            compression=self.compression,
+            packed=self.chunk_info[0] if self.packed() else None
+        )
+
+class FileMeta:
+
+    # What clients are told of a file on create, open and stat. Chunk
+    # locations are fetched separately, a page at a time, so this stays
+    # small however big the file is. The location of a packed file comes
+    # along, so reading it takes one more call.
+
+    def __init__(self, nchunks, compression=None, packed=None):
+        self.nchunks = nchunks
+        self.compression = compression
+        self.packed = packed
 
     def to_hash(self):
         return {
-            "chunk_info": [cinfo.to_hash() for cinfo in self.chunk_info],
+            "nchunks": self.nchunks,
+            "compression": self.compression,
+            "packed": self.packed.to_hash() if self.packed else None
         }
 
     @staticmethod
     def from_hash(h):
-        fi = FileInfo()
-        fi.chunk_info = [ChunkInfo.from_hash(ch) for ch in h["chunk_info"]]
-        return fi
+        packed = h.get("packed")
+        return FileMeta(
+            nchunks=h["nchunks"],
+            compression=h.get("compression"),
+            packed=ChunkInfo.from_hash(packed) if packed else None
+        )
+
+class Container:
+
+    # A chunk small files are packed into. files maps the FileInfo of each
+    # file packed in it that hasn't been collected, deleted or not, to its
+    # name. size is where the next file goes, and pending counts writes
+    # given room in it that haven't finished. created resolves once the
+    # chunk exists on every replica.
+
+    def __init__(self, cinfo, size=0, created=None):
+        self.cinfo = cinfo
+        self.size = size
+        self.files = {}
+        self.pending = 0
+        if created is None:
+            created = Future()
+            created.set_result(None)
+        self.created = created
+
+    def live(self):
+        return sum(info.chunk_info[0].length for info in self.files)
+
+class ChunkServerState:
+
+    # What the master knows of one chunkserver from its heartbeats. free is
+    # None until the server reports it. Allocations count against chunks and
+    # free right away so placement doesn't wait for the next heartbeat to
+    # see them.
+
+    def __init__(self, server, addr):
+        self.server = server
+        self.addr = addr
+        self.chunks = 0
+        self.free = None
+        self.inflight = 0
+        self.last_seen = time.time()
+
+    def update(self, stats):
+        self.chunks = stats["chunks"]
+        self.free = stats["free"]
+        self.inflight = stats["inflight"]
+        self.last_seen = time.time()
+
+    def alive(self, timeout):
+        return time.time() - self.last_seen <= timeout
+
+    def has_room(self):
+        return self.free is None or self.free >= CHUNK_SIZE
+
+    def load(self):
+        return (self.inflight, self.chunks)
+
+    def allocated(self, count):
+        self.chunks += count
+        if self.free is not None:
+            self.free = max(0, self.free - count * CHUNK_SIZE)
+
+# Placement policies pick one of a list of live ChunkServerStates with room
+# for another chunk. They only look at the master's load table, never the
+# network.
+
+# Checkpoints are a header followed by each file's name, compression and
+# chunks, then the chunks waiting to be collected by chunkserver, with
+# every string length-prefixed. Version 1 had no compression, version 2 no
+# packed chunks and version 3 no chunks to collect.
+_CHECKPOINT_MAGIC = b"DFSM"
+_CHECKPOINT_VERSION = 4
+
+def _utf8(s):
+    return s if isinstance(s, bytes) else s.encode("utf-8")
+
+def _encode_checkpoint(files, garbage):
+    # files is a list of (fname, compression, [ChunkInfo]) and garbage a
+    # {addr: [chunkid]}.
+    out = [struct.pack("!4sBI", _CHECKPOINT_MAGIC, _CHECKPOINT_VERSION,
+                       len(files))]
+    for fname, compression, chunks in files:
+        name = _utf8(fname)
+        out.append(struct.pack("!H", len(name)) + name)
+        codec = _utf8(compression or "")
+        out.append(struct.pack("!B", len(codec)) + codec)
+        out.append(struct.pack("!I", len(chunks)))
+        for cinfo in chunks:
+            chunkid = _utf8(cinfo.id)
+            out.append(struct.pack("!B", len(chunkid)) + chunkid)
+            out.append(struct.pack("!B", len(cinfo.replicas)))
+            for host, port in cinfo.replicas:
+                host = _utf8(host)
+                out.append(struct.pack("!B", len(host)) + host)
+                out.append(struct.pack("!H", port))
+            if cinfo.packed():
+                out.append(struct.pack("!BII", 1, cinfo.offset, cinfo.length))
+            else:
+                out.append(struct.pack("!B", 0))
+    out.append(struct.pack("!I", len(garbage)))
+    for (host, port), chunkids in garbage.items():
+        host = _utf8(host)
+        out.append(struct.pack("!B", len(host)) + host)
+        out.append(struct.pack("!HI", port, len(chunkids)))
+        for chunkid in chunkids:
+            chunkid = _utf8(chunkid)
+            out.append(struct.pack("!B", len(chunkid)) + chunkid)
+    return b"".join(out)
+
+def _decode_checkpoint(data):
+    pos = [0]
+
+    def unpack(fmt):
+        vals = struct.unpack_from(fmt, data, pos[0])
+        pos[0] += struct.calcsize(fmt)
+        return vals[0] if len(vals) == 1 else vals
+
+    def string(fmt):
+        n = unpack(fmt)
+        s = data[pos[0]:pos[0]+n]
+        pos[0] += n
+        return s.decode("utf-8")
+
+    magic, version, nfiles = unpack("!4sBI")
+    if magic != _CHECKPOINT_MAGIC or version not in (1, 2, 3, _CHECKPOINT_VERSION):
+        raise ValueError("Unrecognized checkpoint format.")
+    file_info = {}
+    for _ in range(nfiles):
+        fname = string("!H")
+        finfo = FileInfo()
+        if version >= 2:
+            finfo.compression = string("!B") or None
+        for _ in range(unpack("!I")):
+            chunkid = string("!B")
+            replicas = []
+            for _ in range(unpack("!B")):
+                host = string("!B")
+                replicas.append((host, unpack("!H")))
+            cinfo = ChunkInfo(id=chunkid, replicas=replicas)
+            if version >= 3 and unpack("!B"):
+                cinfo.offset, cinfo.length = unpack("!II")
+            finfo.chunk_info.append(cinfo)
+        file_info[fname] = finfo
+    garbage = {}
+    if version >= 4:
+        for _ in range(unpack("!I")):
+            host = string("!B")
+            port, nchunks = unpack("!HI")
+            garbage[(host, port)] = [string("!B") for _ in range(nchunks)]
+    return file_info, garbage
 
 class RoundRobinIter:
 
     def __init__(self):
         self._idx = 0
 
-    def next(self, chunk_servers):
-        start = self._idx
-        while True:
-            s = chunk_servers[self._idx]
-            self._idx += 1
-            self._idx %= len(chunk_servers)
-            try:
-                s.ping()
+    def next(self, candidates):
+        self._idx %= len(candidates)
+        s = candidates[self._idx]
+        self._idx += 1
+        return s
+
+class LeastLoadedPlacement:
+
+    def next(self, candidates):
+        return min(candidates, key=lambda s: s.load())
+
+class CapacityWeightedPlacement:
+
+    # Picks a server with probability proportional to its free space.
+
+    def __init__(self, rand=None):
+        self._rand = rand or random.Random()
+
+    def next(self, candidates):
+        weights = [s.free if s.free is not None else CHUNK_SIZE
+                   for s in candidates]
+        total = sum(weights)
+        if total <= 0:
+            return self._rand.choice(candidates)
+        point = self._rand.uniform(0, total)
+        for s, weight in zip(candidates, weights):
+            point -= weight
+            if point <= 0:
                 return s
-            except Exception as err:
-                if self._idx is start:
-                    raise ValueError("No chunk servers up.")
+        return candidates[-1]
+
+class RandomOfTwoPlacement:
+
+    # Picks the less loaded of two random servers, which spreads load
+    # nearly as well as least-loaded without herding onto one server
+    # between heartbeats.
+
+    def __init__(self, rand=None):
+        self._rand = rand or random.Random()
+
+    def next(self, candidates):
+        if len(candidates) == 1:
+            return candidates[0]
+        a, b = self._rand.sample(candidates, 2)
+        return a if a.load() <= b.load() else b
+
+PLACEMENTS = {
+    "round-robin": RoundRobinIter,
+    "least-loaded": LeastLoadedPlacement,
+    "capacity": CapacityWeightedPlacement,
+    "random-of-two": RandomOfTwoPlacement
+}
 
 class Master:
 
@@ -70,165 +317,956 @@ class Master:
 
     def __init__(self,
                  chunkserver_iter,
-                 chunkservers=[],
-                 file_info={}):
-        self._chunkservers = chunkservers
-        self._chunkserver_dict = {}
+                 chunkservers=None,
+                 file_info=None,
+                 replication=DEFAULT_REPLICATION,
+                 heartbeat_timeout=DEFAULT_HEARTBEAT_TIMEOUT,
+                 oplog=None,
+                 checkpoint_ops=DEFAULT_CHECKPOINT_OPS,
+                 collector=None,
+                 gc_grace=DEFAULT_GC_GRACE,
+                 compact_threshold=DEFAULT_COMPACT_THRESHOLD,
+                 io_pool=None,
+                 call_soon=None):
+        # Chunkservers by address. Addresses are fetched once, at
+        # registration.
+        self._chunkservers = collections.OrderedDict()
         self._chunkserver_iter = chunkserver_iter
+        # Container chunks by id, and the one small files go to next.
+        self._containers = {}
+        self._open_container = None
+        self._compact_threshold = compact_threshold
+        self._packing = set()
+        self._releasing = {}
+        # Chunks of deleted files waiting for the delete to be durable, by
+        # FileInfo.
+        self._releasing_files = {}
+        # Unpacks in progress, by FileInfo.
+        self._unpacking = {}
+        # Chunk creation, small file writes and copies run on io_pool, and
+        # their results are applied through call_soon(fn, *args), which main
+        # points at the server's loop. Without a pool they run inline.
+        self._io_pool = io_pool
+        self._call_soon = call_soon or (lambda fn, *args: fn(*args))
+        self._load(file_info if file_info is not None else {})
+        self._replication = replication
+        self._heartbeat_timeout = heartbeat_timeout
+        self._oplog = oplog
+        self._checkpoint_ops = checkpoint_ops
+        # Chunk lists as of the checkpoint being encoded, of files changed
+        # since it started, by FileInfo. None when there isn't one.
+        self._saved = None
+        self._saved_lock = threading.Lock()
+        # Deleted files by name, oldest first. They stay readable by those
+        # who had them open, and their chunks are kept, until they're
+        # closed and gc_grace seconds have passed.
+        self._hidden = {}
+        self._bad_replicas = {}
+        self._gc_grace = gc_grace
+        self._collector = collector or ChunkCollector(lookup=self._lookup)
+
+        for cserver in chunkservers or []:
+            self.add_chunk_server(cserver)
+        if oplog is not None:
+            self._recover()
+
+    def _recover(self):
+        checkpoint, ops = self._oplog.recover()
+        garbage = {}
+        if checkpoint is not None:
+            file_info, garbage = _decode_checkpoint(checkpoint)
+            self._load(file_info)
+        for op in ops:
+            self._apply(op)
+        # A container may have taken files since it was checkpointed.
+        for addr, chunkids in garbage.items():
+            chunkids = [c for c in chunkids if c not in self._containers]
+            if chunkids:
+                self._collector.add(addr, chunkids)
+        # Containers aren't reopened, since a replica may hold a failed
+        # write past the end of one. Any left empty can go.
+        self._open_container = None
+        for container in list(self._containers.values()):
+            if not container.files:
+                del self._containers[container.cinfo.id]
+                self._collect_container(container)
+        self._oplog.start()
+
+    def _load(self, file_info):
         self._file_info = file_info
+        # Names in _file_info, by directory, for listings.
+        self._index = NamespaceIndex(file_info)
+        self._containers = {}
+        for fname, info in file_info.items():
+            self._track(fname, info)
+
+    def _track(self, fname, info):
+        # Notes which container a packed file is in.
+        if not info.packed():
+            return
+        cinfo = info.chunk_info[0]
+        container = self._containers.get(cinfo.id)
+        if container is None:
+            container = self._containers[cinfo.id] = Container(
+                ChunkInfo(id=cinfo.id, replicas=cinfo.replicas)
+            )
+        container.size = max(container.size, cinfo.offset + cinfo.length)
+        container.files[info] = fname
+
+    def _untrack(self, info):
+        # Forgets a packed file, collecting its container once it's the
+        # last one in it.
+        if not info.packed():
+            return
+        container = self._containers.get(info.chunk_info[0].id)
+        if container is None:
+            return
+        container.files.pop(info, None)
+        self._maybe_release(container)
+
+    def _maybe_release(self, container):
+        # Collects a container no file is in or being written to, once
+        # whatever emptied it is durable.
+        if container.files or container.pending:
+            return
+        if container is self._open_container:
+            return
+        if self._containers.get(container.cinfo.id) is not container:
+            return
+        chunkid = container.cinfo.id
+        del self._containers[chunkid]
+        self._releasing[chunkid] = container
+        def release():
+            del self._releasing[chunkid]
+            # One that was never created was collected by _allocate.
+            if container.created.exception() is None:
+                self._collect_container(container)
+        self._after_sync(release)
+
+    def _reopen(self, fname, info):
+        # A replayed pack went to the open container, so deletes replayed
+        # after it don't collect it.
+        self._track(fname, info)
+        if info.packed():
+            self._open_container = self._containers[info.chunk_info[0].id]
+
+    def _collect_container(self, container):
+        for addr in container.cinfo.replicas:
+            self._collector.add(addr, [container.cinfo.id])
+
+    def _apply(self, op):
+        # Replays one logged mutation.
+        kind, fname = op["op"], op["fname"]
+        if kind == "create":
+            self._file_info[fname] = FileInfo(op.get("compression"))
+            try:
+                self._index.add(fname)
+            except IOError:
+                # Clashes with a directory; logged before there were any.
+                pass
+        elif kind == "delete":
+            # The chunks may not have been collected before the restart.
+            # Deleting them again is harmless.
+            info = self._file_info.pop(fname, None)
+            if info is not None:
+                self._index.remove(fname)
+                self._collect(info)
+        elif kind == "add_chunks":
+            info = self._file_info[fname]
+            info.chunk_info.extend(ChunkInfo.from_hash(h) for h in op["chunks"])
+            self._reopen(fname, info)
+        elif kind == "set_chunks":
+            info = self._file_info[fname]
+            self._untrack(info)
+            info.chunk_info = [ChunkInfo.from_hash(h) for h in op["chunks"]]
+            self._reopen(fname, info)
+        else:
+            raise ValueError("Unrecognized op {}".format(kind))
+
+    def _log(self, op):
+        if self._oplog is None:
+            return
+        self._oplog.append(op)
+        if (self._oplog.since_checkpoint >= self._checkpoint_ops and
+                not self._oplog.checkpointing()):
+            self.checkpoint()
+
+    def checkpoint(self):
+        # Only the namespace dict is copied here. The background writer
+        # reads each file's chunks itself, copy-on-write: a file changed
+        # before the writer gets to it has its old chunks saved first.
+        if self._oplog.checkpointing():
+            return False
+        snapshot = dict(self._file_info)
+        garbage = self._garbage()
+        saved = {}
+
+        def chunks(info):
+            with self._saved_lock:
+                if info in saved:
+                    return saved[info]
+                return list(info.chunk_info)
+
+        def encode():
+            try:
+                files = [
+                    (fname, info.compression, chunks(info))
+                    for fname, info in snapshot.items()
+                ]
+            finally:
+                self._saved = None
+            return _encode_checkpoint(files, garbage)
 
-        for cserver in chunkservers:
-            self._chunkserver_dict[cserver.addr()] = cserver
+        self._saved = saved
+        if not self._oplog.checkpoint(encode):
+            self._saved = None
+            return False
+        return True
+
+    def _changing(self, info):
+        # Called before info's chunks change, to keep them for a
+        # checkpoint being encoded.
+        saved = self._saved
+        if saved is None:
+            return
+        with self._saved_lock:
+            if info not in saved:
+                saved[info] = list(info.chunk_info)
+
+    def _garbage(self):
+        # Chunks no live file refers to that may still be on chunkservers:
+        # those queued for collection, those of hidden files, which won't
+        # be open after a restart, containers holding only hidden files,
+        # and chunks about to be collected. Their deletes aren't replayed
+        # once they're checkpointed.
+        garbage = self._collector.pending_chunks()
+        def add(cinfo):
+            for addr in cinfo.replicas:
+                garbage.setdefault(tuple(addr), []).append(cinfo.id)
+        for infos in self._hidden.values():
+            for info in infos:
+                if not info.packed():
+                    for cinfo in info.chunk_info:
+                        add(cinfo)
+        for container in self._containers.values():
+            if all(info.deleted for info in container.files):
+                add(container.cinfo)
+        for container in self._releasing.values():
+            add(container.cinfo)
+        for cinfos in self._releasing_files.values():
+            for cinfo in cinfos:
+                add(cinfo)
+        return garbage
+
+    def sync(self):
+        # Returns a future that resolves once every mutation so far is
+        # durable. Mutations are applied in memory right away; RPC replies
+        # wait on this so a batch of them shares one fsync.
+        if self._oplog is None:
+            fut = Future()
+            fut.set_result(None)
+            return fut
+        return self._oplog.commit()
+
+    def _after_sync(self, fn):
+        # Runs fn on the loop once every mutation so far is durable.
+        self.sync().add_done_callback(lambda _: self._call_soon(fn))
 
     def _get_file_info(self, fname):
         info = self._file_info.get(fname, None)
-        if not info or info.deleted:
+        if not info:
             raise IOError("No such file {}".format(fname))
         return info
 
-    def _do_delete(self, fname, finfo):
-        # TODO: Do async.
-        del self._file_info[fname]
-        for cinfo in finfo.chunk_info:
-            cserver = self._chunkserver_dict[cinfo.addr]
-            cserver.delete_chunk(cinfo.id)
+    def _lookup(self, addr):
+        state = self._chunkservers.get(addr)
+        return state.server if state else None
+
+    def _collect(self, info):
+        if info.packed():
+            self._untrack(info)
+            return
+        self._releasing_files[info] = info.chunk_info
+        def release():
+            del self._releasing_files[info]
+            self._collect_chunks(info.chunk_info)
+        self._after_sync(release)
+
+    def _collect_chunks(self, cinfos):
+        placed = collections.OrderedDict()
+        for cinfo in cinfos:
+            self._bad_replicas.pop(cinfo.id, None)
+            for addr in cinfo.replicas:
+                placed.setdefault(addr, []).append(cinfo.id)
+        for addr, chunkids in placed.items():
+            self._collector.add(addr, chunkids)
+
+    def _expired(self, info, now):
+        return info.nopen == 0 and now - info.deleted_at >= self._gc_grace
+
+    def collect_garbage(self):
+        # Hands the chunks of hidden files that are closed and past their
+        # grace period to the collector.
+        now = time.time()
+        for fname, infos in list(self._hidden.items()):
+            for info in [i for i in infos if self._expired(i, now)]:
+                infos.remove(info)
+                self._collect(info)
+            if not infos:
+                del self._hidden[fname]
+
+    def start_collector(self):
+        self._collector.start()
 
-    def create(self, fname):
+    def create(self, fname, compression=None):
+        codecs.check(compression)
+        namespace.check(fname)
         if fname in self._file_info:
             raise IOError("File {} already exists.".format(fname))
-        info = FileInfo()
+        self._index.add(fname)
+        info = FileInfo(compression)
         self._file_info[fname] = info
+        op = {"op": "create", "fname": fname}
+        if compression is not None:
+            op["compression"] = compression
+        self._log(op)
         return info
 
     def delete(self, fname):
         info = self._get_file_info(fname)
-        if info.nopen > 0:
-            info.deleted = True
-            return
-        self._do_delete(fname, info)
-    
+        del self._file_info[fname]
+        self._index.remove(fname)
+        # Logged once the file's gone, so a checkpoint this triggers
+        # doesn't include it.
+        self._log({"op": "delete", "fname": fname})
+        info.deleted = True
+        info.deleted_at = time.time()
+        if self._expired(info, info.deleted_at):
+            self._collect(info)
+        else:
+            self._hidden.setdefault(fname, []).append(info)
+
     def open(self, fname):
         info = self._get_file_info(fname)
         info.nopen += 1
         return info
 
+    def list(self, prefix="", limit=DEFAULT_LIST_LIMIT, cursor=None):
+        # Lists the entries of the directory prefix names that start with
+        # the rest of it, e.g. "logs/" or "logs/2026-". Returns (entries,
+        # cursor); pass cursor back to get the next page, until it's None.
+        limit = max(1, min(limit, MAX_LIST_LIMIT))
+        return self._index.list(prefix, limit, cursor)
+
+    def stat(self, fname):
+        return self._get_file_info(fname)
+
+    def _open_info(self, fname):
+        # The file a client with fname open is using: the live one, unless
+        # only a deleted one is open.
+        info = self._file_info.get(fname, None)
+        if info and info.nopen > 0:
+            return info
+        for hidden in reversed(self._hidden.get(fname, [])):
+            if hidden.nopen > 0:
+                return hidden
+        return info or self._get_file_info(fname)
+
     def close(self, fname):
-        info = self._get_file_info(fname)
-        info.nopen -= 1
-        if info.deleted and info.nopen is 0:
-            self._do_delete(fname, info)
+        info = self._open_info(fname)
+        info.nopen = max(0, info.nopen - 1)
+        if info.deleted and self._expired(info, time.time()):
+            self.collect_garbage()
+
+    def _choose_servers(self):
+        live = [
+            s for s in self._chunkservers.values()
+            if s.alive(self._heartbeat_timeout) and s.has_room()
+        ]
+        n = min(self._replication, len(live))
+        if n == 0:
+            raise ValueError("No chunk servers up.")
+        chosen = []
+        while len(chosen) < n:
+            candidates = [s for s in live if s not in chosen]
+            chosen.append(self._chunkserver_iter.next(candidates))
+        for s in chosen:
+            s.allocated(1)
+        return chosen
 
     def request_new_chunk(self, fname):
-        import uuid
+        return self.request_new_chunks(fname, 1).then(lambda cinfos: cinfos[0])
 
+    def request_new_chunks(self, fname, count):
+        # Returns a future for count new chunks of fname. They're only added
+        # to the file once every replica exists.
         finfo = self._get_file_info(fname)
-        server = self._chunkserver_iter.next(self._chunkservers)
-        chunkid = str(uuid.uuid4())
-        server.create_chunk(chunkid)
+        if finfo.packed() or finfo in self._packing:
+            raise IOError("File {} is packed.".format(fname))
+        cinfos, created = self._allocate(count)
+
+        def add(_):
+            if finfo.deleted or finfo.packed():
+                self._collect_chunks(cinfos)
+                raise IOError("File {} changed.".format(fname))
+            self._changing(finfo)
+            finfo.chunk_info.extend(cinfos)
+            self._log({
+                "op": "add_chunks",
+                "fname": fname,
+                "chunks": [cinfo.to_hash() for cinfo in cinfos]
+            })
+            return cinfos
+        return created.then(add)
+
+    def _allocate(self, count):
+        # Places count chunks, then creates them on the I/O pool with one
+        # create_chunks call per chunkserver. Returns their ChunkInfos and a
+        # future resolved once they all exist. If any creation fails, every
+        # chunk is collected, as some may have been created.
+        import uuid
+
+        cinfos = []
+        placed = collections.OrderedDict()
+        for _ in range(count):
+            chunkid = str(uuid.uuid4())
+            chosen = self._choose_servers()
+            for s in chosen:
+                placed.setdefault(s, []).append(chunkid)
+            cinfos.append(ChunkInfo(
+                id=chunkid,
+                replicas=[s.addr for s in chosen]
+            ))
+        creates = [
+            self._offload(s.addr, s.server.create_chunks, chunkids)
+            for s, chunkids in placed.items()
+        ]
+
+        def check(_):
+            for fut in creates:
+                if fut.exception() is None:
+                    continue
+                for s, chunkids in placed.items():
+                    s.allocated(-len(chunkids))
+                    self._collector.add(s.addr, chunkids)
+                return fut.result()
+        created = Future()
+        gather(creates).add_done_callback(
+            lambda _: run_into(created, check, None)
+        )
+        return cinfos, created
+
+    def _offload(self, key, fn, *args):
+        # Runs fn(*args) on the I/O pool, in order with other work under
+        # key, and returns a future resolved through call_soon.
+        fut = Future()
+        if self._io_pool is None:
+            run_into(fut, fn, *args)
+            return fut
+        def task():
+            try:
+                result = fn(*args)
+            except Exception:
+                self._call_soon(fut.set_exception, sys.exc_info())
+                return
+            self._call_soon(fut.set_result, result)
+        self._io_pool.submit_keyed(key, task)
+        return fut
+
+    def _on_loop(self, fn, *args):
+        # Runs fn(*args) through call_soon and waits for its result. For
+        # background threads only.
+        fut = Future()
+        self._call_soon(run_into, fut, fn, *args)
+        return fut.result()
+
+    def _write_packed(self, cinfo, data):
+        for addr in cinfo.replicas:
+            server = self._lookup(addr)
+            if server is None:
+                raise IOError("Unknown chunk server {}".format(addr))
+            server.write_chunk_at(cinfo.id, cinfo.offset, data)
+
+    def _pack(self, data, place):
+        # Makes room for data in the open container, starting a new one when
+        # it's full, and writes it to each replica on the I/O pool, in order
+        # with the container's other writes. Once written, place(cinfo) is
+        # called with where it went; the returned future resolves to what
+        # place returns. After a failed write the replicas may disagree past
+        # the end, so the container takes no more files.
+        container = self._open_container
+        if container is None or container.size + len(data) > CHUNK_SIZE:
+            self._seal()
+            cinfos, created = self._allocate(1)
+            container = Container(cinfos[0], created=created)
+            self._containers[container.cinfo.id] = container
+            self._open_container = container
         cinfo = ChunkInfo(
-            id=chunkid,
-            addr=server.addr()
+            id=container.cinfo.id,
+            replicas=container.cinfo.replicas,
+            offset=container.size,
+            length=len(data)
         )
-        finfo.chunk_info.append(cinfo)
-        return cinfo
+        container.size += len(data)
+        container.pending += 1
+
+        def done():
+            container.pending -= 1
+            try:
+                if written.exception() is not None:
+                    if container is self._open_container:
+                        self._seal()
+                    return written.result()
+                if self._containers.get(cinfo.id) is not container:
+                    raise IOError("Container {} is gone.".format(cinfo.id))
+                return place(cinfo)
+            finally:
+                self._maybe_release(container)
+
+        out = Future()
+        written = chain(container.created, lambda _: self._offload(
+            cinfo.id,
+            self._write_packed,
+            cinfo,
+            data
+        ))
+        written.add_done_callback(lambda _: run_into(out, done))
+        return out
+
+    def _seal(self):
+        # Stops packing into the open container.
+        container, self._open_container = self._open_container, None
+        if container is not None:
+            self._maybe_release(container)
+
+    def write_small(self, fname, data):
+        # Stores data, the whole of an empty file, in a container chunk
+        # shared with other small files. Returns a future for its ChunkInfo,
+        # resolved once it's written and logged. Packed files can't be
+        # appended to.
+        if len(data) > MAX_SMALL_FILE_SIZE:
+            raise ValueError("{} bytes is too big to pack.".format(len(data)))
+        info = self._get_file_info(fname)
+        if info.chunk_info or info in self._packing:
+            raise IOError("File {} isn't empty.".format(fname))
+
+        def place(cinfo):
+            if info.deleted:
+                raise IOError("File {} was deleted.".format(fname))
+            self._changing(info)
+            info.chunk_info.append(cinfo)
+            self._track(fname, info)
+            self._log({
+                "op": "add_chunks",
+                "fname": fname,
+                "chunks": [cinfo.to_hash()]
+            })
+            return cinfo
+
+        self._packing.add(info)
+        fut = self._pack(data, place)
+        fut.add_done_callback(lambda _: self._packing.discard(info))
+        return fut
+
+    def _read_packed(self, cinfo):
+        err = None
+        for addr in cinfo.replicas:
+            server = self._lookup(addr)
+            if server is None:
+                continue
+            try:
+                return server.read_chunk(
+                    cinfo.id,
+                    cinfo.offset,
+                    cinfo.offset + cinfo.length
+                )
+            except (IOError, ValueError) as e:
+                err = e
+        raise err or IOError("No replica of chunk {} is up".format(cinfo.id))
+
+    def compact(self, max_bytes=DEFAULT_COMPACT_BYTES):
+        # Moves files out of a container that takes no more files and whose
+        # live data has fallen below compact_threshold of it, so it can be
+        # collected once empty. Containers holding deleted files someone
+        # may still be reading are left alone. At most about max_bytes move
+        # a pass. Runs on a background thread: copies are made there, and
+        # only the moves happen on the loop. Returns the bytes moved.
+        moved = 0
+        moves = self._on_loop(self._plan_compaction, max_bytes)
+        for fname, info, old in moves:
+            data = self._read_packed(old)
+            self._on_loop(self._relocate, fname, info, old, data).result()
+            moved += old.length
+        return moved
+
+    def _plan_compaction(self, max_bytes):
+        # Returns (fname, FileInfo, ChunkInfo) of the files to move.
+        for container in list(self._containers.values()):
+            if container is self._open_container or container.pending:
+                continue
+            if any(info.deleted for info in container.files):
+                continue
+            if container.live() >= self._compact_threshold * container.size:
+                continue
+            moves, total = [], 0
+            for info, fname in container.files.items():
+                if total >= max_bytes:
+                    break
+                if info in self._unpacking:
+                    continue
+                moves.append((fname, info, info.chunk_info[0]))
+                total += info.chunk_info[0].length
+            return moves
+        return []
+
+    def _copy_packed(self, old, cinfo, codec):
+        data = self._read_packed(old)
+        for addr in cinfo.replicas:
+            server = self._lookup(addr)
+            if server is None:
+                raise IOError("Unknown chunk server {}".format(addr))
+            server.write_chunk(cinfo.id, data, codec=codec)
+
+    def unpack(self, fname):
+        # Copies a packed file into a chunk of its own, so it can be
+        # appended to like any other. Returns a future for the file's
+        # chunks, resolved once they're set and logged.
+        info = self._get_file_info(fname)
+        if info in self._unpacking:
+            return self._unpacking[info]
+        fut = Future()
+        if not info.packed():
+            fut.set_result(list(info.chunk_info))
+            return fut
+        old = info.chunk_info[0]
+        cinfos, created = self._allocate(1)
+        cinfo = cinfos[0]
+
+        def place():
+            if info.deleted:
+                self._collect_chunks([cinfo])
+                raise IOError("File {} was deleted.".format(fname))
+            self._changing(info)
+            self._untrack(info)
+            info.chunk_info = [cinfo]
+            self._log({
+                "op": "set_chunks",
+                "fname": fname,
+                "chunks": [cinfo.to_hash()]
+            })
+            return [cinfo]
+
+        def done(copied):
+            del self._unpacking[info]
+            if copied.exception() is None:
+                run_into(fut, place)
+                return
+            if created.exception() is None:
+                self._collect_chunks([cinfo])
+            run_into(fut, copied.result)
+
+        # Compaction leaves the file where it is until this is done.
+        self._unpacking[info] = fut
+        copied = chain(created, lambda _: self._offload(
+            cinfo.id,
+            self._copy_packed,
+            old,
+            cinfo,
+            codecs.get(info.compression)
+        ))
+        copied.add_done_callback(done)
+        return fut
+
+    def _relocate(self, fname, info, old, data):
+        # Packs a copy of a file's data and points the file at it. Clients
+        # with the file open find it again when reads of the old location
+        # fail.
+        def place(cinfo):
+            if info.deleted or info.chunk_info[0] is not old:
+                # Deleted or moved meanwhile; the copy's just dead space.
+                return None
+            self._changing(info)
+            self._untrack(info)
+            info.chunk_info = [cinfo]
+            self._track(fname, info)
+            self._log({
+                "op": "set_chunks",
+                "fname": fname,
+                "chunks": [cinfo.to_hash()]
+            })
+            return cinfo
+        return self._pack(data, place)
 
     def get_chunk_info(self, fname,
                        start_idx=-1,
                        end_idx=-1):
-        info = self._get_file_info(fname)
-        start_idx = 0 if start_idx is -1 else start_idx
-        end_idx = len(info.chunk_info) if end_idx is -1 else end_idx
-        return info.chunk_info[start_idx:end_idx]
+        # Files deleted while open stay readable by those who have them open.
+        info = self._open_info(fname)
+        start_idx = 0 if start_idx == -1 else start_idx
+        end_idx = len(info.chunk_info) if end_idx == -1 else end_idx
+        return [self._usable(c) for c in info.chunk_info[start_idx:end_idx]]
+
+    def _usable(self, cinfo):
+        bad = self._bad_replicas.get(cinfo.id)
+        if not bad:
+            return cinfo
+        good = [addr for addr in cinfo.replicas if addr not in bad]
+        if not good:
+            return cinfo
+        return ChunkInfo(
+            id=cinfo.id,
+            replicas=good,
+            offset=cinfo.offset,
+            length=cinfo.length
+        )
 
     def add_chunk_server(self, server):
-        self._chunkservers.append(server)
-        self._chunkserver_dict[server.addr()] = server
+        addr = server.addr()
+        self._chunkservers[addr] = ChunkServerState(server, addr)
+        return addr
+
+    def heartbeat(self, addr, stats):
+        state = self._chunkservers.get(addr)
+        if state is None:
+            raise ValueError("Unknown chunk server {}".format(addr))
+        state.update(stats)
+
+    def report_bad_chunks(self, addr, chunkids):
+        # Corrupt replicas are left out of chunk locations handed to
+        # clients, as long as the chunk has another replica.
+        for chunkid in chunkids:
+            log.warning("Chunk %s is corrupt on %s", chunkid, addr)
+            self._bad_replicas.setdefault(chunkid, set()).add(addr)
+
+    def chunkserver_states(self):
+        return list(self._chunkservers.values())
+
+    def stats(self):
+        now = time.time()
+        return {
+            "files": len(self._file_info),
+            "hidden": len(self._hidden),
+            "containers": len(self._containers),
+            "gc_pending": self._collector.pending(),
+            "chunkservers": [{
+                "addr": "{}:{}".format(*state.addr),
+                "chunks": state.chunks,
+                "free": state.free,
+                "inflight": state.inflight,
+                "last_seen": now - state.last_seen
+            } for state in self.chunkserver_states()]
+        }
 
 class RemoteMaster:
 
+    # Calls are serialized so client threads can share the connection.
+
     def __init__(self, conn):
         self._conn = conn
+        self._lock = threading.Lock()
 
     def _check_error(self, resp):
         if "error" in resp:
             raise IOError(resp["error"])
 
-    def create(self, fname):
-        resp = rpc.call_sync(
-            conn=self._conn,
-            method="create",
-            fname=fname
-        )
+    def _call(self, method, payload=b"", **args):
+        with self._lock:
+            resp, _ = rpc.call_framed(
+                self._conn,
+                method,
+                payload=payload,
+                **args
+            )
         self._check_error(resp)
-        return FileInfo.from_hash(resp)
+        return resp
+
+    def create(self, fname, compression=None):
+        return FileMeta.from_hash(self._call(
+            "create",
+            fname=fname,
+            compression=compression
+        ))
+
+    def write_small(self, fname, data, create=False, close=False,
+                    compression=None):
+        # Packs data as the whole of fname in one call, creating the file
+        # first and closing it after if asked.
+        return FileMeta.from_hash(self._call(
+            "write_small",
+            payload=data,
+            fname=fname,
+            create=create,
+            close=close,
+            compression=compression
+        ))
+
+    def unpack(self, fname):
+        # Gives packed fname a chunk of its own. Returns its chunks.
+        resp = self._call("unpack", fname=fname)
+        return [ChunkInfo.from_hash(h) for h in resp["chunk_info"]]
 
     def delete(self, fname):
-        resp = rpc.call_sync(
-            conn=self._conn,
-            method="delete",
-            fname=fname
-        )
-        self._check_error(resp)
+        self._call("delete", fname=fname)
 
     def open(self, fname):
-        resp = rpc.call_sync(
-            conn=self._conn,
-            method="open",
-            fname=fname
-        )
-        self._check_error(resp)
-        return FileInfo.from_hash(resp)
+        return FileMeta.from_hash(self._call("open", fname=fname))
+
+    def stat(self, fname):
+        return FileMeta.from_hash(self._call("stat", fname=fname))
+
+    def list(self, prefix="", limit=DEFAULT_LIST_LIMIT, cursor=None):
+        resp = self._call("list", prefix=prefix, limit=limit, cursor=cursor)
+        return resp["entries"], resp["cursor"]
 
     def close(self, fname):
-        resp = rpc.call_sync(
-            conn=self._conn,
-            method="close",
-            fname=fname
-        )
-        self._check_error(resp)
+        self._call("close", fname=fname)
 
     def request_new_chunk(self, fname):
-        resp = rpc.call_sync(
-            conn=self._conn,
-            method="request_new_chunk",
-            fname=fname
-        )
-        self._check_error(resp)
+        resp = self._call("request_new_chunk", fname=fname)
         return ChunkInfo.from_hash(resp)
 
-    # def get_chunk_info(self, fname,
-    #                    start_idx=-1,
-    #                    end_idx=-1):
-    #     resp = rpc.call_sync(
-    #         conn=self._conn,
-    #         method="get_chunk_info",
-    #         fname=fname,
-    #         start_idx=start_idx,
-    #         end_idx=end_idx
-    #     )
-    #     self._check_error(resp)
-    #     return
-    #     infos = [ChunkInfo.from_hash(h) for h in resp["info"]]
-    #     return infos
+    def request_new_chunks(self, fname, count):
+        resp = self._call("request_new_chunks", fname=fname, count=count)
+        return [ChunkInfo.from_hash(h) for h in resp["chunk_info"]]
+
+    def get_chunk_info(self, fname,
+                       start_idx=-1,
+                       end_idx=-1):
+        resp = self._call(
+            "get_chunk_info",
+            fname=fname,
+            start_idx=start_idx,
+            end_idx=end_idx
+        )
+        return [ChunkInfo.from_hash(h) for h in resp["chunk_info"]]
 
     def ping(self):
-        resp = rpc.call_sync(self._conn, "ping")
+        resp = self._call("ping")
         assert(resp["status"] == "OK")
 
+    def stats(self):
+        return self._call("stats")
+
     # TODO: Rename.
     def closeconn(self):
         self._conn.close()
 
 def connect(addr):
-    conn = socket.socket()
-    conn.connect(addr)
+    conn = rpc.connect(addr)
     return RemoteMaster(conn)
 
-def _listen(port):
-    l = socket.socket()
-    l.bind(("", port))
-    l.listen(1)
-    return l
+def _register(server, master):
+
+    # Replies to mutations wait until they're durable.
+    def committed(resp):
+        return master.sync().then(lambda _: resp)
+
+    def create(conn, msg, payload):
+        return committed(master.create(
+            msg["fname"],
+            msg.get("compression")
+        ).meta().to_hash())
+
+    def delete(conn, msg, payload):
+        master.delete(msg["fname"])
+        return committed(None)
+
+    # Replies to mutations made off the loop wait for fut, then reply with
+    # fn of its result once that's durable.
+    def committed_later(fut, fn):
+        resp = Future()
+        def done(_):
+            try:
+                result = fn(fut.result())
+            except Exception:
+                resp.set_exception(sys.exc_info())
+                return
+            committed(result).add_done_callback(
+                lambda synced: run_into(resp, synced.result)
+            )
+        fut.add_done_callback(done)
+        return resp
+
+    def write_small(conn, msg, payload):
+        fname = msg["fname"]
+        if msg.get("create"):
+            master.create(fname, msg.get("compression"))
+        try:
+            written = master.write_small(fname, payload)
+        except:
+            if msg.get("create"):
+                master.delete(fname)
+            raise
+        def failed(_):
+            if written.exception() is not None and msg.get("create"):
+                master.delete(fname)
+        def placed(_):
+            meta = master.stat(fname).meta()
+            if msg.get("close"):
+                master.close(fname)
+            return meta.to_hash()
+        written.add_done_callback(failed)
+        return committed_later(written, placed)
+
+    def unpack(conn, msg, payload):
+        return committed_later(master.unpack(msg["fname"]), lambda cinfos: {
+            "chunk_info": [cinfo.to_hash() for cinfo in cinfos]
+        })
+
+    def open(conn, msg, payload):
+        return master.open(msg["fname"]).meta().to_hash()
+
+    def stat(conn, msg, payload):
+        return master.stat(msg["fname"]).meta().to_hash()
+
+    def close(conn, msg, payload):
+        master.close(msg["fname"])
+
+    def request_new_chunk(conn, msg, payload):
+        return committed_later(
+            master.request_new_chunk(msg["fname"]),
+            lambda cinfo: cinfo.to_hash()
+        )
+
+    def request_new_chunks(conn, msg, payload):
+        return committed_later(
+            master.request_new_chunks(msg["fname"], msg["count"]),
+            lambda cinfos: {"chunk_info": [c.to_hash() for c in cinfos]}
+        )
+
+    def get_chunk_info(conn, msg, payload):
+        infos = master.get_chunk_info(
+            msg["fname"],
+            msg.get("start_idx", -1),
+            msg.get("end_idx", -1)
+        )
+        return {"chunk_info": [info.to_hash() for info in infos]}
+
+    def heartbeat(conn, msg, payload):
+        addr = (conn.peer[0], msg["port"])
+        master.heartbeat(addr, msg["stats"])
+        if msg.get("bad_chunks"):
+            master.report_bad_chunks(addr, msg["bad_chunks"])
+
+    def ping(conn, msg, payload):
+        return {"status": "OK"}
+
+    def stats(conn, msg, payload):
+        return dict(master.stats(), rpc=server.metrics.to_hash())
+
+    def list_entries(conn, msg, payload):
+        entries, cursor = master.list(
+            msg.get("prefix", ""),
+            msg.get("limit", DEFAULT_LIST_LIMIT),
+            msg.get("cursor")
+        )
+        return {"entries": entries, "cursor": cursor}
+
+    for handler in (create, delete, write_small, unpack, open, stat, close,
+                    request_new_chunk, request_new_chunks, get_chunk_info,
+                    heartbeat, ping, stats):
+        server.register(handler.__name__, handler)
+    server.register("list", list_entries)
 
 def main():
     import sys
@@ -236,6 +1274,16 @@ def main():
 
     client_port = DEFAULT_MASTER_CLIENT_PORT
     chunk_port = DEFAULT_MASTER_CHUNK_PORT
+    replication = DEFAULT_REPLICATION
+    placement = DEFAULT_PLACEMENT
+    heartbeat_interval = DEFAULT_HEARTBEAT_INTERVAL
+    meta_dir = DEFAULT_MASTER_META_DIR
+    checkpoint_ops = DEFAULT_CHECKPOINT_OPS
+    gc_grace = DEFAULT_GC_GRACE
+    gc_rate = DEFAULT_GC_RATE
+    log_level = DEFAULT_LOG_LEVEL
+    stats_interval = DEFAULT_STATS_INTERVAL
+    compact_threshold = DEFAULT_COMPACT_THRESHOLD
 
     args = sys.argv[1:]
     for idx, arg in enumerate(args):
@@ -243,95 +1291,100 @@ def main():
             client_port = int(args[idx+1])
         elif arg == "--chunk-port" and idx+1 < len(args):
             chunk_port = int(args[idx+1])
+        elif arg == "--replication" and idx+1 < len(args):
+            replication = int(args[idx+1])
+        elif arg == "--placement" and idx+1 < len(args):
+            placement = args[idx+1]
+        elif arg == "--heartbeat-interval" and idx+1 < len(args):
+            heartbeat_interval = float(args[idx+1])
+        elif arg == "--meta-dir" and idx+1 < len(args):
+            meta_dir = args[idx+1]
+        elif arg == "--checkpoint-ops" and idx+1 < len(args):
+            checkpoint_ops = int(args[idx+1])
+        elif arg == "--gc-grace" and idx+1 < len(args):
+            gc_grace = float(args[idx+1])
+        elif arg == "--gc-rate" and idx+1 < len(args):
+            gc_rate = float(args[idx+1])
+        elif arg == "--log-level" and idx+1 < len(args):
+            log_level = args[idx+1].upper()
+        elif arg == "--stats-interval" and idx+1 < len(args):
+            stats_interval = float(args[idx+1])
+        elif arg == "--compact-threshold" and idx+1 < len(args):
+            compact_threshold = float(args[idx+1])
 
-    print("Starting master server.")
+    logging.basicConfig(level=log_level, format=DEFAULT_LOG_FORMAT)
 
-    client_listener = _listen(client_port)
-    print("Listening for clients on port {}".format(client_port))
+    if placement not in PLACEMENTS:
+        log.error("Unrecognized placement %s", placement)
+        sys.exit(1)
 
-    chunk_listener = _listen(chunk_port)
-    print("Listening for chunkservers on port {}".format(chunk_port))
+    log.info("Starting master server.")
 
-    readers = [client_listener, chunk_listener]
-    master = Master(chunkserver_iter=RoundRobinIter())
-    while True:
-        rlist, _, _ = select.select(readers, [], [])
-        for s in rlist:
+    server = Server()
+    master = Master(
+        chunkserver_iter=PLACEMENTS[placement](),
+        replication=replication,
+        heartbeat_timeout=3 * heartbeat_interval,
+        oplog=OpLog(meta_dir),
+        checkpoint_ops=checkpoint_ops,
+        collector=ChunkCollector(
+            lookup=lambda addr: master._lookup(addr),
+            rate=gc_rate
+        ),
+        gc_grace=gc_grace,
+        compact_threshold=compact_threshold,
+        io_pool=WorkerPool(DEFAULT_MASTER_IO_THREADS),
+        call_soon=server.call_soon_threadsafe
+    )
+    log.info("Recovered metadata from %s", meta_dir)
+    master.start_collector()
 
-            if s is client_listener:
-                conn, addr = client_listener.accept()
-                print("Accepted client conn with {}".format(addr))
-                readers.append(conn)
-                continue
+    def accept_chunkserver(conn, addr):
+        log.info("Accepted chunk conn with %s", addr)
+        cserver = RemoteChunkServer(conn)
+        master.add_chunk_server(cserver)
+        cserver.start_heartbeats(client_port, heartbeat_interval)
+        return True
 
-            if s is chunk_listener:
-                conn, addr = chunk_listener.accept()
-                print("Accepted chunk conn with {}".format(addr))
-                cserver = RemoteChunkServer(conn)
-                master.add_chunk_server(cserver)
-                continue
+    server.listen(client_port)
+    log.info("Listening for clients on port %s", client_port)
 
-            msg = rpc.recvmsg(s)
-            if not msg:
-                print("Client {} closed conn.".format(s.getpeername()))
-                s.close()
-                readers.remove(s)
-                continue
+    server.listen(chunk_port, on_accept=accept_chunkserver)
+    log.info("Listening for chunkservers on port %s", chunk_port)
 
-            print("RPC call: {}".format(msg))
-
-            method = msg["method"]
-            resp = {}
-            if method == "create":
-                try:
-                    finfo = master.create(msg["fname"])
-                    resp = finfo.to_hash()
-                except Exception as err:
-                    resp["error"] = str(err)
-            elif method == "delete":
-                try:
-                    master.delete(msg["fname"])
-                except Exception as err:
-                    print(err)
-                    resp["error"] = str(err)
-            elif method == "open":
-                try:
-                    finfo = master.open(msg["fname"])
-                    resp = finfo.to_hash()
-                except Exception as err:
-                    print(err)
-                    resp["error"] = str(err)
-            elif method == "close":
-                try:
-                    master.close(msg["fname"])
-                except Exception as err:
-                    print(err)
-                    resp["error"] = str(err)
-            elif method == "request_new_chunk":
-                try:
-                    cinfo = master.request_new_chunk(msg["fname"])
-                    resp = cinfo.to_hash()
-                except Exception as err:
-                    print(err)
-                    resp["error"] = str(err)
-            elif method == "get_chunk_info":
-                try:
-                    infos = master.get_chunk_info(
-                        msg["fname"],
-                        msg["start_offset"],
-                        msg["end_offset"]
-                    )
-                    resp["chunk_info"] = [info.to_hash() for info in infos]
-                except Exception as err:
-                    print(err)
-                    resp["error"] = str(err)
-            elif method == "ping":
-                resp["status"] = "OK"
-            else:
-                print("Unrecognized RPC call.")
-                resp["error"] = "Unrecognized RPC method {}".format(method)
+    # Hidden files are checked from the server's loop, which owns the
+    # namespace.
+    def expire_hidden():
+        while True:
+            time.sleep(DEFAULT_GC_INTERVAL)
+            server.call_soon_threadsafe(master.collect_garbage)
+    if gc_grace > 0:
+        t = threading.Thread(target=expire_hidden)
+        t.daemon = True
+        t.start()
 
-            rpc.sendmsg(s, resp)
+    # Compaction copies data on its own thread, applying only the moves on
+    # the server's loop.
+    def compact_containers():
+        while True:
+            time.sleep(DEFAULT_COMPACT_INTERVAL)
+            try:
+                master.compact()
+            except (IOError, ValueError, socket.error) as err:
+                log.warning("Compaction failed: %s", err)
+    if compact_threshold > 0:
+        t = threading.Thread(target=compact_containers)
+        t.daemon = True
+        t.start()
+
+    _register(server, master)
+    if stats_interval > 0:
+        start_dump(
+            lambda: dict(master.stats(), rpc=server.metrics.to_hash()),
+            stats_interval,
+            call=server.call_soon_threadsafe
+        )
+    server.serve_forever()
 
 if __name__ == "__main__":
     main()
@@ -0,0 +1,136 @@
+
+import json
+import logging
+import threading
+import time
+
+log = logging.getLogger("metrics")
+
+# Latency bucket upper bounds in seconds: 100us doubling up to about 52s,
+# with a final bucket for anything slower.
+_BOUNDS = [0.0001 * (1 << n) for n in range(20)]
+
+class Histogram:
+
+    def __init__(self, bounds=_BOUNDS):
+        self._bounds = bounds
+        self.counts = [0] * (len(bounds) + 1)
+        self.count = 0
+        self.total = 0.0
+
+    def record(self, value):
+        idx = 0
+        while idx < len(self._bounds) and value > self._bounds[idx]:
+            idx += 1
+        self.counts[idx] += 1
+        self.count += 1
+        self.total += value
+
+    def percentile(self, p):
+        # The upper bound of the bucket holding the p'th percentile, or
+        # None past the last bound.
+        if not self.count:
+            return 0.0
+        rank = p / 100.0 * self.count
+        seen = 0
+        for idx, n in enumerate(self.counts):
+            seen += n
+            if seen >= rank:
+                break
+        return self._bounds[idx] if idx < len(self._bounds) else None
+
+    def to_hash(self):
+        def ms(s):
+            return None if s is None else s * 1000
+        return {
+            "count": self.count,
+            "mean_ms": ms(self.total / self.count) if self.count else 0.0,
+            "p50_ms": ms(self.percentile(50)),
+            "p99_ms": ms(self.percentile(99)),
+            "buckets": [
+                [ms(self._bounds[idx]) if idx < len(self._bounds) else None, n]
+                for idx, n in enumerate(self.counts) if n
+            ]
+        }
+
+class MethodStats:
+
+    def __init__(self):
+        self.calls = 0
+        self.errors = 0
+        self.bytes_in = 0
+        self.bytes_out = 0
+        self.latency = Histogram()
+
+    def to_hash(self):
+        return {
+            "calls": self.calls,
+            "errors": self.errors,
+            "bytes_in": self.bytes_in,
+            "bytes_out": self.bytes_out,
+            "latency": self.latency.to_hash()
+        }
+
+class RpcMetrics:
+
+    # Per-method call, error and payload byte counts and latency histograms,
+    # plus the number of calls in flight. start returns a token that's
+    # handed back to finish once the response is ready.
+
+    def __init__(self):
+        self._methods = {}
+        self._inflight = 0
+        self._lock = threading.Lock()
+
+    def start(self, method, bytes_in):
+        with self._lock:
+            stats = self._methods.get(method)
+            if stats is None:
+                stats = self._methods[method] = MethodStats()
+            stats.calls += 1
+            stats.bytes_in += bytes_in
+            self._inflight += 1
+        return stats, time.time()
+
+    def finish(self, call, bytes_out, error=False):
+        stats, start = call
+        elapsed = time.time() - start
+        with self._lock:
+            stats.bytes_out += bytes_out
+            if error:
+                stats.errors += 1
+            stats.latency.record(elapsed)
+            self._inflight -= 1
+
+    def inflight(self):
+        return self._inflight
+
+    def to_hash(self):
+        with self._lock:
+            return {
+                "inflight": self._inflight,
+                "methods": dict(
+                    (method, stats.to_hash())
+                    for method, stats in self._methods.items()
+                )
+            }
+
+def log_stats(stats):
+    try:
+        log.info("stats %s", json.dumps(stats(), sort_keys=True))
+    except Exception as err:
+        log.warning("Collecting stats failed: %s", err)
+
+def start_dump(stats, interval, call=None):
+    # Logs stats() every interval seconds. call(fn, *args), if given, runs
+    # each dump where the stats are safe to read, e.g. a server's loop.
+    def run():
+        while True:
+            time.sleep(interval)
+            if call is None:
+                log_stats(stats)
+            else:
+                call(log_stats, stats)
+    t = threading.Thread(target=run)
+    t.daemon = True
+    t.start()
@@ -0,0 +1,120 @@
+
+import bisect
+
+# Paths are "/" separated names, relative to the root: "logs/2026/a.log".
+# Directories exist while they hold something. Listings name directories
+# with a trailing "/".
+SEP = "/"
+
+def check(path):
+    if not all(path.split(SEP)):
+        raise ValueError("Invalid path {}".format(path))
+
+class _Dir:
+
+    # children maps a name to its _Dir, or None for a file. names holds the
+    # same names sorted, so listings can start anywhere in O(log n).
+
+    def __init__(self):
+        self.children = {}
+        self.names = []
+
+    def add(self, name, child, sort=True):
+        self.children[name] = child
+        if sort:
+            bisect.insort(self.names, name)
+        else:
+            self.names.append(name)
+
+    def remove(self, name):
+        del self.children[name]
+        del self.names[bisect.bisect_left(self.names, name)]
+
+class NamespaceIndex:
+
+    def __init__(self, paths=()):
+        # Builds the index of paths in one pass, sorting each directory
+        # once at the end. Paths that clash with a directory, which could
+        # be created before there were directories, are left out.
+        self._root = _Dir()
+        for path in paths:
+            try:
+                self._add(path, sort=False)
+            except IOError:
+                pass
+        dirs = [self._root]
+        while dirs:
+            node = dirs.pop()
+            node.names.sort()
+            dirs.extend(c for c in node.children.values() if c is not None)
+
+    def add(self, path):
+        self._add(path, sort=True)
+
+    def _add(self, path, sort):
+        parts = path.split(SEP)
+        node = self._root
+        for idx, name in enumerate(parts[:-1]):
+            child = node.children.get(name, node)
+            if child is None:
+                raise IOError("{} is a file".format(SEP.join(parts[:idx+1])))
+            if child is node:
+                child = _Dir()
+                node.add(name, child, sort)
+            node = child
+        name = parts[-1]
+        if name in node.children:
+            kind = "file" if node.children[name] is None else "directory"
+            raise IOError("{} is a {}".format(path, kind))
+        node.add(name, None, sort)
+
+    def remove(self, path):
+        # Removes a file, and any directories it leaves empty.
+        parts = path.split(SEP)
+        nodes = [self._root]
+        for name in parts[:-1]:
+            child = nodes[-1].children.get(name)
+            if child is None:
+                return
+            nodes.append(child)
+        if parts[-1] not in nodes[-1].children:
+            return
+        nodes[-1].remove(parts[-1])
+        for idx in range(len(nodes) - 1, 0, -1):
+            if nodes[idx].children:
+                break
+            nodes[idx-1].remove(parts[idx-1])
+
+    def _find_dir(self, path):
+        node = self._root
+        for name in path.split(SEP) if path else []:
+            node = node.children.get(name)
+            if node is None:
+                return None
+        return node
+
+    def list(self, prefix, limit, cursor=None):
+        # Returns up to limit entries of the directory prefix names whose
+        # names start with the rest of prefix, in order, after cursor. Also
+        # returns the cursor to continue from, or None if that's all.
+        # Costs O(log n + limit) for a directory of n entries.
+        dirpath, _, start = prefix.rpartition(SEP)
+        node = self._find_dir(dirpath)
+        if node is None:
+            return [], None
+        base = dirpath + SEP if dirpath else ""
+        idx = bisect.bisect_left(node.names, start)
+        if cursor:
+            after = cursor[len(base):].rstrip(SEP)
+            idx = max(idx, bisect.bisect_right(node.names, after))
+
+        entries = []
+        while idx < len(node.names) and len(entries) < limit:
+            name = node.names[idx]
+            if not name.startswith(start):
+                break
+            suffix = "" if node.children[name] is None else SEP
+            entries.append(base + name + suffix)
+            idx += 1
+        more = idx < len(node.names) and node.names[idx].startswith(start)
+        return entries, entries[-1] if more and entries else None
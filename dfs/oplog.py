@@ -0,0 +1,230 @@
+
+import json
+import logging
+import os
+import struct
+import threading
+import zlib
+
+from workers import Future
+
+log = logging.getLogger("oplog")
+
+# Each record is (seq, length, crc32) followed by a JSON encoded op.
+_HEADER = "!QII"
+_HEADER_SIZE = struct.calcsize(_HEADER)
+
+_SEGMENT_PREFIX = "log."
+_CHECKPOINT_PREFIX = "checkpoint."
+
+def _crc(data):
+    return zlib.crc32(data) & 0xffffffff
+
+def _fsync_dir(path):
+    try:
+        fd = os.open(path, os.O_RDONLY)
+    except OSError:
+        return
+    try:
+        os.fsync(fd)
+    except OSError:
+        # Not every platform can sync a directory.
+        pass
+    finally:
+        os.close(fd)
+
+def _numbered(log_dir, prefix):
+    # Returns [(n, path)] for files named prefix + n, sorted by n.
+    found = []
+    for name in os.listdir(log_dir):
+        if not name.startswith(prefix):
+            continue
+        try:
+            n = int(name[len(prefix):])
+        except ValueError:
+            continue
+        found.append((n, os.path.join(log_dir, name)))
+    return sorted(found)
+
+def _read_segment(path):
+    # Yields (seq, op) for each intact record, stopping at a torn or
+    # corrupt tail.
+    with open(path, "rb") as f:
+        data = f.read()
+    pos = 0
+    while pos + _HEADER_SIZE <= len(data):
+        seq, length, crc = struct.unpack_from(_HEADER, data, pos)
+        body = data[pos+_HEADER_SIZE:pos+_HEADER_SIZE+length]
+        if len(body) < length or _crc(body) != crc:
+            return
+        yield seq, json.loads(body.decode("utf-8"))
+        pos += _HEADER_SIZE + length
+
+class OpLog:
+
+    # A write-ahead log of metadata operations split into segments named by
+    # the sequence number of their first record, plus checkpoints named by
+    # the last sequence number they include.
+    #
+    # append writes a record to the current segment without syncing it.
+    # commit returns a future that resolves once everything appended so far
+    # is on disk; a sync thread covers all waiting commits with one fsync.
+    # Segments and checkpoints older than the latest checkpoint are removed
+    # once it is durable.
+
+    def __init__(self, log_dir, fsync=True):
+        if not os.path.isdir(log_dir):
+            os.makedirs(log_dir)
+        self._dir = log_dir
+        self._fsync = fsync
+        self._seq = 0
+        self._synced = 0
+        self._fd = None
+        self._lock = threading.Lock()
+        self._cond = threading.Condition(self._lock)
+        self._sync_lock = threading.Lock()
+        self._waiters = []
+        self._checkpointing = False
+        self.since_checkpoint = 0
+
+    def recover(self):
+        # Returns (checkpoint, ops): the latest checkpoint's contents or None,
+        # and the ops logged after it, in order. Appends go to a fresh
+        # segment afterwards so nothing is written after a torn record.
+        checkpoint, start = None, 0
+        checkpoints = _numbered(self._dir, _CHECKPOINT_PREFIX)
+        if checkpoints:
+            start, path = checkpoints[-1]
+            with open(path, "rb") as f:
+                checkpoint = f.read()
+
+        ops = []
+        self._seq = start
+        for _, path in _numbered(self._dir, _SEGMENT_PREFIX):
+            for seq, op in _read_segment(path):
+                if seq <= self._seq:
+                    continue
+                if seq != self._seq + 1:
+                    break
+                ops.append(op)
+                self._seq = seq
+        self._synced = self._seq
+        self.since_checkpoint = len(ops)
+        for n, path in _numbered(self._dir, _SEGMENT_PREFIX):
+            if n > self._seq:
+                # Holds nothing past the torn record we stopped at.
+                os.remove(path)
+        self._fd = self._open_segment(self._seq + 1)
+        return checkpoint, ops
+
+    def _open_segment(self, first_seq):
+        path = os.path.join(self._dir, _SEGMENT_PREFIX + str(first_seq))
+        flags = os.O_WRONLY | os.O_CREAT | os.O_TRUNC | os.O_APPEND
+        fd = os.open(path, flags, 0o644)
+        _fsync_dir(self._dir)
+        return fd
+
+    def start(self):
+        t = threading.Thread(target=self._sync_loop)
+        t.daemon = True
+        t.start()
+
+    def append(self, op):
+        data = json.dumps(op).encode("utf-8")
+        with self._lock:
+            self._seq += 1
+            os.write(self._fd, struct.pack(
+                _HEADER,
+                self._seq,
+                len(data),
+                _crc(data)
+            ) + data)
+            self.since_checkpoint += 1
+            return self._seq
+
+    def commit(self):
+        fut = Future()
+        with self._lock:
+            if self._synced < self._seq:
+                self._waiters.append((self._seq, fut))
+                self._cond.notify()
+                return fut
+        fut.set_result(None)
+        return fut
+
+    def _sync_loop(self):
+        while True:
+            with self._lock:
+                while not self._waiters:
+                    self._cond.wait()
+            # Rotation syncs the segment it retires under _sync_lock, so
+            # syncing the current one here covers everything up to target.
+            with self._sync_lock:
+                with self._lock:
+                    target = self._seq
+                    fd = self._fd
+                if self._fsync:
+                    os.fsync(fd)
+            with self._lock:
+                self._synced = max(self._synced, target)
+                done = [fut for seq, fut in self._waiters if seq <= target]
+                self._waiters = [
+                    (seq, fut) for seq, fut in self._waiters if seq > target
+                ]
+            for fut in done:
+                fut.set_result(None)
+
+    def checkpointing(self):
+        return self._checkpointing
+
+    def checkpoint(self, encode):
+        # Starts a checkpoint of the state as of the last append. encode()
+        # runs on a background thread and returns the checkpoint's bytes, so
+        # it must only see the state as of now, not what later ops change.
+        with self._sync_lock:
+            with self._lock:
+                if self._checkpointing:
+                    return False
+                self._checkpointing = True
+                seq = self._seq
+                old = self._fd
+                self._fd = self._open_segment(seq + 1)
+                self.since_checkpoint = 0
+            if self._fsync:
+                os.fsync(old)
+            os.close(old)
+        t = threading.Thread(target=self._write_checkpoint, args=(seq, encode))
+        t.daemon = True
+        t.start()
+        return True
+
+    def _write_checkpoint(self, seq, encode):
+        try:
+            path = os.path.join(self._dir, _CHECKPOINT_PREFIX + str(seq))
+            tmp = path + ".tmp"
+            with open(tmp, "wb") as f:
+                f.write(encode())
+                f.flush()
+                os.fsync(f.fileno())
+            os.rename(tmp, path)
+            _fsync_dir(self._dir)
+
+            for n, old in _numbered(self._dir, _CHECKPOINT_PREFIX):
+                if n < seq:
+                    os.remove(old)
+            for n, old in _numbered(self._dir, _SEGMENT_PREFIX):
+                if n <= seq:
+                    os.remove(old)
+        except (IOError, OSError) as err:
+            log.error("Checkpoint %s failed: %s", seq, err)
+        finally:
+            with self._lock:
+                self._checkpointing = False
+
+    def close(self):
+        with self._sync_lock:
+            with self._lock:
+                fd, self._fd = self._fd, None
+            if fd is not None:
+                os.fsync(fd)
+                os.close(fd)
@@ -0,0 +1,105 @@
+
+import contextlib
+import select
+import socket
+import threading
+import time
+
+def _healthy(conn):
+    # An idle connection has no outstanding request, so it should never be
+    # readable. If it is, the peer either closed it or sent garbage.
+    # poll rather than select, which can't take fds past FD_SETSIZE.
+    poller = select.poll()
+    try:
+        poller.register(conn, select.POLLIN)
+        ready = poller.poll(0)
+    except (select.error, socket.error, ValueError):
+        return False
+    return not ready
+
+class ConnectionPool:
+
+    # Holds up to max_per_addr connections to each address, or any number
+    # if it's None. Checkouts past the limit wait for one to come back.
+
+    def __init__(self, connect,
+                 max_per_addr=4,
+                 idle_timeout=60):
+        self._connect = connect
+        self._max_per_addr = max_per_addr
+        self._idle_timeout = idle_timeout
+        self._cond = threading.Condition()
+        self._idle = {}
+        self._nopen = {}
+
+    def _release(self, addr):
+        self._nopen[addr] -= 1
+        self._cond.notify_all()
+
+    def _expire(self):
+        deadline = time.time() - self._idle_timeout
+        for addr, idle in self._idle.items():
+            while idle and idle[0][1] < deadline:
+                conn, _ = idle.pop(0)
+                conn.close()
+                self._release(addr)
+
+    def load(self, addr):
+        # Connections to addr currently checked out.
+        with self._cond:
+            return self._nopen.get(addr, 0) - len(self._idle.get(addr, []))
+
+    def checkout(self, addr):
+        with self._cond:
+            while True:
+                self._expire()
+                idle = self._idle.get(addr, [])
+                while idle:
+                    conn, _ = idle.pop()
+                    if _healthy(conn):
+                        return conn
+                    conn.close()
+                    self._release(addr)
+                nopen = self._nopen.get(addr, 0)
+                if self._max_per_addr is None or nopen < self._max_per_addr:
+                    self._nopen[addr] = nopen + 1
+                    break
+                self._cond.wait()
+        try:
+            return self._connect(addr)
+        except:
+            with self._cond:
+                self._release(addr)
+            raise
+
+    def checkin(self, addr, conn):
+        with self._cond:
+            self._idle.setdefault(addr, []).append((conn, time.time()))
+            self._cond.notify_all()
+
+    def discard(self, addr, conn):
+        conn.close()
+        with self._cond:
+            self._release(addr)
+
+    @contextlib.contextmanager
+    def connection(self, addr):
+        conn = self.checkout(addr)
+        try:
+            yield conn
+        except (IOError, OSError, socket.error):
+            # The stream may be mid-frame, so it can't be reused.
+            self.discard(addr, conn)
+            raise
+        except:
+            self.checkin(addr, conn)
+            raise
+        self.checkin(addr, conn)
+
+    def close(self):
+        with self._cond:
+            for addr, idle in self._idle.items():
+                for conn, _ in idle:
+                    conn.close()
+                    self._nopen[addr] -= 1
+            self._idle = {}
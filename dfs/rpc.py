@@ -1,41 +1,151 @@
 
+import errno
 import json
+import socket
 import struct
 
-def recvn(conn, n):
-    msg = ""
-    while len(msg) < n:
-        r = conn.recv(n - len(msg))
-        if not r:
-            return None
-        msg += r
-    return msg
+from constants import CHUNK_SIZE
+
+# Binary frames carry a small fixed header, JSON metadata and an opaque
+# payload. Bulk data travels in the payload and never goes through JSON.
+_FRAME_MAGIC = 0xDF
+_FRAME_HEADER = struct.Struct("!BIQ")
+# Lengths are checked before anything's allocated for them. Payloads carry
+# at most a chunk's data, plus framing when it's compressed.
+_MAX_META_SIZE = 1 << 22
+_MAX_PAYLOAD_SIZE = CHUNK_SIZE + (1 << 20)
 
-def sendall(conn, msg):
+def recv_into(conn, buf):
+    view = memoryview(buf)
     n = 0
-    l = len(msg)
-    while n < l:
-        n += conn.send(msg[n:])
-
-def sendmsg(conn, msg):
-    msgstr = json.dumps(msg)
-    lenstr = struct.pack("i", len(msgstr))
-    sendall(conn, lenstr)
-    sendall(conn, msgstr)
-
-def recvmsg(conn):
-    lenstr = recvn(conn, 4)
-    if not lenstr:
+    while n < len(buf):
+        r = conn.recv_into(view[n:])
+        if not r:
+            return False
+        n += r
+    return True
+
+def recvn(conn, n):
+    buf = bytearray(n)
+    if not recv_into(conn, buf):
+        return None
+    return buf
+
+def sendv(conn, bufs):
+    bufs = [memoryview(b) for b in bufs if len(b) > 0]
+    if not hasattr(conn, "sendmsg"):
+        for b in bufs:
+            conn.sendall(b)
+        return
+    while bufs:
+        n = conn.sendmsg(bufs)
+        while bufs and n >= len(bufs[0]):
+            n -= len(bufs[0])
+            bufs.pop(0)
+        if n > 0:
+            bufs[0] = bufs[0][n:]
+
+def encode_frame(meta, payload=b""):
+    metastr = json.dumps(meta).encode("utf-8")
+    header = _FRAME_HEADER.pack(_FRAME_MAGIC, len(metastr), len(payload))
+    return [header + metastr, payload]
+
+def connect(addr):
+    conn = socket.socket()
+    conn.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    conn.connect(addr)
+    return conn
+
+def _check_header(header):
+    magic, metalen, paylen = _FRAME_HEADER.unpack_from(header)
+    if magic != _FRAME_MAGIC:
+        raise IOError("Bad frame magic {}".format(magic))
+    if metalen > _MAX_META_SIZE or paylen > _MAX_PAYLOAD_SIZE:
+        raise IOError("Frame too big: {} + {} bytes".format(metalen, paylen))
+    return metalen, paylen
+
+def _decode_meta(buf):
+    # Bad metadata is the sender's fault, so it fails the connection like
+    # any other protocol error rather than whoever's reading it.
+    try:
+        meta = json.loads(buf.decode("utf-8"))
+    except ValueError as err:
+        raise IOError("Bad frame metadata: {}".format(err))
+    if not isinstance(meta, dict):
+        raise IOError("Frame metadata isn't an object")
+    return meta
+
+def sendframe(conn, meta, payload=b""):
+    sendv(conn, encode_frame(meta, payload))
+
+def recvframe(conn):
+    header = recvn(conn, _FRAME_HEADER.size)
+    if not header:
         return None
-    msglen = struct.unpack("i", lenstr)[0]
-    msgstr = recvn(conn, msglen)
-    if not msgstr:
+    metalen, paylen = _check_header(header)
+    metastr = recvn(conn, metalen)
+    if metastr is None:
         return None
-    msg = json.loads(msgstr)
-    return msg
+    payload = bytearray(paylen)
+    if not recv_into(conn, payload):
+        return None
+    return _decode_meta(metastr), payload
 
-def call_sync(conn, method, **args):
+def call_framed(conn, method, payload=b"", **args):
     args["method"] = method
-    sendmsg(conn, args)
-    resp = recvmsg(conn)
-    return resp
+    sendframe(conn, args, payload)
+    frame = recvframe(conn)
+    if frame is None:
+        raise IOError("Connection closed during call to {}".format(method))
+    return frame
+
+class FrameReader:
+
+    # Incrementally parses frames from a non-blocking socket. Each part of a
+    # frame is received straight into a buffer preallocated for its length.
+
+    def __init__(self):
+        self._start()
+
+    def _start(self):
+        self._buf = bytearray(_FRAME_HEADER.size)
+        self._pos = 0
+        self._metalen = None
+        self._meta = None
+
+    def _advance(self):
+        if self._metalen is None:
+            self._metalen, paylen = _check_header(self._buf)
+            self._paylen = paylen
+            self._buf = bytearray(self._metalen)
+        elif self._meta is None:
+            self._meta = _decode_meta(self._buf)
+            self._buf = bytearray(self._paylen)
+        else:
+            frame = (self._meta, self._buf)
+            self._start()
+            return frame
+        self._pos = 0
+        return None
+
+    def recv(self, conn, budget):
+        # Returns the frames completed by reading at most about budget
+        # bytes, and whether the peer closed the connection.
+        frames = []
+        nread = 0
+        while nread < budget:
+            try:
+                n = conn.recv_into(memoryview(self._buf)[self._pos:])
+            except socket.error as err:
+                if err.errno in (errno.EAGAIN, errno.EWOULDBLOCK):
+                    break
+                raise
+            if n == 0:
+                return frames, True
+            self._pos += n
+            nread += n
+            while self._pos == len(self._buf):
+                frame = self._advance()
+                if frame:
+                    frames.append(frame)
+        return frames, False
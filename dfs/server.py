@@ -0,0 +1,301 @@
+
+import collections
+import errno
+import itertools
+import logging
+import select
+import socket
+
+import rpc
+from metrics import RpcMetrics
+from workers import Future
+
+log = logging.getLogger("server")
+
+# Bytes read from one connection before moving on to the next, so a large
+# upload can't starve other clients.
+_READ_BUDGET = 1 << 20
+# Requests a connection may have outstanding before we stop reading from it.
+_MAX_PENDING = 64
+
+if hasattr(select, "epoll"):
+    _IN, _OUT = select.EPOLLIN, select.EPOLLOUT
+    _ERR = select.EPOLLERR | select.EPOLLHUP
+
+    class _Poller:
+
+        def __init__(self):
+            self._epoll = select.epoll()
+
+        def register(self, fd, events):
+            self._epoll.register(fd, events)
+
+        def modify(self, fd, events):
+            self._epoll.modify(fd, events)
+
+        def unregister(self, fd):
+            self._epoll.unregister(fd)
+
+        def poll(self, timeout):
+            return self._epoll.poll(-1 if timeout is None else timeout)
+else:
+    _IN, _OUT = select.POLLIN, select.POLLOUT
+    _ERR = select.POLLERR | select.POLLHUP
+
+    class _Poller:
+
+        def __init__(self):
+            self._poll = select.poll()
+
+        def register(self, fd, events):
+            self._poll.register(fd, events)
+
+        def modify(self, fd, events):
+            self._poll.modify(fd, events)
+
+        def unregister(self, fd):
+            self._poll.unregister(fd)
+
+        def poll(self, timeout):
+            return self._poll.poll(None if timeout is None else timeout * 1000)
+
+def _would_block(err):
+    return err.errno in (errno.EAGAIN, errno.EWOULDBLOCK)
+
+class Connection:
+
+    def __init__(self, server, sock):
+        sock.setblocking(False)
+        self.sock = sock
+        self.peer = sock.getpeername()
+        self.closed = False
+        self._server = server
+        self._reader = rpc.FrameReader()
+        self._pending = collections.deque()
+        self._out = collections.deque()
+        self._events = 0
+
+    def fileno(self):
+        return self.sock.fileno()
+
+    def _interest(self):
+        events = 0
+        if len(self._pending) < _MAX_PENDING:
+            events |= _IN
+        if self._out:
+            events |= _OUT
+        return events
+
+    def _update_interest(self):
+        events = self._interest()
+        if events != self._events:
+            self._server._poller.modify(self.fileno(), events)
+            self._events = events
+
+    def _on_readable(self):
+        frames, eof = self._reader.recv(self.sock, _READ_BUDGET)
+        for meta, payload in frames:
+            slot = [False, None, b""]
+            self._pending.append(slot)
+            self._server._dispatch(self, slot, meta, payload)
+        if eof:
+            self.close()
+        elif not self.closed:
+            self._update_interest()
+
+    def _complete(self, slot, resp, payload):
+        # Responses go out in request order even if handlers finish out of
+        # order.
+        if self.closed:
+            return
+        slot[0], slot[1], slot[2] = True, resp, payload
+        while self._pending and self._pending[0][0]:
+            _, resp, payload = self._pending.popleft()
+            self._out.extend(
+                memoryview(b) for b in rpc.encode_frame(resp, payload)
+                if len(b) > 0
+            )
+        self._on_writable()
+
+    def _on_writable(self):
+        while self._out:
+            try:
+                if hasattr(self.sock, "sendmsg"):
+                    n = self.sock.sendmsg(list(itertools.islice(self._out, 64)))
+                else:
+                    n = self.sock.send(self._out[0])
+            except socket.error as err:
+                if _would_block(err):
+                    break
+                raise
+            while n > 0:
+                head = self._out[0]
+                if n < len(head):
+                    self._out[0] = head[n:]
+                    break
+                n -= len(head)
+                self._out.popleft()
+        self._update_interest()
+
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        self._server._remove(self)
+        self.sock.close()
+
+class Server:
+
+    # An event loop serving framed RPCs. Handlers are looked up by method
+    # name and called as handler(conn, msg, payload). They return a response
+    # dict, a (response, payload) tuple or a workers.Future resolving to
+    # either; exceptions become {"error": ...} responses. Every call is
+    # counted in metrics.
+
+    def __init__(self):
+        self.metrics = RpcMetrics()
+        self._poller = _Poller()
+        self._handlers = {}
+        self._listeners = {}
+        self._conns = {}
+        self._callbacks = collections.deque()
+        self._wakeup_r, self._wakeup_w = socket.socketpair()
+        self._wakeup_r.setblocking(False)
+        self._wakeup_w.setblocking(False)
+        self._poller.register(self._wakeup_r.fileno(), _IN)
+
+    def register(self, method, handler):
+        self._handlers[method] = handler
+
+    def listen(self, port, on_accept=None):
+        # on_accept(sock, addr) may take ownership of an accepted socket
+        # by returning True; otherwise it's served as an RPC connection.
+        l = socket.socket()
+        l.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        l.bind(("", port))
+        l.listen(128)
+        l.setblocking(False)
+        self._listeners[l.fileno()] = (l, on_accept)
+        self._poller.register(l.fileno(), _IN)
+        return l
+
+    def add_connection(self, sock):
+        conn = Connection(self, sock)
+        self._conns[conn.fileno()] = conn
+        conn._events = conn._interest()
+        self._poller.register(conn.fileno(), conn._events)
+        return conn
+
+    def _remove(self, conn):
+        log.debug("Client %s closed conn.", conn.peer)
+        del self._conns[conn.fileno()]
+        self._poller.unregister(conn.fileno())
+
+    def call_soon_threadsafe(self, fn, *args):
+        self._callbacks.append((fn, args))
+        try:
+            self._wakeup_w.send(b"x")
+        except socket.error as err:
+            # A full wakeup pipe already guarantees a wakeup.
+            if not _would_block(err):
+                raise
+
+    def _dispatch(self, conn, slot, msg, payload):
+        method = msg.get("method")
+        log.debug("RPC call to method %s from %s", method, conn.peer)
+        handler = self._handlers.get(method)
+        if handler is None:
+            # Unknown names share one entry so clients can't grow the table.
+            call = self.metrics.start("<unknown>", len(payload))
+            self._respond(conn, slot, call, {
+                "error": "Unrecognized RPC method {}".format(method)
+            })
+            return
+        call = self.metrics.start(method, len(payload))
+        try:
+            result = handler(conn, msg, payload)
+        except Exception as err:
+            log.debug("RPC call to method %s failed: %s", method, err)
+            self._respond(conn, slot, call, {"error": str(err)})
+            return
+        if not isinstance(result, Future):
+            self._respond(conn, slot, call, result)
+            return
+
+        def done(fut):
+            try:
+                resp = fut.result()
+            except Exception as err:
+                log.debug("RPC call to method %s failed: %s", method, err)
+                resp = {"error": str(err)}
+            self.call_soon_threadsafe(self._respond, conn, slot, call, resp)
+        result.add_done_callback(done)
+
+    def _respond(self, conn, slot, call, result):
+        if isinstance(result, tuple):
+            resp, payload = result
+        else:
+            resp, payload = result, b""
+        resp = resp or {}
+        self.metrics.finish(call, len(payload), "error" in resp)
+        try:
+            conn._complete(slot, resp, payload)
+        except socket.error as err:
+            log.warning("Responding to %s failed: %s", conn.peer, err)
+            conn.close()
+
+    def _accept(self, listener, on_accept):
+        while True:
+            try:
+                sock, addr = listener.accept()
+            except socket.error as err:
+                if _would_block(err):
+                    return
+                raise
+            log.debug("Accepted conn with %s", addr)
+            sock.setblocking(True)
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            if on_accept and on_accept(sock, addr):
+                continue
+            self.add_connection(sock)
+
+    def _run_callbacks(self):
+        try:
+            while self._wakeup_r.recv(4096):
+                pass
+        except socket.error as err:
+            if not _would_block(err):
+                raise
+        while self._callbacks:
+            fn, args = self._callbacks.popleft()
+            fn(*args)
+
+    def poll_once(self, timeout=None):
+        try:
+            ready = self._poller.poll(timeout)
+        except (IOError, select.error) as err:
+            if err.args[0] == errno.EINTR:
+                return
+            raise
+        for fd, events in ready:
+            if fd == self._wakeup_r.fileno():
+                self._run_callbacks()
+                continue
+            if fd in self._listeners:
+                self._accept(*self._listeners[fd])
+                continue
+            conn = self._conns.get(fd)
+            if conn is None:
+                continue
+            try:
+                if events & (_IN | _ERR):
+                    conn._on_readable()
+                if not conn.closed and events & _OUT:
+                    conn._on_writable()
+            except (IOError, socket.error) as err:
+                log.warning("Connection with %s failed: %s", conn.peer, err)
+                conn.close()
+
+    def serve_forever(self):
+        while True:
+            self.poll_once()
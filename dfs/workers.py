@@ -0,0 +1,233 @@
+
+import collections
+import sys
+import threading
+
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+class Future:
+
+    def __init__(self):
+        self._cond = threading.Condition()
+        self._done = False
+        self._result = None
+        self._exc_info = None
+        self._callbacks = []
+
+    def _finish(self):
+        with self._cond:
+            self._done = True
+            self._cond.notify_all()
+            callbacks, self._callbacks = self._callbacks, []
+        for fn in callbacks:
+            fn(self)
+
+    def set_result(self, result):
+        self._result = result
+        self._finish()
+
+    def set_exception(self, exc_info):
+        self._exc_info = exc_info
+        self._finish()
+
+    def done(self):
+        with self._cond:
+            return self._done
+
+    def add_done_callback(self, fn):
+        with self._cond:
+            if not self._done:
+                self._callbacks.append(fn)
+                return
+        fn(self)
+
+    def exception(self):
+        self.wait()
+        return self._exc_info[1] if self._exc_info else None
+
+    def wait(self, timeout=None):
+        with self._cond:
+            if timeout is None:
+                while not self._done:
+                    self._cond.wait()
+            elif not self._done:
+                self._cond.wait(timeout)
+            return self._done
+
+    def result(self, timeout=None):
+        if not self.wait(timeout):
+            raise RuntimeError("Timed out waiting for result.")
+        if self._exc_info:
+            raise self._exc_info[1]
+        return self._result
+
+    def then(self, fn):
+        # Returns a future for fn applied to this future's result.
+        fut = Future()
+        def done(_):
+            if self._exc_info:
+                fut.set_exception(self._exc_info)
+            else:
+                run_into(fut, fn, self._result)
+        self.add_done_callback(done)
+        return fut
+
+def gather(futs):
+    # Returns a future for the list of results of futs, failing with the
+    # first error once all of them are done.
+    out = Future()
+    remaining = [len(futs)]
+    lock = threading.Lock()
+    def done(_):
+        with lock:
+            remaining[0] -= 1
+            if remaining[0] > 0:
+                return
+        for fut in futs:
+            if fut._exc_info:
+                out.set_exception(fut._exc_info)
+                return
+        out.set_result([fut._result for fut in futs])
+    if not futs:
+        out.set_result([])
+    for fut in futs:
+        fut.add_done_callback(done)
+    return out
+
+def chain(fut, fn):
+    # Like fut.then(fn), for an fn that returns a future: the result
+    # resolves with the one fn returns.
+    out = Future()
+    def done(_):
+        if fut._exc_info:
+            out.set_exception(fut._exc_info)
+            return
+        try:
+            inner = fn(fut._result)
+        except Exception:
+            out.set_exception(sys.exc_info())
+            return
+        inner.add_done_callback(lambda _: run_into(out, inner.result))
+    fut.add_done_callback(done)
+    return out
+
+def run_into(fut, fn, *args, **kwargs):
+    try:
+        result = fn(*args, **kwargs)
+    except Exception:
+        fut.set_exception(sys.exc_info())
+        return
+    fut.set_result(result)
+
+class WorkerPool:
+
+    # Runs tasks on a fixed set of threads. Tasks submitted with the same
+    # key through submit_keyed run one at a time in submission order, while
+    # tasks with different keys run in parallel.
+
+    def __init__(self, nthreads):
+        self._queue = queue.Queue()
+        self._lock = threading.Lock()
+        self._keyed = {}
+        self._inflight = 0
+        self._threads = []
+        for _ in range(nthreads):
+            t = threading.Thread(target=self._run)
+            t.daemon = True
+            t.start()
+            self._threads.append(t)
+
+    def _run(self):
+        while True:
+            task = self._queue.get()
+            if task is None:
+                return
+            task()
+
+    def _track(self, fn):
+        # Counts fn as in flight until it returns, before its future is
+        # resolved.
+        with self._lock:
+            self._inflight += 1
+        def tracked(*args, **kwargs):
+            try:
+                return fn(*args, **kwargs)
+            finally:
+                with self._lock:
+                    self._inflight -= 1
+        return tracked
+
+    def inflight(self):
+        # Tasks submitted but not yet finished, queued or running.
+        return self._inflight
+
+    def submit(self, fn, *args, **kwargs):
+        fut = Future()
+        fn = self._track(fn)
+        self._queue.put(lambda: run_into(fut, fn, *args, **kwargs))
+        return fut
+
+    def _run_keyed(self, key, task):
+        task()
+        with self._lock:
+            tasks = self._keyed[key]
+            if not tasks:
+                del self._keyed[key]
+                return
+            task = tasks.popleft()
+        self._queue.put(lambda: self._run_keyed(key, task))
+
+    def submit_keyed(self, key, fn, *args, **kwargs):
+        fut = Future()
+        fn = self._track(fn)
+        task = lambda: run_into(fut, fn, *args, **kwargs)
+        with self._lock:
+            if key in self._keyed:
+                self._keyed[key].append(task)
+                return fut
+            self._keyed[key] = collections.deque()
+        self._queue.put(lambda: self._run_keyed(key, task))
+        return fut
+
+    def shutdown(self):
+        for _ in self._threads:
+            self._queue.put(None)
+        for t in self._threads:
+            t.join()
+
+class KeyedThreads:
+
+    # Runs tasks with the same key one at a time in submission order, on a
+    # thread started for the key while it has tasks queued. Meant for tasks
+    # that wait on other servers, which a fixed pool could fill up with
+    # while those servers wait on it in turn.
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._keyed = {}
+
+    def _run(self, key, task):
+        while True:
+            task()
+            with self._lock:
+                tasks = self._keyed[key]
+                if not tasks:
+                    del self._keyed[key]
+                    return
+                task = tasks.popleft()
+
+    def submit_keyed(self, key, fn, *args, **kwargs):
+        fut = Future()
+        task = lambda: run_into(fut, fn, *args, **kwargs)
+        with self._lock:
+            if key in self._keyed:
+                self._keyed[key].append(task)
+                return fut
+            self._keyed[key] = collections.deque()
+        t = threading.Thread(target=self._run, args=(key, task))
+        t.daemon = True
+        t.start()
+        return fut
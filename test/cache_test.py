@@ -0,0 +1,55 @@
+
+import setup
+import unittest
+
+from cache import BlockCache
+
+class TestBlockCache(unittest.TestCase):
+
+    def test_get_miss(self):
+        c = BlockCache(capacity=10)
+        self.assertEquals(c.get(("c1", 0, 4)), None)
+        self.assertEquals(c.stats()["misses"], 1)
+
+    def test_add_get(self):
+        c = BlockCache(capacity=10)
+        c.add(("c1", 0, 4), b"abcd")
+        self.assertEquals(c.get(("c1", 0, 4)), b"abcd")
+        self.assertEquals(c.stats()["hits"], 1)
+
+    def test_evicts_lru(self):
+        c = BlockCache(capacity=8)
+        c.add(("c1", 0, 4), b"abcd")
+        c.add(("c1", 4, 8), b"efgh")
+        _ = c.get(("c1", 0, 4))
+        c.add(("c2", 0, 4), b"ijkl")
+        self.assertEquals(c.get(("c1", 4, 8)), None)
+        self.assertEquals(c.get(("c1", 0, 4)), b"abcd")
+        stats = c.stats()
+        self.assertEquals(stats["evictions"], 1)
+        self.assertEquals(stats["size"], 8)
+
+    def test_oversized_block_not_cached(self):
+        c = BlockCache(capacity=2)
+        c.add(("c1", 0, 4), b"abcd")
+        self.assertEquals(c.get(("c1", 0, 4)), None)
+
+    def test_invalidate_range(self):
+        c = BlockCache(capacity=100)
+        c.add(("c1", 0, 4), b"abcd")
+        c.add(("c1", 4, 8), b"ef")
+        c.add(("c2", 4, 8), b"ef")
+        c.invalidate("c1", 6, 10)
+        self.assertEquals(c.get(("c1", 0, 4)), b"abcd")
+        self.assertEquals(c.get(("c1", 4, 8)), None)
+        self.assertEquals(c.get(("c2", 4, 8)), b"ef")
+
+    def test_invalidate_chunk(self):
+        c = BlockCache(capacity=100)
+        c.add(("c1", 0, 4), b"abcd")
+        c.add(("c1", 4, 8), b"efgh")
+        c.invalidate("c1")
+        self.assertEquals(c.stats()["blocks"], 0)
+
+if __name__ == "__main__":
+    unittest.main()
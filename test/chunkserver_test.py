@@ -1,10 +1,33 @@
 
 import setup
+import socket
+import threading
 import unittest
 
-from chunkserver import ChunkServer
+import chunkserver
+from chunkserver import ChainForwarder, ChunkServer, Scrubber
+from pool import ConnectionPool
+from server import Server
+from constants import CHUNK_SIZE, CHECKSUM_BLOCK_SIZE
+from workers import WorkerPool
+import rpc
+import checksum
+import compression
 import env
 
+B = CHECKSUM_BLOCK_SIZE
+
+def corrupt(e, fname, offset):
+    fd = e.open(fname, "r+")
+    e.writeat(fd, offset, b"X")
+    e.close(fd)
+
+def stored_crcs(e, chunkid):
+    fd = e.open(chunkid + ".crc", "r")
+    crcs = checksum.unpack(e.readall(fd))
+    e.close(fd)
+    return crcs
+
 class TestChunkServer(unittest.TestCase):
 
     def test_create_chunk(self):
@@ -13,6 +36,17 @@ class TestChunkServer(unittest.TestCase):
         cs.write_chunk("c1", b"12345")
         _ = cs.read_chunk("c1")
 
+    def test_create_chunks(self):
+        cs = ChunkServer(env=env.MemEnv())
+        cs.create_chunks(["c1", "c2"])
+        self.assertEquals(cs.chunk_size("c1"), 0)
+        self.assertEquals(cs.chunk_size("c2"), 0)
+
+    def test_stats(self):
+        cs = ChunkServer(env=env.MemEnv())
+        cs.create_chunks(["c1", "c2"])
+        self.assertEquals(cs.stats()["chunks"], 2)
+
     def test_delete_chunk(self):
         cs = ChunkServer(env=env.MemEnv())
         cs.create_chunk("c1")
@@ -20,6 +54,12 @@ class TestChunkServer(unittest.TestCase):
         with self.assertRaises(IOError):
             _ = cs.read_chunk("c1")
 
+    def test_delete_chunks(self):
+        cs = ChunkServer(env=env.MemEnv())
+        cs.create_chunks(["c1", "c2"])
+        cs.delete_chunks(["c1", "c3", "c2"])
+        self.assertEquals(cs.stats()["chunks"], 0)
+
     def test_delete_chunk_DNE(self):
         cs = ChunkServer(env=env.MemEnv())
         with self.assertRaises(IOError):
@@ -45,10 +85,306 @@ class TestChunkServer(unittest.TestCase):
         )
         self.assertEquals(res, msg[1:3])
 
+    def test_read_chunk_range_past_end(self):
+        cs = ChunkServer(env=env.MemEnv())
+        cs.create_chunk("c1")
+        msg = b"123456789"
+        cs.write_chunk("c1", msg)
+        res = cs.read_chunk(
+            chunkid="c1",
+            start_offset=4,
+            end_offset=100
+        )
+        self.assertEquals(res, msg[4:])
+
     def test_write_chunk_DNE(self):
         cs = ChunkServer(env=env.MemEnv())
         with self.assertRaises(IOError):
             cs.write_chunk("c1", b"12345")
 
+    def test_append_chunk(self):
+        cs = ChunkServer(env=env.MemEnv())
+        cs.create_chunk("c1")
+        cs.write_chunk("c1", b"12345")
+        size = cs.append_chunk("c1", b"678")
+        self.assertEquals(size, 8)
+        self.assertEquals(cs.read_chunk("c1"), b"12345678")
+        self.assertEquals(cs.chunk_size("c1"), 8)
+
+    def test_append_chunk_too_large(self):
+        cs = ChunkServer(env=env.MemEnv())
+        cs.create_chunk("c1")
+        cs.write_chunk("c1", b"12345")
+        with self.assertRaises(ValueError):
+            cs.append_chunk("c1", b"x" * (CHUNK_SIZE - 4))
+
+    def test_write_chunk_at(self):
+        cs = ChunkServer(env=env.MemEnv())
+        cs.create_chunk("c1")
+        cs.write_chunk("c1", b"12345")
+        size = cs.write_chunk_at("c1", 3, b"abc")
+        self.assertEquals(size, 6)
+        self.assertEquals(cs.read_chunk("c1"), b"123abc")
+
+    def test_write_chunk_at_past_end(self):
+        cs = ChunkServer(env=env.MemEnv())
+        cs.create_chunk("c1")
+        with self.assertRaises(ValueError):
+            cs.write_chunk_at("c1", 1, b"abc")
+
+class TestChecksums(unittest.TestCase):
+
+    def expected(self, data):
+        return [checksum.crc32(data, start, min(start + B, len(data)))
+                for start in range(0, len(data), B)]
+
+    def test_incremental(self):
+        e = env.MemEnv()
+        cs = ChunkServer(env=e)
+        cs.create_chunk("c1")
+        data = bytearray(n % 251 for n in range(3 * B + 100))
+        for start in range(0, len(data), 1000):
+            cs.append_chunk("c1", data[start:start+1000])
+        self.assertEquals(stored_crcs(e, "c1"), self.expected(data))
+
+        data[B - 10:B + 10] = b"y" * 20
+        cs.write_chunk_at("c1", B - 10, b"y" * 20)
+        self.assertEquals(stored_crcs(e, "c1"), self.expected(data))
+
+        cs.write_chunk("c1", b"short")
+        self.assertEquals(stored_crcs(e, "c1"), self.expected(b"short"))
+
+    def test_corrupt_read(self):
+        e = env.MemEnv()
+        cs = ChunkServer(env=e)
+        cs.create_chunk("c1")
+        cs.write_chunk("c1", b"a" * (3 * B))
+        corrupt(e, "c1", 2 * B + 5)
+        self.assertEquals(cs.read_chunk("c1", 0, 2 * B), b"a" * (2 * B))
+        self.assertEquals(cs.read_chunk("c1", 10, 20), b"a" * 10)
+        self.assertEquals(cs.take_bad_chunks(), [])
+        with self.assertRaises(IOError):
+            cs.read_chunk("c1", 2 * B + 1, 2 * B + 2)
+        with self.assertRaises(IOError):
+            cs.read_chunk("c1")
+        self.assertEquals(cs.take_bad_chunks(), ["c1"])
+        self.assertEquals(cs.take_bad_chunks(), [])
+
+    def test_missing_sidecar(self):
+        e = env.MemEnv()
+        cs = ChunkServer(env=e)
+        cs.create_chunk("c1")
+        cs.write_chunk("c1", b"abc")
+        e.remove("c1.crc")
+        self.assertEquals(cs.read_chunk("c1"), b"abc")
+        self.assertEquals(cs.append_chunk("c1", b"de"), 5)
+        self.assertEquals(stored_crcs(e, "c1"), self.expected(b"abcde"))
+
+    def test_chunk_ids(self):
+        cs = ChunkServer(env=env.MemEnv())
+        cs.create_chunks(["c1", "c2"])
+        self.assertEquals(sorted(cs.chunk_ids()), ["c1", "c2"])
+        cs.delete_chunk("c1")
+        self.assertEquals(cs.chunk_ids(), ["c2"])
+
+    def test_scrub(self):
+        e = env.MemEnv()
+        cs = ChunkServer(env=e)
+        cs.create_chunks(["c1", "c2"])
+        cs.write_chunk("c1", b"a" * 100)
+        cs.write_chunk("c2", b"b" * 100)
+        corrupt(e, "c2", 50)
+        pool = WorkerPool(1)
+        self.assertEquals(Scrubber(cs, pool, cold_after=60).scrub(), 0)
+        self.assertEquals(Scrubber(cs, pool, cold_after=0).scrub(), 100)
+        self.assertEquals(cs.take_bad_chunks(), ["c2"])
+        pool.shutdown()
+
+class TestCompressedChunks(unittest.TestCase):
+
+    def setUp(self):
+        self.env = env.MemEnv()
+        self.cs = ChunkServer(env=self.env)
+        self.cs.create_chunk("c1")
+        self.codec = compression.get("zlib")
+
+    def frames(self, data):
+        return compression.encode(self.codec, data, block_size=1000)
+
+    def read(self, start, end):
+        raw, frames = self.cs.read_frames("c1", start, end)
+        data = compression.decode(self.codec, frames)
+        return data[start-raw:end-raw]
+
+    def test_write_read(self):
+        data = bytearray(n % 7 for n in range(10000))
+        size = self.cs.write_chunk_at("c1", 0, self.frames(data), framed=True)
+        self.assertEquals(size, 10000)
+        self.assertEquals(self.cs.chunk_size("c1", framed=True), 10000)
+        self.assertTrue(self.cs.chunk_size("c1") < 10000)
+        self.assertEquals(self.read(2500, 4100), data[2500:4100])
+        raw, frames = self.cs.read_frames("c1", 2500, 2600)
+        self.assertEquals(raw, 2000)
+        self.assertEquals(len(list(compression.frames(frames))), 1)
+
+    def test_append(self):
+        self.cs.write_chunk("c1", self.frames(b"a" * 1500), framed=True)
+        self.assertEquals(
+            self.cs.append_chunk("c1", self.frames(b"b" * 500), framed=True),
+            2000
+        )
+        with self.assertRaises(ValueError):
+            self.cs.write_chunk_at("c1", 1000, self.frames(b"c"), framed=True)
+        self.assertEquals(self.read(1400, 1600), b"a" * 100 + b"b" * 100)
+
+    def test_reindex(self):
+        self.cs.write_chunk("c1", self.frames(b"a" * 2500), framed=True)
+        cs = ChunkServer(env=self.env)
+        self.assertEquals(cs.chunk_size("c1", framed=True), 2500)
+
+    def test_torn_frame(self):
+        self.cs.write_chunk("c1", self.frames(b"a" * 1000), framed=True)
+        fd = self.env.open("c1", "r+")
+        self.env.writeat(fd, self.env.size(fd), self.frames(b"b" * 1000)[:-1])
+        self.env.close(fd)
+
+        cs = ChunkServer(env=self.env)
+        self.assertEquals(cs.chunk_size("c1", framed=True), 1000)
+        cs.append_chunk("c1", self.frames(b"c" * 1000), framed=True)
+        self.cs = cs
+        self.assertEquals(self.read(0, 2000), b"a" * 1000 + b"c" * 1000)
+        self.assertEquals(cs.verify_chunk("c1"), cs.chunk_size("c1"))
+
+class TestChainForwarder(unittest.TestCase):
+
+    def peer(self, nbatch, fail=(), hangup=False):
+        # A replica that reads nbatch requests before answering any of
+        # them, failing those whose offset is in fail, or hanging up.
+        listener = socket.socket()
+        listener.bind(("127.0.0.1", 0))
+        listener.listen(1)
+        def serve():
+            conn, _ = listener.accept()
+            msgs = [rpc.recvframe(conn)[0] for _ in range(nbatch)]
+            if hangup:
+                conn.close()
+                return
+            for msg in msgs:
+                if msg["offset"] in fail:
+                    rpc.sendframe(conn, {"error": "bad"})
+                else:
+                    rpc.sendframe(conn, {"size": msg["offset"] + 1})
+        t = threading.Thread(target=serve)
+        t.daemon = True
+        t.start()
+        return listener.getsockname()
+
+    def forward(self, forwarder, addr, offset):
+        return forwarder.forward({
+            "method": "write_chunk_at",
+            "chunkid": "c",
+            "offset": offset,
+            "chain": [addr]
+        }, b"x")
+
+    def test_pipelines(self):
+        addr = self.peer(3, fail=(1,))
+        forwarder = ChainForwarder(
+            ConnectionPool(connect=chunkserver.connect),
+            window=3
+        )
+        futs = [self.forward(forwarder, addr, n) for n in range(3)]
+        self.assertEquals(futs[0].result(5)["size"], 1)
+        self.assertTrue(isinstance(futs[1].exception(), ValueError))
+        self.assertEquals(futs[2].result(5)["size"], 3)
+
+    def test_connection_lost(self):
+        addr = self.peer(2, hangup=True)
+        forwarder = ChainForwarder(
+            ConnectionPool(connect=chunkserver.connect),
+            window=3
+        )
+        futs = [self.forward(forwarder, addr, n) for n in range(2)]
+        for fut in futs:
+            self.assertTrue(fut.wait(5))
+            self.assertTrue(isinstance(fut.exception(), IOError))
+
+class TestReplication(unittest.TestCase):
+
+    # Chunkservers on loopback, each with a single I/O thread, so a worker
+    # held up forwarding would stall the chain behind it.
+
+    def setUp(self):
+        self.running = True
+        self.addrs = []
+        self.threads = []
+        for _ in range(2):
+            server = Server()
+            port = server.listen(0).getsockname()[1]
+            chunkserver._register(
+                server,
+                ChunkServer(env=env.MemEnv()),
+                port,
+                WorkerPool(1)
+            )
+            t = threading.Thread(target=self.serve, args=(server,))
+            t.daemon = True
+            t.start()
+            self.addrs.append(("127.0.0.1", port))
+            self.threads.append(t)
+
+    def tearDown(self):
+        self.running = False
+        for t in self.threads:
+            t.join()
+
+    def serve(self, server):
+        while self.running:
+            server.poll_once(0.01)
+
+    def test_opposite_chains(self):
+        data = b"x" * (1 << 20)
+        errors = []
+
+        for addr in self.addrs:
+            chunkserver.connect(addr).create_chunks(
+                ["c{}-{}".format(n, idx) for n in range(2) for idx in range(4)]
+            )
+
+        def upload(n, first, second):
+            try:
+                cs = chunkserver.connect(first)
+                for idx in range(4):
+                    cs.write_chunk_pipelined(
+                        "c{}-{}".format(n, idx),
+                        0,
+                        data,
+                        chain=[second],
+                        piece_size=1 << 16
+                    )
+            except Exception as err:
+                errors.append(err)
+
+        a, b = self.addrs
+        uploads = [
+            threading.Thread(target=upload, args=(0, a, b)),
+            threading.Thread(target=upload, args=(1, b, a))
+        ]
+        for t in uploads:
+            t.daemon = True
+            t.start()
+        for t in uploads:
+            t.join(10)
+            self.assertFalse(t.is_alive())
+        self.assertEquals(errors, [])
+        for addr in self.addrs:
+            cs = chunkserver.connect(addr)
+            for n in range(2):
+                for idx in range(4):
+                    self.assertEquals(
+                        cs.chunk_size("c{}-{}".format(n, idx)),
+                        len(data)
+                    )
+
 if __name__ == "__main__":
     unittest.main()
@@ -0,0 +1,337 @@
+import setup
+import contextlib
+import threading
+import time
+import unittest
+
+import client
+from client import ChunkLocations, Client
+from master import ChunkInfo, FileMeta
+
+class CountingMaster:
+
+    def __init__(self, nchunks):
+        self.chunks = [ChunkInfo(str(n), [("localhost", n)])
+                       for n in range(nchunks)]
+        self.calls = []
+
+    def get_chunk_info(self, fname, start_idx=-1, end_idx=-1):
+        self.calls.append((start_idx, end_idx))
+        return self.chunks[start_idx:end_idx]
+
+class TestChunkLocations(unittest.TestCase):
+
+    def test_fetches_pages(self):
+        m = CountingMaster(5)
+        locs = ChunkLocations(m, "a.txt", 5, page_size=2)
+        self.assertEquals(len(locs), 5)
+        self.assertEquals(locs.get(3).id, "3")
+        self.assertEquals(locs.get(2).id, "2")
+        self.assertEquals(locs.last().id, "4")
+        self.assertEquals(m.calls, [(2, 4), (4, 5)])
+
+    def test_append(self):
+        m = CountingMaster(1)
+        locs = ChunkLocations(m, "a.txt", 1, page_size=2)
+        locs.append(ChunkInfo("new", []))
+        self.assertEquals(len(locs), 2)
+        self.assertEquals(locs.last().id, "new")
+        self.assertEquals(locs.get(0).id, "0")
+        self.assertEquals(locs.get(1).id, "new")
+
+    def test_invalidate(self):
+        m = CountingMaster(3)
+        locs = ChunkLocations(m, "a.txt", 3, page_size=2)
+        locs.get(0)
+        m.chunks[1] = ChunkInfo("moved", [])
+        self.assertEquals(locs.get(1).id, "1")
+        locs.invalidate(1)
+        self.assertEquals(locs.get(1).id, "moved")
+        self.assertEquals(m.calls, [(0, 2), (0, 2)])
+
+    def test_known(self):
+        m = CountingMaster(1)
+        packed = ChunkInfo("c", [], offset=10, length=5)
+        locs = ChunkLocations(m, "a.txt", 1, page_size=2, known={0: packed})
+        self.assertEquals(locs.get(0).offset, 10)
+        self.assertEquals(m.calls, [])
+        locs.invalidate(0)
+        self.assertEquals(locs.get(0).id, "0")
+
+    def test_missing_chunk(self):
+        locs = ChunkLocations(CountingMaster(1), "a.txt", 2, page_size=4)
+        with self.assertRaises(IOError):
+            locs.get(1)
+
+class FakeChunkServer:
+
+    # Chunks in memory, with a log of the reads and writes made. fail maps
+    # chunk ids to the error writes to them raise. Writes take delay
+    # seconds, and the most ever in progress at once is kept.
+
+    def __init__(self):
+        self.chunks = {}
+        self.reads = []
+        self.writes = []
+        self.fail = {}
+        self.delay = 0
+        self.inflight = 0
+        self.max_inflight = 0
+        self._lock = threading.Lock()
+
+    def create(self, chunkid):
+        self.chunks[chunkid] = bytearray()
+
+    def read_chunk(self, chunkid, start_offset=-1, end_offset=-1, codec=None):
+        with self._lock:
+            self.reads.append((chunkid, start_offset, end_offset))
+        return bytes(self.chunks[chunkid][start_offset:end_offset])
+
+    def write_chunk_pipelined(self, chunkid, offset, data, chain=(),
+                              codec=None):
+        with self._lock:
+            self.writes.append((chunkid, offset, len(data)))
+            self.inflight += 1
+            self.max_inflight = max(self.max_inflight, self.inflight)
+        try:
+            time.sleep(self.delay)
+        finally:
+            with self._lock:
+                self.inflight -= 1
+        if chunkid in self.fail:
+            raise self.fail[chunkid]
+        chunk = self.chunks[chunkid]
+        chunk[offset:offset+len(data)] = bytearray(data)
+        return len(chunk)
+
+    def chunk_size(self, chunkid, framed=False):
+        return len(self.chunks[chunkid])
+
+class FakePool:
+
+    def __init__(self, server):
+        self.server = server
+
+    def load(self, addr):
+        return 0
+
+    @contextlib.contextmanager
+    def connection(self, addr):
+        yield self.server
+
+    def close(self):
+        pass
+
+class FakeMaster:
+
+    # One chunkserver holding every chunk.
+
+    def __init__(self, server):
+        self.server = server
+        self.files = {}
+        self.closed = []
+
+    def create(self, fname, compression=None):
+        self.files[fname] = []
+        return FileMeta(0)
+
+    def open(self, fname):
+        cinfos = self.files[fname]
+        packed = cinfos[0] if cinfos and cinfos[0].packed() else None
+        return FileMeta(len(cinfos), packed=packed)
+
+    def close(self, fname):
+        self.closed.append(fname)
+
+    def write_small(self, fname, data, create=False, close=False,
+                    compression=None):
+        # Every file goes in one container.
+        self.server.chunks.setdefault("pack", bytearray())
+        container = self.server.chunks["pack"]
+        cinfo = ChunkInfo("pack", [("fake", 1)], len(container), len(data))
+        container += data
+        self.files[fname] = [cinfo]
+        if close:
+            self.close(fname)
+        return FileMeta(1, packed=cinfo)
+
+    def unpack(self, fname):
+        old = self.files[fname][0]
+        if old.packed():
+            cinfo = ChunkInfo(fname + "-0", [("fake", 1)])
+            self.server.chunks[cinfo.id] = \
+                self.server.chunks["pack"][old.offset:old.offset+old.length]
+            self.files[fname] = [cinfo]
+        return list(self.files[fname])
+
+    def request_new_chunks(self, fname, count):
+        cinfos = []
+        for _ in range(count):
+            cinfo = ChunkInfo(
+                "{}-{}".format(fname, len(self.files[fname])),
+                [("fake", 1)]
+            )
+            self.server.create(cinfo.id)
+            self.files[fname].append(cinfo)
+            cinfos.append(cinfo)
+        return cinfos
+
+    def request_new_chunk(self, fname):
+        return self.request_new_chunks(fname, 1)[0]
+
+    def get_chunk_info(self, fname, start_idx=-1, end_idx=-1):
+        return self.files[fname][start_idx:end_idx]
+
+    def closeconn(self):
+        pass
+
+class TestFile(unittest.TestCase):
+
+    # Chunks are shrunk to a few blocks so files can span several.
+
+    def setUp(self):
+        self.chunk_size = client.CHUNK_SIZE
+        client.CHUNK_SIZE = 1024
+        self.server = FakeChunkServer()
+        self.master = FakeMaster(self.server)
+
+    def tearDown(self):
+        client.CHUNK_SIZE = self.chunk_size
+
+    def connect(self, **kwargs):
+        kwargs.setdefault("block_size", 256)
+        kwargs.setdefault("small_file_size", 0)
+        cl = Client(self.master, **kwargs)
+        cl._pool = FakePool(self.server)
+        self.addCleanup(cl.close)
+        return cl
+
+    def test_write_buffers(self):
+        f = self.connect(write_buffer_size=100).create("a")
+        f.write(b"a" * 60)
+        self.assertEquals(self.server.writes, [])
+        f.write(b"b" * 50)
+        self.assertEquals(self.server.writes, [("a-0", 0, 110)])
+        f.write(b"c" * 10)
+        f.write(b"d" * 200)
+        self.assertEquals(self.server.writes[1:], [
+            ("a-0", 110, 10),
+            ("a-0", 120, 200)
+        ])
+        f.write(b"e")
+        f.flush()
+        f.flush()
+        self.assertEquals(self.server.writes[3:], [("a-0", 320, 1)])
+        f.write(b"f")
+        f.close()
+        self.assertEquals(self.server.writes[4:], [("a-0", 321, 1)])
+        self.assertEquals(self.master.closed, ["a"])
+        self.assertEquals(
+            bytes(self.server.chunks["a-0"]),
+            b"a" * 60 + b"b" * 50 + b"c" * 10 + b"d" * 200 + b"ef"
+        )
+
+    def test_close_raises_write_error(self):
+        f = self.connect().create("a")
+        f.write(b"x" * 2000)
+        f.flush()
+        self.server.fail["a-1"] = IOError("disk full")
+        f.write(b"y")
+        with self.assertRaises(IOError):
+            f.close()
+        self.assertEquals(self.master.closed, ["a"])
+
+    def test_upload_window(self):
+        self.server.delay = 0.02
+        f = self.connect(write_window=2).create("a")
+        f.write(b"x" * 5 * 1024)
+        f.flush()
+        self.assertEquals(len(self.server.writes), 5)
+        self.assertEquals(self.server.max_inflight, 2)
+        for n in range(5):
+            self.assertEquals(len(self.server.chunks["a-{}".format(n)]), 1024)
+
+    def test_upload_raises_first_error(self):
+        self.server.delay = 0.01
+        self.server.fail["a-1"] = IOError("first")
+        self.server.fail["a-3"] = IOError("second")
+        f = self.connect(write_window=2).create("a")
+        f.write(b"x" * 5 * 1024)
+        with self.assertRaises(IOError) as ctx:
+            f.flush()
+        self.assertEquals(str(ctx.exception), "first")
+        # The chunks allocated are all still known.
+        self.assertEquals(len(f._chunks), 5)
+
+    def test_append_to_packed(self):
+        cl = self.connect(small_file_size=64)
+        f = cl.create("a")
+        f.write(b"first\n")
+        f.close()
+        self.assertTrue(self.master.files["a"][0].packed())
+        f = cl.open("a")
+        f.write(b"x" * 2000)
+        f.close()
+        self.assertFalse(self.master.files["a"][0].packed())
+        self.assertEquals(len(self.master.files["a"]), 2)
+        f = cl.open("a")
+        self.assertEquals(f.read(3000), b"first\n" + b"x" * 2000)
+
+    def test_read_across_chunks(self):
+        data = bytes(bytearray(n % 251 for n in range(1324)))
+        cl = self.connect(readahead_max=0)
+        f = cl.create("a")
+        f.write(data)
+        f.close()
+        f = cl.open("a")
+        f.seek(1000)
+        self.assertEquals(f.read(1000), data[1000:])
+        self.assertEquals(f.tell(), 1324)
+        self.assertEquals(f.read(10), b"")
+        f.seek(200)
+        self.assertEquals(f.read(900), data[200:1100])
+        f.seek(5000)
+        self.assertEquals(f.read(10), b"")
+
+    def test_read_stops_at_eof(self):
+        cl = self.connect(readahead_max=0)
+        f = cl.create("a")
+        f.write(b"x" * 1100)
+        f.close()
+        f = cl.open("a")
+        f.seek(1000)
+        self.assertEquals(f.read(1 << 20), b"x" * 100)
+        # The rest of the first chunk, and the second chunk's first block.
+        self.assertEquals(self.server.reads, [
+            ("a-0", 768, 1024),
+            ("a-1", 0, 256)
+        ])
+
+    def wait_prefetch(self, cl):
+        while cl._readahead_pool.inflight():
+            time.sleep(0.001)
+
+    def test_readahead(self):
+        cl = self.connect(readahead_max=4)
+        f = cl.create("a")
+        f.write(b"x" * 4096)
+        f.close()
+        f = cl.open("a")
+        windows = []
+        for _ in range(4):
+            f.read(256)
+            windows.append(f._readahead_window)
+        self.assertEquals(windows, [1, 2, 4, 4])
+        self.wait_prefetch(cl)
+        # Blocks 4 to 7, the next chunk, were fetched ahead of the reader.
+        self.assertTrue(("a-1", 768, 1024) in self.server.reads)
+
+        f.seek(3000)
+        nreads = len(self.server.reads)
+        f.read(256)
+        self.assertEquals(f._readahead_window, 0)
+        self.wait_prefetch(cl)
+        self.assertEquals(len(self.server.reads), nreads + 2)
+
+if __name__ == "__main__":
+    unittest.main()
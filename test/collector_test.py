@@ -0,0 +1,71 @@
+import setup
+import unittest
+
+from collector import ChunkCollector
+
+class FakeServer:
+
+    def __init__(self, fail=0):
+        self.deleted = []
+        self.fail = fail
+
+    def delete_chunks(self, chunkids):
+        if self.fail > 0:
+            self.fail -= 1
+            raise IOError("down")
+        self.deleted.append(list(chunkids))
+
+class TestChunkCollector(unittest.TestCase):
+
+    def test_batches(self):
+        s = FakeServer()
+        c = ChunkCollector(lookup=lambda addr: s, batch_size=2)
+        c.add("a", ["1", "2", "3"])
+        self.assertEquals(c.pending(), 3)
+        self.assertEquals(c.collect(), 2)
+        self.assertEquals(c.collect(), 1)
+        self.assertEquals(c.collect(), None)
+        self.assertEquals(s.deleted, [["1", "2"], ["3"]])
+
+    def test_round_robin(self):
+        servers = {"a": FakeServer(), "b": FakeServer()}
+        c = ChunkCollector(lookup=servers.get, batch_size=1)
+        c.add("a", ["1", "2"])
+        c.add("b", ["3"])
+        c.collect()
+        c.collect()
+        self.assertEquals(servers["b"].deleted, [["3"]])
+
+    def test_retry(self):
+        s = FakeServer(fail=1)
+        c = ChunkCollector(lookup=lambda addr: s, retry_interval=0)
+        c.add("a", ["1", "2"])
+        self.assertEquals(c.collect(), 0)
+        self.assertEquals(c.pending(), 2)
+        self.assertEquals(c.collect(), 2)
+        self.assertEquals(s.deleted, [["1", "2"]])
+
+    def test_unknown_server_waits(self):
+        c = ChunkCollector(lookup=lambda addr: None, retry_interval=60)
+        c.add("a", ["1"])
+        self.assertEquals(c.collect(), 0)
+        self.assertEquals(c.collect(), None)
+        self.assertEquals(c.pending(), 1)
+
+    def test_pending_chunks(self):
+        seen = []
+        class Snooping(FakeServer):
+            def delete_chunks(self, chunkids):
+                seen.append(c.pending_chunks())
+                FakeServer.delete_chunks(self, chunkids)
+        c = ChunkCollector(lookup=lambda addr: Snooping(), batch_size=1)
+        c.add("a", ["1", "2"])
+        c.add("b", ["3"])
+        self.assertEquals(c.pending_chunks(), {"a": ["1", "2"], "b": ["3"]})
+        c.collect()
+        # The batch being sent still counts.
+        self.assertEquals(seen, [{"a": ["2", "1"], "b": ["3"]}])
+        self.assertEquals(c.pending_chunks(), {"a": ["2"], "b": ["3"]})
+
+if __name__ == "__main__":
+    unittest.main()
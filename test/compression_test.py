@@ -0,0 +1,38 @@
+import setup
+import os
+import unittest
+
+import compression
+
+class TestCompression(unittest.TestCase):
+
+    def setUp(self):
+        self.codec = compression.get("zlib")
+
+    def test_round_trip(self):
+        data = b"log line\n" * 20000
+        encoded = compression.encode(self.codec, data, block_size=1000)
+        self.assertTrue(len(encoded) < len(data) // 5)
+        self.assertEquals(compression.decode(self.codec, encoded), data)
+        frames = list(compression.frames(encoded))
+        self.assertEquals(len(frames), 180)
+        self.assertEquals(sum(raw for raw, _ in frames), len(data))
+
+    def test_incompressible(self):
+        data = os.urandom(3000)
+        encoded = compression.encode(self.codec, data, block_size=1000)
+        self.assertEquals(len(encoded), len(data) + 3 * compression.HEADER.size)
+        self.assertEquals(compression.decode(self.codec, encoded), data)
+
+    def test_truncated(self):
+        encoded = compression.encode(self.codec, b"x" * 100)
+        with self.assertRaises(ValueError):
+            list(compression.frames(encoded[:-1]))
+
+    def test_unknown(self):
+        self.assertEquals(compression.get(None), None)
+        with self.assertRaises(ValueError):
+            compression.get("nope")
+
+if __name__ == "__main__":
+    unittest.main()
@@ -1,5 +1,7 @@
 
 import setup
+import shutil
+import tempfile
 import unittest
 
 import env
@@ -35,18 +37,18 @@ class TestMemEnv(unittest.TestCase):
     def test_seek(self):
         e = env.MemEnv()
         fd = e.open("a.txt", "w+")
-        msg = "abcdefg"
+        msg = b"abcdefg"
         e.write(fd, msg)
         e.close(fd)
         fd = e.open("a.txt", "r")
         e.seek(fd, 2)
         buf = e.read(fd, 1)
-        self.assertEquals(buf, msg[2])
+        self.assertEquals(buf, msg[2:3])
 
     def test_read_write(self):
         e = env.MemEnv()
         fd = e.open("a.txt", "w+")
-        msg = "abcdefg"
+        msg = b"abcdefg"
         e.write(fd, msg)
         e.close(fd)
         fd = e.open("a.txt", "r")
@@ -57,17 +59,17 @@ class TestMemEnv(unittest.TestCase):
     def test_read_chunks(self):
         e = env.MemEnv()
         fd = e.open("a.txt", "w+")
-        msg = "abcdefg"
+        msg = b"abcdefg"
         e.write(fd, msg)
         e.close(fd)
         fd = e.open("a.txt", "r")
-        buf = "".join([e.read(fd, 1) for _ in range(len(msg))])
+        buf = b"".join([e.read(fd, 1) for _ in range(len(msg))])
         self.assertEquals(buf, msg)
 
     def test_readall(self):
         e = env.MemEnv()
         fd = e.open("a.txt", "w+")
-        msg = "abcdefg"
+        msg = b"abcdefg"
         e.write(fd, msg)
         e.close(fd)
         fd = e.open("a.txt", "r")
@@ -77,7 +79,7 @@ class TestMemEnv(unittest.TestCase):
     def test_readrange(self):
         e = env.MemEnv()
         fd = e.open("a.txt", "w+")
-        msg = "abcdefg"
+        msg = b"abcdefg"
         e.write(fd, msg)
         e.close(fd)
         fd = e.open("a.txt", "r")
@@ -87,13 +89,155 @@ class TestMemEnv(unittest.TestCase):
     def test_readrange_moves_offset(self):
         e = env.MemEnv()
         fd = e.open("a.txt", "w+")
-        msg = "abcdefg"
+        msg = b"abcdefg"
         e.write(fd, msg)
         e.close(fd)
         fd = e.open("a.txt", "r")
         _ = e.readrange(fd, start_offset=1, end_offset=2)
         buf = e.read(fd, 1)
-        self.assertEquals(buf, msg[2])
+        self.assertEquals(buf, msg[2:3])
+
+    def test_writeat(self):
+        e = env.MemEnv()
+        fd = e.open("a.txt", "w+")
+        e.write(fd, b"abcdefg")
+        e.writeat(fd, 5, b"xyz")
+        self.assertEquals(e.size(fd), 8)
+        buf = e.readrange(fd, start_offset=0, end_offset=8)
+        self.assertEquals(buf, b"abcdexyz")
+
+    def test_truncate(self):
+        e = env.MemEnv()
+        fd = e.open("a.txt", "w+")
+        e.write(fd, b"abcdefg")
+        e.truncate(fd, 2)
+        self.assertEquals(e.size(fd), 2)
+        self.assertEquals(e.readall(fd), b"")
+
+    def test_write_overwrites(self):
+        e = env.MemEnv()
+        fd = e.open("a.txt", "w+")
+        e.write(fd, b"abcdefg")
+        e.seek(fd, 2)
+        e.write(fd, b"XY")
+        self.assertEquals(e.readrange(fd, start_offset=0, end_offset=7), b"abXYefg")
+
+    def test_close_keeps_descriptors(self):
+        e = env.MemEnv()
+        fa = e.open("a.txt", "w+")
+        fb = e.open("b.txt", "w+")
+        e.write(fb, b"b")
+        e.close(fa)
+        self.assertEquals(e.readrange(fb, start_offset=0, end_offset=1), b"b")
+        fc = e.open("c.txt", "w+")
+        self.assertEquals(fc, fa)
+
+    def test_remove_open_file(self):
+        e = env.MemEnv()
+        fd = e.open("a.txt", "w+")
+        e.write(fd, b"abc")
+        e.remove("a.txt")
+        self.assertEquals(e.readrange(fd, start_offset=0, end_offset=3), b"abc")
+        with self.assertRaises(IOError):
+            e.open("a.txt", "r")
+
+class TestPosixEnv(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def init_env(self, **kwargs):
+        return env.PosixEnv(data_dir=self.dir, **kwargs)
+
+    def test_open_non_existent(self):
+        e = self.init_env()
+        with self.assertRaises(IOError):
+            e.open("a.txt", "r")
+
+    def test_read_write(self):
+        e = self.init_env()
+        fd = e.open("a.txt", "w+")
+        msg = b"abcdefg"
+        e.write(fd, msg)
+        e.close(fd)
+        fd = e.open("a.txt", "r")
+        self.assertEquals(e.read(fd, len(msg)), msg)
+        self.assertEquals(e.read(fd, 1), b"")
+        e.close(fd)
+
+    def test_readrange(self):
+        e = self.init_env()
+        fd = e.open("a.txt", "w+")
+        e.write(fd, b"abcdefg")
+        self.assertEquals(e.readrange(fd, start_offset=1, end_offset=3), b"bc")
+        self.assertEquals(e.readrange(fd, start_offset=5, end_offset=30), b"fg")
+
+    def test_writeat_remaps(self):
+        e = self.init_env()
+        fd = e.open("a.txt", "w+")
+        e.write(fd, b"abc")
+        self.assertEquals(e.readall(fd), b"")
+        self.assertEquals(e.readrange(fd, start_offset=0, end_offset=3), b"abc")
+        e.writeat(fd, 3, b"def")
+        self.assertEquals(e.size(fd), 6)
+        self.assertEquals(e.readrange(fd, start_offset=0, end_offset=6), b"abcdef")
+
+    def test_truncate(self):
+        e = self.init_env()
+        fd = e.open("a.txt", "w+")
+        e.write(fd, b"abcdefg")
+        e.truncate(fd, 2)
+        self.assertEquals(e.size(fd), 2)
+        self.assertEquals(e.readrange(fd, start_offset=0, end_offset=7), b"ab")
+
+    def test_read_survives_truncate(self):
+        e = self.init_env()
+        fd = e.open("a.txt", "w+")
+        e.write(fd, b"x" * 8192)
+        data = e.readrange(fd, start_offset=4096, end_offset=8192)
+        e.truncate(fd, 0)
+        e.write(fd, b"y" * 8192)
+        self.assertEquals(bytes(data), b"x" * 4096)
+
+    def test_remove(self):
+        e = self.init_env()
+        e.close(e.open("a.txt", "w+"))
+        e.remove("a.txt")
+        with self.assertRaises(IOError):
+            e.open("a.txt", "r")
+        with self.assertRaises(IOError):
+            e.remove("a.txt")
+
+    def test_persists(self):
+        for policy in ("always", "batch", "none"):
+            e = self.init_env(fsync=policy)
+            fd = e.open(policy, "w+")
+            e.write(fd, b"abc")
+            e.close(fd)
+            e.sync()
+            e = self.init_env()
+            fd = e.open(policy, "r")
+            self.assertEquals(e.readall(fd), b"abc")
+
+    def test_max_open(self):
+        e = self.init_env(max_open=1)
+        for name in ("a", "b", "c"):
+            fd = e.open(name, "w+")
+            e.write(fd, name.encode("ascii"))
+            e.close(fd)
+        fd = e.open("a", "r")
+        self.assertEquals(e.readall(fd), b"a")
+
+    def test_listdir(self):
+        e = self.init_env()
+        for name in ("a", "b"):
+            e.close(e.open(name, "w+"))
+        e.remove("a")
+        self.assertEquals(e.listdir(), ["b"])
+        self.assertTrue(e.free_space() > 0)
 
 if __name__ == "__main__":
     unittest.main()
@@ -1,30 +1,587 @@
 
 import setup
+import shutil
+import tempfile
+import threading
+import time
 import unittest
 
-from chunk_server import ChunkServer
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+import compression
+from chunkserver import ChunkServer
 from env import MemEnv
-from master import Master, RoundRobinIter
+from constants import CHUNK_SIZE, MAX_SMALL_FILE_SIZE
+from oplog import OpLog
+from workers import WorkerPool
+from master import (Master, RoundRobinIter, LeastLoadedPlacement,
+                    CapacityWeightedPlacement, RandomOfTwoPlacement)
+
+class LocalChunkServer(ChunkServer):
+
+    def __init__(self, port):
+        ChunkServer.__init__(self, env=MemEnv())
+        self._port = port
 
-def init_master():
-    itr = RoundRobinIter()
+    def addr(self):
+        return ("localhost", self._port)
+
+    # Takes data the way RemoteChunkServer does.
+    def write_chunk(self, chunkid, data, codec=None):
+        if codec is None:
+            return ChunkServer.write_chunk(self, chunkid, data)
+        data = compression.encode(codec, data)
+        return ChunkServer.write_chunk(self, chunkid, data, framed=True)
+
+def init_master(itr=None, **kwargs):
+    itr = itr or RoundRobinIter()
     cservers = [
-        ChunkServer(env=MemEnv()),
-        ChunkServer(env=MemEnv()),
-        ChunkServer(env=MemEnv())
+        LocalChunkServer(1),
+        LocalChunkServer(2),
+        LocalChunkServer(3)
     ]
     m = Master(
-        chunk_server_iter=itr,
-        chunk_servers=cservers
+        chunkserver_iter=itr,
+        chunkservers=cservers,
+        **kwargs
     )
-    return m
+    return m, cservers
+
+def run_posted(posted, fut):
+    # Runs what's posted back from the I/O pool until fut resolves.
+    while not fut.done():
+        fn, args = posted.get(timeout=5)
+        fn(*args)
+
+def drain(m):
+    while m._collector.collect():
+        pass
 
 class TestMaster(unittest.TestCase):
 
     def test_create(self):
-        m = init_master()
+        m, _ = init_master()
         finfo = m.create("a.txt")
         self.assertEquals(len(finfo.chunk_info), 0)
 
+    def test_request_new_chunk_replicated(self):
+        m, cservers = init_master(replication=2)
+        m.create("a.txt")
+        cinfo = m.request_new_chunk("a.txt").result()
+        self.assertEquals(len(cinfo.replicas), 2)
+        self.assertEquals(len(set(cinfo.replicas)), 2)
+        for cserver in cservers:
+            if cserver.addr() in cinfo.replicas:
+                self.assertEquals(cserver.chunk_size(cinfo.id), 0)
+
+    def test_replication_capped_by_servers(self):
+        m, _ = init_master(replication=5)
+        m.create("a.txt")
+        cinfo = m.request_new_chunk("a.txt").result()
+        self.assertEquals(len(cinfo.replicas), 3)
+
+    def test_allocate_failure(self):
+        posted = queue.Queue()
+        m, cservers = init_master(
+            replication=2,
+            io_pool=WorkerPool(2),
+            call_soon=lambda fn, *args: posted.put((fn, args))
+        )
+        def fail(chunkids):
+            raise IOError("disk full")
+        cservers[1].create_chunks = fail
+        m.create("a.txt")
+        fut = m.request_new_chunks("a.txt", 2)
+        run_posted(posted, fut)
+        with self.assertRaises(IOError):
+            fut.result()
+        self.assertEquals(m.get_chunk_info("a.txt"), [])
+        drain(m)
+        for cserver in cservers:
+            self.assertEquals(cserver.chunk_ids(), [])
+        for state in m.chunkserver_states():
+            self.assertEquals(state.chunks, 0)
+
+    def test_request_new_chunks(self):
+        m, cservers = init_master(replication=2)
+        m.create("a.txt")
+        cinfos = m.request_new_chunks("a.txt", 3).result()
+        self.assertEquals(len(set(cinfo.id for cinfo in cinfos)), 3)
+        self.assertEquals(
+            [cinfo.id for cinfo in m.get_chunk_info("a.txt")],
+            [cinfo.id for cinfo in cinfos]
+        )
+        for cinfo in cinfos:
+            self.assertEquals(len(set(cinfo.replicas)), 2)
+            for cserver in cservers:
+                if cserver.addr() in cinfo.replicas:
+                    self.assertEquals(cserver.chunk_size(cinfo.id), 0)
+
+    def test_request_new_chunks_caches_addrs(self):
+        m, cservers = init_master()
+        calls = []
+        for cserver in cservers:
+            cserver.addr = lambda addr=cserver.addr(): calls.append(addr) or addr
+        m.create("a.txt")
+        m.request_new_chunks("a.txt", 4).result()
+        self.assertEquals(calls, [])
+
+    def test_delete_removes_replicas(self):
+        m, cservers = init_master(replication=3)
+        m.create("a.txt")
+        cinfo = m.request_new_chunk("a.txt").result()
+        m.delete("a.txt")
+        with self.assertRaises(IOError):
+            m.open("a.txt")
+        m.create("a.txt")
+        drain(m)
+        for cserver in cservers:
+            with self.assertRaises(IOError):
+                cserver.chunk_size(cinfo.id)
+
+    def test_delete_while_open(self):
+        m, cservers = init_master(replication=1)
+        m.create("a.txt")
+        cinfo = m.request_new_chunk("a.txt").result()
+        m.open("a.txt")
+        m.delete("a.txt")
+        drain(m)
+        cserver = cservers[cinfo.replicas[0][1] - 1]
+        self.assertEquals(cserver.chunk_size(cinfo.id), 0)
+        m.close("a.txt")
+        drain(m)
+        with self.assertRaises(IOError):
+            cserver.chunk_size(cinfo.id)
+
+    def test_delete_grace(self):
+        m, cservers = init_master(replication=1, gc_grace=60)
+        m.create("a.txt")
+        cinfo = m.request_new_chunk("a.txt").result()
+        m.delete("a.txt")
+        m.collect_garbage()
+        drain(m)
+        cserver = cservers[cinfo.replicas[0][1] - 1]
+        self.assertEquals(cserver.chunk_size(cinfo.id), 0)
+        m._hidden["a.txt"][0].deleted_at -= 60
+        m.collect_garbage()
+        drain(m)
+        with self.assertRaises(IOError):
+            cserver.chunk_size(cinfo.id)
+        self.assertEquals(m._hidden, {})
+
+    def test_get_chunk_info_pages(self):
+        m, _ = init_master()
+        m.create("a.txt")
+        cinfos = m.request_new_chunks("a.txt", 5).result()
+        ids = [c.id for c in cinfos]
+        self.assertEquals([c.id for c in m.get_chunk_info("a.txt", 1, 3)],
+                          ids[1:3])
+        self.assertEquals([c.id for c in m.get_chunk_info("a.txt", 4, 10)],
+                          ids[4:])
+        self.assertEquals(m.stat("a.txt").meta().nchunks, 5)
+
+    def test_get_chunk_info_deleted_open(self):
+        m, _ = init_master()
+        m.create("a.txt")
+        m.request_new_chunk("a.txt").result()
+        m.open("a.txt")
+        m.delete("a.txt")
+        self.assertEquals(len(m.get_chunk_info("a.txt")), 1)
+        with self.assertRaises(IOError):
+            m.stat("a.txt")
+
+    def test_bad_replicas_hidden(self):
+        m, _ = init_master(replication=2)
+        m.create("a.txt")
+        cinfo = m.request_new_chunk("a.txt").result()
+        bad, good = cinfo.replicas
+        m.report_bad_chunks(bad, [cinfo.id])
+        self.assertEquals(m.get_chunk_info("a.txt")[0].replicas, [good])
+        m.report_bad_chunks(good, [cinfo.id])
+        self.assertEquals(len(m.get_chunk_info("a.txt")[0].replicas), 2)
+
+    def test_heartbeat_unknown_server(self):
+        m, _ = init_master()
+        with self.assertRaises(ValueError):
+            m.heartbeat(("localhost", 4), {})
+
+    def test_create_compressed(self):
+        m, _ = init_master()
+        m.create("a.txt", compression="zlib")
+        self.assertEquals(m.open("a.txt").meta().compression, "zlib")
+        with self.assertRaises(ValueError):
+            m.create("b.txt", compression="nope")
+
+    def test_list(self):
+        m, _ = init_master()
+        for fname in ("logs/a", "logs/b", "logs/old/c", "x"):
+            m.create(fname)
+        self.assertEquals(m.list(), (["logs/", "x"], None))
+        self.assertEquals(m.list("logs/", limit=2), (["logs/a", "logs/b"], "logs/b"))
+        self.assertEquals(m.list("logs/", cursor="logs/b"), (["logs/old/"], None))
+        m.delete("logs/old/c")
+        self.assertEquals(m.list("logs/"), (["logs/a", "logs/b"], None))
+        with self.assertRaises(ValueError):
+            m.create("/y")
+
+    def test_delete_waits_for_sync(self):
+        posted = queue.Queue()
+        m, cservers = init_master(
+            replication=1,
+            call_soon=lambda fn, *args: posted.put((fn, args))
+        )
+        m.create("a.txt")
+        cinfo = m.request_new_chunk("a.txt").result()
+        cserver = cservers[cinfo.replicas[0][1] - 1]
+        m.delete("a.txt")
+        drain(m)
+        self.assertEquals(cserver.chunk_size(cinfo.id), 0)
+        self.assertEquals(m._garbage(), {cinfo.replicas[0]: [cinfo.id]})
+        fn, args = posted.get_nowait()
+        fn(*args)
+        drain(m)
+        with self.assertRaises(IOError):
+            cserver.chunk_size(cinfo.id)
+
+    def test_write_small(self):
+        m, cservers = init_master(replication=2)
+        m.create("a.txt")
+        m.create("b.txt")
+        a = m.write_small("a.txt", b"hello").result()
+        b = m.write_small("b.txt", b"world!").result()
+        self.assertEquals(a.id, b.id)
+        self.assertEquals((a.offset, a.length), (0, 5))
+        self.assertEquals((b.offset, b.length), (5, 6))
+        self.assertEquals(m.open("b.txt").meta().packed.offset, 5)
+        for cserver in cservers:
+            if cserver.addr() in b.replicas:
+                self.assertEquals(cserver.read_chunk(b.id, 5, 11), b"world!")
+        with self.assertRaises(IOError):
+            m.write_small("a.txt", b"again")
+        with self.assertRaises(IOError):
+            m.request_new_chunk("a.txt").result()
+        m.create("c.txt")
+        with self.assertRaises(ValueError):
+            m.write_small("c.txt", b"x" * (MAX_SMALL_FILE_SIZE + 1))
+
+    def test_write_small_fills_containers(self):
+        m, _ = init_master()
+        data = b"x" * MAX_SMALL_FILE_SIZE
+        ids = set()
+        for n in range(CHUNK_SIZE // len(data) + 1):
+            m.create("f{}".format(n))
+            ids.add(m.write_small("f{}".format(n), data).result().id)
+        self.assertEquals(len(ids), 2)
+
+    def test_delete_packed(self):
+        m, cservers = init_master(replication=1)
+        m.create("a.txt")
+        m.create("b.txt")
+        cinfo = m.write_small("a.txt", b"hello").result()
+        m.write_small("b.txt", b"world")
+        cserver = cservers[cinfo.replicas[0][1] - 1]
+        m.delete("a.txt")
+        m.delete("b.txt")
+        # Empty, but still taking files.
+        drain(m)
+        self.assertEquals(cserver.chunk_size(cinfo.id), 10)
+        m.create("c.txt")
+        self.assertEquals(m.write_small("c.txt", b"!").result().id, cinfo.id)
+        m._open_container = None
+        m.delete("c.txt")
+        drain(m)
+        with self.assertRaises(IOError):
+            cserver.chunk_size(cinfo.id)
+
+    def test_compact(self):
+        m, cservers = init_master(replication=1)
+        for fname in ("a.txt", "b.txt", "c.txt"):
+            m.create(fname)
+            old = m.write_small(fname, fname.encode() * 10).result()
+        m._open_container = None
+        self.assertFalse(m.compact())
+        m.delete("a.txt")
+        m.delete("b.txt")
+        self.assertTrue(m.compact())
+        self.assertFalse(m.compact())
+        m.sync().result()
+        drain(m)
+        with self.assertRaises(IOError):
+            cservers[old.replicas[0][1] - 1].chunk_size(old.id)
+        new = m.get_chunk_info("c.txt")[0]
+        self.assertNotEquals(new.id, old.id)
+        self.assertEquals((new.offset, new.length), (0, 50))
+        cserver = cservers[new.replicas[0][1] - 1]
+        self.assertEquals(cserver.read_chunk(new.id, 0, 50), b"c.txt" * 10)
+
+    def test_write_small_off_loop(self):
+        posted = queue.Queue()
+        m, _ = init_master(
+            replication=1,
+            io_pool=WorkerPool(2),
+            call_soon=lambda fn, *args: posted.put((fn, args))
+        )
+        m.create("a.txt")
+        fut = m.write_small("a.txt", b"hello")
+        fn, args = posted.get(timeout=5)
+        # Nothing's placed until the loop runs the results.
+        self.assertFalse(fut.done())
+        self.assertEquals(m.get_chunk_info("a.txt"), [])
+        fn(*args)
+        run_posted(posted, fut)
+        self.assertEquals(fut.result().length, 5)
+        self.assertEquals(m.get_chunk_info("a.txt")[0].length, 5)
+
+    def test_compact_bounded(self):
+        m, _ = init_master(replication=1)
+        for n in range(10):
+            m.create("f{}".format(n))
+            m.write_small("f{}".format(n), b"x" * 100).result()
+        m._open_container = None
+        for n in range(7):
+            m.delete("f{}".format(n))
+        self.assertEquals(m.compact(max_bytes=150), 200)
+        self.assertEquals(m.compact(max_bytes=150), 100)
+        self.assertEquals(m.compact(max_bytes=150), 0)
+        for n in range(7, 10):
+            cinfo = m.get_chunk_info("f{}".format(n))[0]
+            self.assertEquals(m._read_packed(cinfo), b"x" * 100)
+
+    def test_compact_skips_open_deleted(self):
+        m, _ = init_master(replication=1, gc_grace=60)
+        for fname in ("a.txt", "b.txt"):
+            m.create(fname)
+            m.write_small(fname, b"data")
+        m._open_container = None
+        m.delete("a.txt")
+        self.assertFalse(m.compact())
+
+    def test_unpack(self):
+        m, cservers = init_master(replication=2)
+        for fname, codec in (("a.txt", None), ("z.txt", "zlib")):
+            m.create(fname, compression=codec)
+            packed = m.write_small(fname, b"hello").result()
+            cinfos = m.unpack(fname).result()
+            self.assertEquals(len(cinfos), 1)
+            self.assertFalse(cinfos[0].packed())
+            self.assertNotEquals(cinfos[0].id, packed.id)
+            self.assertEquals(m.get_chunk_info(fname), cinfos)
+            self.assertEquals(m.unpack(fname).result(), cinfos)
+            stored = b"hello"
+            if codec:
+                stored = compression.encode(compression.get(codec), stored)
+            for cserver in cservers:
+                if cserver.addr() in cinfos[0].replicas:
+                    self.assertEquals(cserver.read_chunk(cinfos[0].id), stored)
+        # Now it can grow.
+        m.request_new_chunk("a.txt").result()
+        self.assertEquals(len(m.get_chunk_info("a.txt")), 2)
+
+    def test_unpack_deleted(self):
+        posted = queue.Queue()
+        m, cservers = init_master(
+            replication=1,
+            io_pool=WorkerPool(1),
+            call_soon=lambda fn, *args: posted.put((fn, args))
+        )
+        m.create("a.txt")
+        m.create("b.txt")
+        for fname in ("a.txt", "b.txt"):
+            run_posted(posted, m.write_small(fname, b"data"))
+        fut = m.unpack("a.txt")
+        m.delete("a.txt")
+        run_posted(posted, fut)
+        with self.assertRaises(IOError):
+            fut.result()
+        drain(m)
+        self.assertEquals(sum(len(c.chunk_ids()) for c in cservers), 1)
+
+    def test_stats(self):
+        m, _ = init_master()
+        m.create("a.txt")
+        m.heartbeat(("localhost", 2), {"chunks": 5, "free": 0, "inflight": 3})
+        stats = m.stats()
+        self.assertEquals(stats["files"], 1)
+        server = [s for s in stats["chunkservers"] if s["addr"] == "localhost:2"]
+        self.assertEquals(server[0]["chunks"], 5)
+        self.assertEquals(server[0]["inflight"], 3)
+
+    def test_skips_dead_servers(self):
+        m, _ = init_master(heartbeat_timeout=10)
+        dead = m.chunkserver_states()[0]
+        dead.last_seen -= 60
+        m.create("a.txt")
+        cinfos = m.request_new_chunks("a.txt", 4).result()
+        for cinfo in cinfos:
+            self.assertEquals(len(cinfo.replicas), 2)
+            self.assertTrue(dead.addr not in cinfo.replicas)
+
+    def test_skips_full_servers(self):
+        m, _ = init_master(replication=1)
+        for s in m.chunkserver_states():
+            m.heartbeat(s.addr, {"chunks": 0, "free": 0, "inflight": 0})
+        m.heartbeat(("localhost", 2), {
+            "chunks": 0,
+            "free": 10 * CHUNK_SIZE,
+            "inflight": 0
+        })
+        m.create("a.txt")
+        for cinfo in m.request_new_chunks("a.txt", 5).result():
+            self.assertEquals(cinfo.replicas, [("localhost", 2)])
+        with self.assertRaises(ValueError):
+            m.request_new_chunks("a.txt", 10).result()
+
+    def test_least_loaded(self):
+        m, _ = init_master(itr=LeastLoadedPlacement(), replication=1)
+        for port, chunks in ((1, 5), (2, 0), (3, 3)):
+            m.heartbeat(("localhost", port), {
+                "chunks": chunks,
+                "free": None,
+                "inflight": 0
+            })
+        m.create("a.txt")
+        cinfos = m.request_new_chunks("a.txt", 5).result()
+        placed = [c.replicas[0][1] for c in cinfos]
+        self.assertEquals(placed.count(2), 4)
+        self.assertEquals(placed.count(3), 1)
+
+    def test_policies_spread_chunks(self):
+        for itr in (CapacityWeightedPlacement(), RandomOfTwoPlacement()):
+            m, _ = init_master(itr=itr, replication=1)
+            m.create("a.txt")
+            m.request_new_chunks("a.txt", 30).result()
+            for s in m.chunkserver_states():
+                self.assertTrue(s.chunks > 0)
+
+class TestMasterRecovery(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def restart(self, m=None, **kwargs):
+        if m is not None:
+            while m._oplog.checkpointing():
+                time.sleep(0.01)
+            m._oplog.close()
+        return init_master(oplog=OpLog(self.dir), **kwargs)[0]
+
+    def check_namespace(self, m):
+        self.assertEquals(m.get_chunk_info("b.txt"), [])
+        with self.assertRaises(IOError):
+            m.open("a.txt")
+        cinfos = m.get_chunk_info("c.txt")
+        self.assertEquals(len(cinfos), 3)
+        self.assertEquals(len(cinfos[0].replicas), 3)
+        self.assertEquals(cinfos[0].replicas[0][0], "localhost")
+        self.assertEquals(m.stat("b.txt").compression, "zlib")
+        self.assertEquals(m.stat("c.txt").compression, None)
+        self.assertEquals(m.list()[0][:2], ["b.txt", "c.txt"])
+        cinfo = m.get_chunk_info("s.txt")[0]
+        self.assertEquals((cinfo.offset, cinfo.length), (4, 5))
+        self.assertEquals(m.stat("s.txt").meta().packed.id, cinfo.id)
+        self.assertEquals(list(m._containers), [cinfo.id])
+
+    def populate(self, m):
+        m.create("a.txt")
+        m.create("b.txt", compression="zlib")
+        m.create("c.txt")
+        m.request_new_chunks("a.txt", 1).result()
+        m.request_new_chunks("c.txt", 2).result()
+        m.request_new_chunk("c.txt").result()
+        m.delete("a.txt")
+        m.create("t.txt")
+        m.write_small("t.txt", b"tiny")
+        m.create("s.txt")
+        m.write_small("s.txt", b"small")
+        m.delete("t.txt")
+        m.sync().result()
+
+    def test_recover_from_log(self):
+        m = self.restart()
+        self.populate(m)
+        self.check_namespace(self.restart(m))
+
+    def test_recover_from_checkpoint(self):
+        m = self.restart(checkpoint_ops=3)
+        self.populate(m)
+        m = self.restart(m)
+        self.check_namespace(m)
+        m.create("d.txt")
+        self.assertTrue(m.checkpoint())
+        m = self.restart(m)
+        self.check_namespace(m)
+        self.assertEquals(m.get_chunk_info("d.txt"), [])
+
+    def test_checkpoint_on_delete(self):
+        m = self.restart(checkpoint_ops=3)
+        m.create("a")
+        m.request_new_chunk("a").result()
+        m.delete("a")
+        m.sync().result()
+        m = self.restart(m)
+        with self.assertRaises(IOError):
+            m.open("a")
+        self.assertEquals(m.list(), ([], None))
+
+    def test_checkpoint_during_changes(self):
+        m = self.restart()
+        m.create("a")
+        m.request_new_chunk("a").result()
+        m.create("b")
+        # Hold the encoder back until the files have changed.
+        go = threading.Event()
+        start = m._oplog.checkpoint
+        def checkpoint(encode):
+            def held():
+                go.wait()
+                return encode()
+            return start(held)
+        m._oplog.checkpoint = checkpoint
+        self.assertTrue(m.checkpoint())
+        self.assertFalse(m.checkpoint())
+        m.request_new_chunks("a", 2).result()
+        m.write_small("b", b"small")
+        m.sync().result()
+        go.set()
+        m2 = self.restart(m)
+        self.assertIsNone(m._saved)
+        self.assertEquals(len(m2.get_chunk_info("a")), 3)
+        self.assertEquals(len(m2.get_chunk_info("b")), 1)
+
+    def test_checkpoint_keeps_garbage(self):
+        cservers = init_master()[1]
+        def restart(m=None, **kwargs):
+            if m is not None:
+                while m._oplog.checkpointing():
+                    time.sleep(0.01)
+                m._oplog.close()
+            return Master(
+                chunkserver_iter=RoundRobinIter(),
+                chunkservers=cservers,
+                oplog=OpLog(self.dir),
+                **kwargs
+            )
+        m = restart(gc_grace=1000)
+        for fname in ("hidden", "queued", "packed"):
+            m.create(fname)
+        m.request_new_chunks("hidden", 2).result()
+        m.request_new_chunks("queued", 1).result()
+        m.write_small("packed", b"data")
+        m.delete("hidden")
+        m.delete("packed")
+        m._gc_grace = 0
+        m.delete("queued")
+        self.assertTrue(m.checkpoint())
+        m = restart(m)
+        drain(m)
+        for cserver in cservers:
+            self.assertEquals(list(cserver.chunk_ids()), [])
+
 if __name__ == "__main__":
     unittest.main()
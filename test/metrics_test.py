@@ -0,0 +1,41 @@
+import setup
+import unittest
+
+from metrics import Histogram, RpcMetrics
+
+class TestHistogram(unittest.TestCase):
+
+    def test_percentiles(self):
+        h = Histogram(bounds=[1, 2, 4])
+        for value in [0.5] * 98 + [3, 3]:
+            h.record(value)
+        self.assertEquals(h.count, 100)
+        self.assertEquals(h.percentile(50), 1)
+        self.assertEquals(h.percentile(99), 4)
+
+    def test_overflow(self):
+        h = Histogram(bounds=[1])
+        h.record(5)
+        self.assertEquals(h.counts, [0, 1])
+        self.assertEquals(h.percentile(50), None)
+
+class TestRpcMetrics(unittest.TestCase):
+
+    def test_counts(self):
+        m = RpcMetrics()
+        call = m.start("read", 10)
+        self.assertEquals(m.inflight(), 1)
+        m.finish(call, 100)
+        m.finish(m.start("read", 5), 0, error=True)
+
+        stats = m.to_hash()
+        self.assertEquals(stats["inflight"], 0)
+        read = stats["methods"]["read"]
+        self.assertEquals(read["calls"], 2)
+        self.assertEquals(read["errors"], 1)
+        self.assertEquals(read["bytes_in"], 15)
+        self.assertEquals(read["bytes_out"], 100)
+        self.assertEquals(read["latency"]["count"], 2)
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,51 @@
+import setup
+import unittest
+
+import namespace
+from namespace import NamespaceIndex
+
+class TestNamespaceIndex(unittest.TestCase):
+
+    def test_list_directory(self):
+        index = NamespaceIndex(["b", "a/x", "a/y/z", "c"])
+        self.assertEquals(index.list("", 10), (["a/", "b", "c"], None))
+        self.assertEquals(index.list("a/", 10), (["a/x", "a/y/"], None))
+        self.assertEquals(index.list("a/y/", 10), (["a/y/z"], None))
+        self.assertEquals(index.list("nope/", 10), ([], None))
+
+    def test_list_prefix(self):
+        index = NamespaceIndex()
+        for name in ["log-1", "log-2", "data", "logs/a"]:
+            index.add(name)
+        self.assertEquals(index.list("log", 10), (["log-1", "log-2", "logs/"], None))
+        self.assertEquals(index.list("log-", 10), (["log-1", "log-2"], None))
+
+    def test_paging(self):
+        index = NamespaceIndex("d/{:03}".format(n) for n in range(25))
+        index.add("e")
+        names, cursor = [], None
+        while True:
+            page, cursor = index.list("d/", 10, cursor)
+            names.extend(page)
+            if cursor is None:
+                break
+        self.assertEquals(names, ["d/{:03}".format(n) for n in range(25)])
+
+    def test_remove_prunes_directories(self):
+        index = NamespaceIndex(["a/b/c", "a/d"])
+        index.remove("a/b/c")
+        self.assertEquals(index.list("a/", 10), (["a/d"], None))
+        index.remove("a/d")
+        self.assertEquals(index.list("", 10), ([], None))
+
+    def test_clashes(self):
+        index = NamespaceIndex(["a/b"])
+        with self.assertRaises(IOError):
+            index.add("a")
+        with self.assertRaises(IOError):
+            index.add("a/b/c")
+        with self.assertRaises(ValueError):
+            namespace.check("a//b")
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,85 @@
+import setup
+import os
+import shutil
+import tempfile
+import time
+import unittest
+
+from oplog import OpLog
+
+class TestOpLog(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def init_log(self):
+        log = OpLog(self.dir)
+        checkpoint, ops = log.recover()
+        log.start()
+        return log, checkpoint, ops
+
+    def wait_checkpoint(self, log):
+        while log.checkpointing():
+            time.sleep(0.01)
+
+    def test_recover_empty(self):
+        _, checkpoint, ops = self.init_log()
+        self.assertEquals(checkpoint, None)
+        self.assertEquals(ops, [])
+
+    def test_append_recover(self):
+        log, _, _ = self.init_log()
+        for n in range(3):
+            log.append({"op": "create", "n": n})
+        log.commit().result()
+        log.close()
+        _, _, ops = self.init_log()
+        self.assertEquals([op["n"] for op in ops], [0, 1, 2])
+
+    def test_group_commit(self):
+        log, _, _ = self.init_log()
+        futs = []
+        for n in range(100):
+            log.append({"n": n})
+            futs.append(log.commit())
+        for fut in futs:
+            fut.result()
+
+    def test_torn_tail(self):
+        log, _, _ = self.init_log()
+        log.append({"n": 0})
+        log.append({"n": 1})
+        log.close()
+        path = os.path.join(self.dir, "log.1")
+        with open(path, "r+b") as f:
+            f.truncate(os.path.getsize(path) - 1)
+
+        log, _, ops = self.init_log()
+        self.assertEquals([op["n"] for op in ops], [0])
+        log.append({"n": 2})
+        log.close()
+        _, _, ops = self.init_log()
+        self.assertEquals([op["n"] for op in ops], [0, 2])
+
+    def test_checkpoint(self):
+        log, _, _ = self.init_log()
+        log.append({"n": 0})
+        log.append({"n": 1})
+        self.assertTrue(log.checkpoint(lambda: b"state"))
+        self.wait_checkpoint(log)
+        log.append({"n": 2})
+        log.close()
+        self.assertEquals(
+            sorted(os.listdir(self.dir)),
+            ["checkpoint.2", "log.3"]
+        )
+
+        _, checkpoint, ops = self.init_log()
+        self.assertEquals(checkpoint, b"state")
+        self.assertEquals([op["n"] for op in ops], [2])
+
+if __name__ == "__main__":
+    unittest.main()
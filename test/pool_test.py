@@ -0,0 +1,99 @@
+
+import setup
+import os
+import socket
+import time
+import unittest
+
+from pool import ConnectionPool
+
+class FakeConn:
+
+    def __init__(self, addr):
+        self.addr = addr
+        self.sock, self.peer = socket.socketpair()
+        self.closed = False
+
+    def fileno(self):
+        return self.sock.fileno()
+
+    def close(self):
+        self.closed = True
+        self.sock.close()
+
+def init_pool(**kwargs):
+    conns = []
+    def connect(addr):
+        conn = FakeConn(addr)
+        conns.append(conn)
+        return conn
+    return ConnectionPool(connect=connect, **kwargs), conns
+
+class TestConnectionPool(unittest.TestCase):
+
+    def test_reuse(self):
+        pool, conns = init_pool()
+        with pool.connection(("a", 1)) as c1:
+            pass
+        with pool.connection(("a", 1)) as c2:
+            pass
+        self.assertIs(c1, c2)
+        self.assertEquals(len(conns), 1)
+
+    def test_keyed_by_addr(self):
+        pool, conns = init_pool()
+        with pool.connection(("a", 1)) as c1:
+            pass
+        with pool.connection(("b", 1)) as c2:
+            pass
+        self.assertIsNot(c1, c2)
+
+    def test_unhealthy_discarded(self):
+        pool, conns = init_pool()
+        with pool.connection(("a", 1)) as c1:
+            pass
+        c1.peer.close()
+        with pool.connection(("a", 1)) as c2:
+            pass
+        self.assertIsNot(c1, c2)
+        self.assertTrue(c1.closed)
+
+    def test_high_fd_reused(self):
+        pool, conns = init_pool()
+        with pool.connection(("a", 1)) as c1:
+            # Past FD_SETSIZE, which select can't handle.
+            os.dup2(c1.sock.fileno(), 1100)
+            self.addCleanup(os.close, 1100)
+            c1.fileno = lambda: 1100
+        with pool.connection(("a", 1)) as c2:
+            pass
+        self.assertIs(c1, c2)
+
+    def test_error_discards(self):
+        pool, conns = init_pool()
+        with self.assertRaises(IOError):
+            with pool.connection(("a", 1)) as c1:
+                raise IOError("broken")
+        self.assertTrue(c1.closed)
+
+    def test_idle_timeout(self):
+        pool, conns = init_pool(idle_timeout=0)
+        with pool.connection(("a", 1)) as c1:
+            pass
+        time.sleep(0.01)
+        with pool.connection(("a", 1)) as c2:
+            pass
+        self.assertIsNot(c1, c2)
+        self.assertTrue(c1.closed)
+
+    def test_max_per_addr(self):
+        pool, conns = init_pool(max_per_addr=2)
+        c1 = pool.checkout(("a", 1))
+        c2 = pool.checkout(("a", 1))
+        pool.checkin(("a", 1), c1)
+        c3 = pool.checkout(("a", 1))
+        self.assertIs(c1, c3)
+        self.assertEquals(len(conns), 2)
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,47 @@
+
+import setup
+import socket
+import unittest
+
+import rpc
+
+class TestRpc(unittest.TestCase):
+
+    def test_frame_payload(self):
+        a, b = socket.socketpair()
+        payload = b"\x00\xff" * 1000
+        rpc.sendframe(a, {"method": "write_chunk"}, payload)
+        meta, data = rpc.recvframe(b)
+        self.assertEquals(meta["method"], "write_chunk")
+        self.assertEquals(data, payload)
+
+    def test_frame_empty_payload(self):
+        a, b = socket.socketpair()
+        rpc.sendframe(a, {"status": "ok"})
+        meta, data = rpc.recvframe(b)
+        self.assertEquals(meta["status"], "ok")
+        self.assertEquals(len(data), 0)
+
+    def test_recvframe_closed(self):
+        a, b = socket.socketpair()
+        a.close()
+        self.assertEquals(rpc.recvframe(b), None)
+
+    def test_recvframe_bad_meta(self):
+        for meta in (b"{not json", b"[1, 2]"):
+            a, b = socket.socketpair()
+            a.sendall(rpc._FRAME_HEADER.pack(rpc._FRAME_MAGIC, len(meta), 0))
+            a.sendall(meta)
+            with self.assertRaises(IOError):
+                rpc.recvframe(b)
+
+    def test_recvframe_too_big(self):
+        for metalen, paylen in ((2, 1 << 40), (1 << 30, 0)):
+            a, b = socket.socketpair()
+            a.sendall(rpc._FRAME_HEADER.pack(rpc._FRAME_MAGIC, metalen, paylen))
+            a.sendall(b"{}")
+            with self.assertRaises(IOError):
+                rpc.recvframe(b)
+
+if __name__ == "__main__":
+    unittest.main()
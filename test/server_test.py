@@ -0,0 +1,110 @@
+
+import setup
+import threading
+import unittest
+
+import rpc
+from server import Server
+from workers import Future
+
+class TestServer(unittest.TestCase):
+
+    def setUp(self):
+        self.server = Server()
+        self.port = self.server.listen(0).getsockname()[1]
+        self.running = True
+        self.thread = threading.Thread(target=self.serve)
+        self.thread.start()
+
+    def tearDown(self):
+        self.running = False
+        self.thread.join()
+
+    def serve(self):
+        while self.running:
+            self.server.poll_once(0.01)
+
+    def connect(self):
+        return rpc.connect(("127.0.0.1", self.port))
+
+    def test_call(self):
+        self.server.register("echo", lambda conn, msg, payload: (
+            {"n": msg["n"]}, payload
+        ))
+        resp, payload = rpc.call_framed(self.connect(), "echo", b"x" * 5000, n=3)
+        self.assertEquals(resp["n"], 3)
+        self.assertEquals(payload, b"x" * 5000)
+
+    def test_error(self):
+        def fail(conn, msg, payload):
+            raise IOError("broken")
+        self.server.register("fail", fail)
+        resp, _ = rpc.call_framed(self.connect(), "fail")
+        self.assertEquals(resp["error"], "broken")
+
+    def test_unknown_method(self):
+        resp, _ = rpc.call_framed(self.connect(), "nope")
+        self.assertTrue("error" in resp)
+
+    def test_deferred_responses_in_order(self):
+        futs = []
+        def slow(conn, msg, payload):
+            fut = Future()
+            futs.append(fut)
+            return fut
+        self.server.register("slow", slow)
+        self.server.register("fast", lambda conn, msg, payload: {"n": 2})
+        conn = self.connect()
+        rpc.sendframe(conn, {"method": "slow"})
+        rpc.sendframe(conn, {"method": "fast"})
+        while not futs:
+            pass
+        futs[0].set_result({"n": 1})
+        self.assertEquals(rpc.recvframe(conn)[0]["n"], 1)
+        self.assertEquals(rpc.recvframe(conn)[0]["n"], 2)
+
+    def test_bad_meta_closes_conn(self):
+        for meta in (b"{not json", b"[1, 2]", b"\xff"):
+            conn = self.connect()
+            conn.sendall(rpc._FRAME_HEADER.pack(rpc._FRAME_MAGIC, len(meta), 0))
+            conn.sendall(meta)
+            self.assertEquals(conn.recv(1), b"")
+        self.assertTrue(self.thread.is_alive())
+        resp, _ = rpc.call_framed(self.connect(), "nope")
+        self.assertTrue("error" in resp)
+
+    def test_huge_frame_closes_conn(self):
+        conn = self.connect()
+        conn.sendall(rpc._FRAME_HEADER.pack(rpc._FRAME_MAGIC, 2, 1 << 40))
+        self.assertEquals(conn.recv(1), b"")
+        self.assertTrue(self.thread.is_alive())
+        resp, _ = rpc.call_framed(self.connect(), "nope")
+        self.assertTrue("error" in resp)
+
+    def test_metrics(self):
+        def fail(conn, msg, payload):
+            raise IOError("broken")
+        self.server.register("echo", lambda conn, msg, payload: ({}, payload))
+        self.server.register("fail", fail)
+        conn = self.connect()
+        rpc.call_framed(conn, "echo", b"x" * 10)
+        rpc.call_framed(conn, "fail")
+        rpc.call_framed(conn, "nope")
+
+        methods = self.server.metrics.to_hash()["methods"]
+        self.assertEquals(methods["echo"]["calls"], 1)
+        self.assertEquals(methods["echo"]["bytes_in"], 10)
+        self.assertEquals(methods["echo"]["bytes_out"], 10)
+        self.assertEquals(methods["fail"]["errors"], 1)
+        self.assertEquals(methods["<unknown>"]["errors"], 1)
+
+    def test_many_connections(self):
+        self.server.register("ping", lambda conn, msg, payload: {"status": "ok"})
+        conns = [self.connect() for _ in range(50)]
+        for conn in conns:
+            rpc.sendframe(conn, {"method": "ping"})
+        for conn in conns:
+            self.assertEquals(rpc.recvframe(conn)[0]["status"], "ok")
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,129 @@
+
+import setup
+import threading
+import unittest
+
+from workers import Future, KeyedThreads, WorkerPool, chain, gather
+
+class TestWorkerPool(unittest.TestCase):
+
+    def test_submit(self):
+        pool = WorkerPool(2)
+        fut = pool.submit(lambda a, b: a + b, 1, 2)
+        self.assertEquals(fut.result(), 3)
+        pool.shutdown()
+
+    def test_submit_error(self):
+        pool = WorkerPool(1)
+        def fail():
+            raise IOError("failed")
+        fut = pool.submit(fail)
+        with self.assertRaises(IOError):
+            fut.result()
+        self.assertTrue(isinstance(fut.exception(), IOError))
+        pool.shutdown()
+
+    def test_done_callback(self):
+        fut = Future()
+        seen = []
+        fut.add_done_callback(lambda f: seen.append(f.result()))
+        fut.set_result(5)
+        fut.add_done_callback(lambda f: seen.append(f.result()))
+        self.assertEquals(seen, [5, 5])
+
+    def test_parallel(self):
+        pool = WorkerPool(2)
+        barrier = threading.Event()
+        first = pool.submit(barrier.wait, 5)
+        second = pool.submit(barrier.set)
+        second.result()
+        self.assertTrue(first.result())
+        pool.shutdown()
+
+    def test_keyed_ordering(self):
+        pool = WorkerPool(4)
+        seen = []
+        futs = [pool.submit_keyed("c1", seen.append, i) for i in range(100)]
+        for fut in futs:
+            fut.result()
+        self.assertEquals(seen, list(range(100)))
+        pool.shutdown()
+
+    def test_keyed_parallel(self):
+        pool = WorkerPool(2)
+        barrier = threading.Event()
+        first = pool.submit_keyed("c1", barrier.wait, 5)
+        queued = pool.submit_keyed("c1", lambda: barrier.is_set())
+        second = pool.submit_keyed("c2", barrier.set)
+        second.result()
+        self.assertTrue(first.result())
+        self.assertTrue(queued.result())
+        pool.shutdown()
+
+    def test_inflight(self):
+        pool = WorkerPool(1)
+        gate = threading.Event()
+        futs = [pool.submit(gate.wait), pool.submit_keyed("k", gate.wait)]
+        self.assertEquals(pool.inflight(), 2)
+        gate.set()
+        for fut in futs:
+            fut.wait()
+        self.assertEquals(pool.inflight(), 0)
+
+    def test_gather_then(self):
+        a, b = Future(), Future()
+        fut = gather([a, b]).then(lambda results: sum(results))
+        a.set_result(1)
+        self.assertFalse(fut.done())
+        b.set_result(2)
+        self.assertEquals(fut.result(), 3)
+
+    def test_gather_error(self):
+        a, b = Future(), Future()
+        fut = gather([a, b])
+        try:
+            raise IOError("failed")
+        except IOError:
+            import sys
+            a.set_exception(sys.exc_info())
+        b.set_result(2)
+        with self.assertRaises(IOError):
+            fut.result()
+
+    def test_chain(self):
+        a, b = Future(), Future()
+        fut = chain(a, lambda x: b.then(lambda y: x + y))
+        a.set_result(1)
+        self.assertFalse(fut.done())
+        b.set_result(2)
+        self.assertEquals(fut.result(), 3)
+
+    def test_chain_error(self):
+        a = Future()
+        def fail(_):
+            raise IOError("failed")
+        fut = chain(a, fail)
+        a.set_result(1)
+        with self.assertRaises(IOError):
+            fut.result()
+
+class TestKeyedThreads(unittest.TestCase):
+
+    def test_ordering(self):
+        threads = KeyedThreads()
+        seen = []
+        futs = [threads.submit_keyed("c1", seen.append, i) for i in range(100)]
+        for fut in futs:
+            fut.result()
+        self.assertEquals(seen, list(range(100)))
+
+    def test_keys_never_wait(self):
+        threads = KeyedThreads()
+        gate = threading.Event()
+        waiting = [threads.submit_keyed(n, gate.wait, 5) for n in range(20)]
+        threads.submit_keyed("last", gate.set)
+        for fut in waiting:
+            self.assertTrue(fut.result())
+
+if __name__ == "__main__":
+    unittest.main()